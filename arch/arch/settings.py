@@ -31,8 +31,78 @@ CONTACT_EMAIL = os.environ.get('CONTACT_EMAIL', default='admin@example.com')
 ACTIVATE_AI_SEARCH = eval(os.environ.get("ACTIVATE_AI_SEARCH", default=0))
 # Quantize the AI models used by the search module to reduce memory usage
 QUANTIZE_CLIP_MODELS = eval(os.environ.get("QUANTIZE_CLIP_MODELS", default=1))
+# Runtime of the CLIP models: 'torch' (sentence-transformers) or 'onnx' (ONNX Runtime on the CPU, requires
+# onnxruntime, the models are exported once with manage.py export_onnx_models), both are quantized as set above
+CLIP_BACKEND = os.environ.get("CLIP_BACKEND", default="torch")
+# CLIP models used by the search module (names on huggingface.co), the text model has to encode texts into the
+# embedding space of the image model. Changing a model marks the stored image embeddings as stale.
+IMAGE_EMBEDDING_MODEL = os.environ.get("IMAGE_EMBEDDING_MODEL", default="clip-ViT-B-32")
+TEXT_EMBEDDING_MODEL = os.environ.get("TEXT_EMBEDDING_MODEL",
+                                      default="sentence-transformers/clip-ViT-B-32-multilingual-v1")
+# Number of dimensions of the embeddings of the image model, the width of the vector column of the pgvector index
+# (after a change run makemigrations arch_vector, migrate and build_vector_index)
+IMAGE_EMBEDDING_DIMENSIONS = int(os.environ.get("IMAGE_EMBEDDING_DIMENSIONS", default=512))
+# Seconds after which an AI model which was not used is unloaded again (0 keeps the models loaded), models preloaded by
+# the qcluster workers and the inference server are never unloaded
+AI_MODEL_IDLE_TIMEOUT = int(os.environ.get("AI_MODEL_IDLE_TIMEOUT", default=1800))
+# Number of images encoded at once by the image model and number of threads decoding the next images meanwhile
+IMAGE_EMBEDDING_BATCH_SIZE = int(os.environ.get("IMAGE_EMBEDDING_BATCH_SIZE", default=16))
+IMAGE_DECODE_WORKERS = int(os.environ.get("IMAGE_DECODE_WORKERS", default=4))
+# Number type of the stored image embeddings: 'float32' or 'float16' (half the size)
+EMBEDDING_DTYPE = os.environ.get("EMBEDDING_DTYPE", default="float32")
+# Vector index used to rank records by image embedding similarity:
+# 'python' (exact, computed in the web process), 'pgvector' (approximate, HNSW index, requires pgvector==0.3.2)
+# or 'mmap' (exact, memory-mapped .npy files shared by the web processes, no database extension)
+VECTOR_SEARCH_BACKEND = os.environ.get("VECTOR_SEARCH_BACKEND", default="python")
+# Directory and number type ('float32' or 'float16', half the memory but slower) of the 'mmap' vector index files
+VECTOR_INDEX_PATH = os.environ.get("VECTOR_INDEX_PATH", default=os.path.join(BASE_DIR, 'vector_index'))
+VECTOR_INDEX_DTYPE = os.environ.get("VECTOR_INDEX_DTYPE", default="float32")
+# Number of nearest neighbours fetched from an approximate vector index per search
+VECTOR_SEARCH_TOP_K = int(os.environ.get("VECTOR_SEARCH_TOP_K", default=500))
+# pgvector: continue the index scan until VECTOR_SEARCH_TOP_K permitted records are found (requires the pgvector
+# extension >= 0.8) and the number of permitted records up to which all of them are compared without the index
+VECTOR_SEARCH_ITERATIVE_SCAN = eval(os.environ.get("VECTOR_SEARCH_ITERATIVE_SCAN", default="True"))
+VECTOR_SEARCH_EXACT_LIMIT = int(os.environ.get("VECTOR_SEARCH_EXACT_LIMIT", default=10000))
+# Number of search query embeddings cached in memory per process (0 disables the cache)
+TEXT_EMBEDDING_CACHE_SIZE = int(os.environ.get("TEXT_EMBEDDING_CACHE_SIZE", default=1024))
+# Optional cache (name of a cache in CACHES, e.g. 'default') to share search query embeddings between processes
+TEXT_EMBEDDING_SHARED_CACHE = os.environ.get("TEXT_EMBEDDING_SHARED_CACHE", default=None)
+# Where search results are scored and sorted: 'python' (in the web process) or 'sql' (in a single database query,
+# with AI search only with the pgvector backend, otherwise the results are ranked in python)
+SEARCH_RANKING_MODE = os.environ.get("SEARCH_RANKING_MODE", default="python")
+# Seconds a search result set (the navigation context of search and album pages) is kept in the database
+RESULT_SET_TTL = int(os.environ.get("RESULT_SET_TTL", default=86400))
+# Only rank records matching the full-text query, a fuzzy word of the query, a depicted user or a nearby embedding
+SEARCH_FULL_TEXT_PREFILTER = eval(os.environ.get("SEARCH_FULL_TEXT_PREFILTER", default="False"))
+# Minimum trigram word similarity (between 0 and 1) for fuzzy autocomplete suggestions
+TRIGRAM_SIMILARITY_THRESHOLD = float(os.environ.get("TRIGRAM_SIMILARITY_THRESHOLD", default=0.6))
 # Face Detection: Automatically detects faces on uploaded images (requires Tensorflow and cvlib==0.2.7)
 ACTIVATE_FACE_DETECTION = eval(os.environ.get("ACTIVATE_FACE_DETECTION", default=0))
+# Face detection backend: 'cvlib' (requires TensorFlow and cvlib), 'ssd' (the model of cvlib run with OpenCV, same
+# boxes without TensorFlow) or 'yunet' (YuNet model run with OpenCV), see manage.py benchmark_face_detectors
+FACE_DETECTOR = os.environ.get("FACE_DETECTOR", default="cvlib")
+# Weights of the 'ssd' and 'yunet' backends (downloaded with manage.py download_face_detectors): the commit of the
+# OpenCV model zoo the YuNet model is downloaded from and the SHA-256 checksums of the files, by file name, e.g.
+# "{'face_detection_yunet_2023mar.onnx': '<sha256>'}" (files without a matching checksum are not used)
+FACE_DETECTOR_YUNET_REVISION = os.environ.get("FACE_DETECTOR_YUNET_REVISION", default="")
+FACE_DETECTOR_WEIGHTS_SHA256 = eval(os.environ.get("FACE_DETECTOR_WEIGHTS_SHA256", default="{}"))
+# Detect faces also on images which contain face regions in their XMP metadata (the regions are imported in any case)
+FORCE_FACE_DETECTION = eval(os.environ.get("FORCE_FACE_DETECTION", default="False"))
+# Longest side in pixels of the images decoded for face detection (0 decodes the full image)
+FACE_DETECTION_IMAGE_SIZE = int(os.environ.get("FACE_DETECTION_IMAGE_SIZE", default=1024))
+# Unix socket of the local inference server (manage.py run_inference_server), which hosts the AI models once for all
+# web and qcluster processes ('' loads the models in every process), seconds to wait for its answers and milliseconds
+# the server waits for concurrent requests to process them in one batch
+INFERENCE_SOCKET = os.environ.get("INFERENCE_SOCKET", default="")
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", default=60))
+INFERENCE_BATCH_WAIT = float(os.environ.get("INFERENCE_BATCH_WAIT", default=5))
+# Function (dotted path) run by every qcluster worker process when it starts, e.g. to load the AI models before the
+# first task ('' disables it), and the memory in MB a worker may use for the preloaded models (0 for no limit)
+QCLUSTER_WARMUP_HOOK = os.environ.get("QCLUSTER_WARMUP_HOOK", default="arch_app.workers.warm_up_models")
+QCLUSTER_MEMORY_BUDGET = int(os.environ.get("QCLUSTER_MEMORY_BUDGET", default=0))
+# Memory in MB the models add to a worker, replaces the estimates of arch_app.workers.MODEL_MEMORY with the values
+# logged by the warm-up, e.g. "{'face_detection_cvlib': 950}"
+QCLUSTER_MODEL_MEMORY = eval(os.environ.get("QCLUSTER_MODEL_MEMORY", default="{}"))
 # Moderation settings: Hides new comments as default until they are approved by a moderator
 HIDE_COMMENTS = eval(os.environ.get("HIDE_COMMENTS", default=1))
 # Maximum file size for uploads in bytes (i.e. 2.5 MB * 100)
@@ -59,6 +129,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',          # PostgreSQL specific lookups (e.g. trigram similarity)
 
     # custom apps:
     'mathfilters',                      # math filters for Django templates
@@ -70,6 +141,8 @@ INSTALLED_APPS = [
     "crispy_bootstrap5",                # crispy forms for bootstrap5
     # 'debug_toolbar',                  # debug toolbar (for developers)
 ]
+if VECTOR_SEARCH_BACKEND == 'pgvector':
+    INSTALLED_APPS.append('arch_vector.apps.ArchVectorConfig')  # pgvector index of the record embeddings
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -124,6 +197,10 @@ DATABASES = {
                 'HOST': os.environ.get("SQL_HOST", default='localhost'),
                 # set to empty string for default (5432)
                 'PORT': os.environ.get("SQL_PORT", default="5432"),
+                # threshold of the trigram word similarity operators used by the autocomplete
+                'OPTIONS': {
+                    'options': f"-c pg_trgm.word_similarity_threshold={TRIGRAM_SIMILARITY_THRESHOLD}",
+                },
                 'TEST': {
                     'NAME': 'arch_db_test',
                 },
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ArchAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'arch_app'
+
+    def ready(self):
+        # warm-up of the qcluster worker processes
+        from . import workers  # noqa: F401
@@ -0,0 +1,93 @@
+"""
+This script compares the face detection backends (see modules/computer_vision/face_detectors.py) on image records of
+the archive: the time to load a backend, the time per image, the resident memory of the process and the agreement
+of the boxes with the first backend. Every backend runs in a new process, so that the memory of a backend (e.g.
+TensorFlow imported by cvlib) does not count for the others.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from arch_app.models import Record
+from arch_app.modules.computer_vision.face_detectors import create_detector, DETECTORS
+from arch_app.modules.computer_vision.image_loading import load_image, box_iou
+from arch_app.modules.embeddings.model_registry import resident_memory
+
+
+def match_boxes(reference, boxes, threshold=0.5):
+    """ returns the number of reference boxes which overlap a box with an IoU of at least the threshold """
+    return sum(1 for box in reference if any(box_iou(box, other) >= threshold for other in boxes))
+
+
+class Command(BaseCommand):
+    help = 'compares the latency and memory of the face detection backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', dest='backends', choices=list(DETECTORS),
+                            help='backend to compare (can be repeated, default: all), the first one is the reference')
+        parser.add_argument('--records', type=int, default=100, help='number of image records')
+        # runs a single backend and prints the results as JSON (used for the new processes)
+        parser.add_argument('--record-ids', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['record_ids']:
+            self.run_backend(options['backends'][0], [int(pk) for pk in options['record_ids'].split(',')])
+            return
+        record_ids = list(Record.objects.filter(type='Image').order_by('?')
+                          .values_list('id', flat=True)[:options['records']])
+        if not record_ids:
+            raise CommandError('There are no image records to compare.')
+        results = {}
+        for backend in options['backends'] or list(DETECTORS):
+            result = subprocess.run(
+                [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_face_detectors',
+                 '--backend', backend, '--record-ids', ','.join(map(str, record_ids))],
+                capture_output=True, text=True)
+            if result.returncode:
+                self.stderr.write(f'{backend}: failed\n{result.stderr[-1000:]}')
+                continue
+            results[backend] = json.loads(result.stdout.strip().splitlines()[-1])
+        if not results:
+            raise CommandError('No backend could be run.')
+
+        reference_name = next(iter(results))
+        reference = results[reference_name]['boxes']
+        reference_faces = sum(len(boxes) for boxes in reference)
+        for backend, result in results.items():
+            found = sum(match_boxes(ref, boxes) for ref, boxes in zip(reference, result['boxes']))
+            faces = sum(len(boxes) for boxes in result['boxes'])
+            self.stdout.write(
+                f"{backend}: load {result['load_seconds'] * 1000:.0f} ms, {result['image_seconds'] * 1000:.1f} ms per "
+                f"image ({1 / result['image_seconds']:.1f} images/s), {result['memory_mb']:.0f} MB resident "
+                f"(+{result['memory_mb'] - result['base_memory_mb']:.0f} MB for the backend), {faces} faces, "
+                f"{found}/{reference_faces} faces of {reference_name} found (IoU >= 0.5)")
+        self.stdout.write(self.style.SUCCESS(f'Compared {len(results)} backends on {len(record_ids)} images.'))
+
+    def run_backend(self, backend, record_ids):
+        """ detects the faces on the records with one backend and prints the timing, memory and boxes as JSON """
+        images = []
+        for record in Record.objects.filter(id__in=record_ids).order_by('id'):
+            # decoded as for the face detection task, the decoding is not measured
+            try:
+                img = load_image(record.media_file.path, settings.FACE_DETECTION_IMAGE_SIZE or None, side='long')[0]
+            except OSError:
+                # skipped by all backends
+                continue
+            images.append(np.asarray(img))
+        base_memory = resident_memory()
+        start = time.perf_counter()
+        detector = create_detector(backend)
+        detector.detect(np.zeros((64, 64, 3), dtype=np.uint8))
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        boxes = [detector.detect(image) for image in images]
+        image_seconds = (time.perf_counter() - start) / max(len(images), 1)
+        self.stdout.write(json.dumps({
+            'load_seconds': load_seconds, 'image_seconds': max(image_seconds, 1e-9), 'base_memory_mb': base_memory,
+            'memory_mb': resident_memory(), 'boxes': boxes,
+        }))
@@ -0,0 +1,52 @@
+"""
+This script measures the latency of the search: it generates a synthetic archive and replays a mix of search and
+autocomplete requests, reporting p50/p95 latency, the number of database queries and the memory usage.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from arch_app.models import User
+from arch_app.modules.search.benchmark import generate_archive, generate_queries, run_benchmark, summarize, \
+    delete_benchmark_data, USER_PREFIX
+
+
+class Command(BaseCommand):
+    help = 'benchmarks the search with a synthetic archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=10000, help='number of generated records')
+        parser.add_argument('--archives', type=int, default=2, help='number of generated archives')
+        parser.add_argument('--users', type=int, default=50, help='number of generated users')
+        parser.add_argument('--no-embeddings', action='store_true', help='do not generate image embeddings')
+        parser.add_argument('--batch-size', type=int, default=5000, help='number of records inserted per batch')
+        parser.add_argument('--reuse', action='store_true', help='reuse the archive of a previous run')
+        parser.add_argument('--clean', action='store_true', help='delete the generated archive afterwards')
+        parser.add_argument('--queries', type=int, default=200, help='number of replayed requests')
+        parser.add_argument('--warmup', type=int, default=10, help='number of requests replayed before measuring')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the generated archive and queries')
+        parser.add_argument('--ranking-mode', choices=['python', 'sql'],
+                            help='ranking mode of the search (default: SEARCH_RANKING_MODE)')
+        parser.add_argument('--prefilter', action='store_true',
+                            help='apply the full-text pre-filter (default: SEARCH_FULL_TEXT_PREFILTER)')
+        parser.add_argument('--trace-memory', action='store_true', help='measure the peak memory of each request')
+
+    def handle(self, *args, **options):
+        if options['reuse']:
+            if not User.objects.filter(username__startswith=USER_PREFIX).exists():
+                raise CommandError('There is no generated archive to reuse.')
+        else:
+            delete_benchmark_data()
+            self.stdout.write(f"Generating {options['records']} records ...")
+            generate_archive(options['records'], num_archives=options['archives'], num_users=options['users'],
+                             embeddings=not options['no_embeddings'], seed=options['seed'],
+                             batch_size=options['batch_size'], log=self.stdout.write)
+        users = list(User.objects.filter(username__startswith=USER_PREFIX).order_by('username'))
+
+        search_options = {'ranking_mode': options['ranking_mode'], 'prefilter': options['prefilter'] or None}
+        run_benchmark(users, generate_queries(options['warmup'], seed=options['seed'] + 1), **search_options)
+        measurements = run_benchmark(users, generate_queries(options['queries'], seed=options['seed']),
+                                     trace_memory=options['trace_memory'], **search_options)
+        for line in summarize(measurements):
+            self.stdout.write(line)
+
+        if options['clean']:
+            delete_benchmark_data()
+        self.stdout.write(self.style.SUCCESS('Successfully ran the search benchmark.'))
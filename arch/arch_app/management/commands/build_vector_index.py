@@ -0,0 +1,74 @@
+"""
+This script copies the stored record embeddings into the vector index (VECTOR_SEARCH_BACKEND='pgvector' or 'mmap').
+"""
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from arch_app.models import RecordEmbedding
+from arch_app.modules.embeddings.model_versions import get_image_model_version
+from arch_app.modules.search import mmap_index
+
+
+class Command(BaseCommand):
+    help = 'copies all record embeddings into the pgvector index or the memory-mapped vector index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of vectors inserted per query')
+
+    def handle(self, *args, **options):
+        if settings.VECTOR_SEARCH_BACKEND not in ('pgvector', 'mmap'):
+            raise CommandError("The vector index is only used if VECTOR_SEARCH_BACKEND is set to 'pgvector' or "
+                               "'mmap'.")
+        self.stdout.write('Start building the vector index ...')
+        if settings.VECTOR_SEARCH_BACKEND == 'mmap':
+            count = self.build_mmap_index(options['batch_size'])
+        else:
+            count = self.build_pgvector_index(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully indexed {count} record embeddings.'))
+
+    @staticmethod
+    def build_pgvector_index(batch_size):
+        from arch_vector.models import RecordVector
+
+        model_version = get_image_model_version()
+        embeddings = RecordEmbedding.objects.filter(model_version=model_version) \
+            .values_list('record_id', 'dtype', 'vector')
+        first = embeddings.first()
+        dimensions = RecordEmbedding.dimensions(first[2], first[1]) if first else settings.IMAGE_EMBEDDING_DIMENSIONS
+        if dimensions != settings.IMAGE_EMBEDDING_DIMENSIONS:
+            raise CommandError(f"The embeddings of {model_version} have {dimensions} dimensions, set "
+                               f"IMAGE_EMBEDDING_DIMENSIONS and migrate the arch_vector app.")
+        RecordVector.objects.all().delete()
+        batch = []
+        count = 0
+        for record_id, dtype, vector in embeddings.iterator(chunk_size=batch_size):
+            batch.append(RecordVector(record_id=record_id, model_version=model_version,
+                                      embedding=np.frombuffer(vector, dtype=dtype).tolist()))
+            if len(batch) >= batch_size:
+                RecordVector.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        RecordVector.objects.bulk_create(batch)
+        count += len(batch)
+        return count
+
+    def build_mmap_index(self, batch_size):
+        """ rewrites the shard of every archive, one archive at a time """
+        index = mmap_index.get_index()
+        count = 0
+        embedded = RecordEmbedding.objects.filter(model_version=get_image_model_version())
+        for archive_id in embedded.values_list('record__album__archive_id', flat=True).distinct():
+            records = embedded.filter(record__album__archive_id=archive_id).values_list('record_id', 'dtype', 'vector')
+            record_ids = []
+            # the width of the embeddings of the image model
+            _, dtype, vector = records.first()
+            embeddings = np.empty((records.count(), RecordEmbedding.dimensions(vector, dtype)), dtype=index.dtype)
+            for record_id, dtype, vector in records.iterator(chunk_size=batch_size):
+                if len(record_ids) == len(embeddings):
+                    break  # records embedded while the shard is built are added by their task
+                embeddings[len(record_ids)] = np.frombuffer(vector, dtype=dtype)
+                record_ids.append(record_id)
+            index.rebuild(archive_id, record_ids, embeddings[:len(record_ids)])
+            self.stdout.write(f'Archive {archive_id}: {len(record_ids)} embeddings')
+            count += len(record_ids)
+        return count
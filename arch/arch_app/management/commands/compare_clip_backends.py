@@ -0,0 +1,80 @@
+"""
+This script compares the ONNX Runtime backend of the CLIP models with the torch models on images of the archive:
+the cosine similarity of the embeddings of both backends, the recall of the search (share of the top k records of
+the torch models which the ONNX models also rank in the top k) and the time per image and per query.
+Run it before switching CLIP_BACKEND to 'onnx' (requires torch, sentence-transformers and onnxruntime).
+"""
+import time
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+from arch_app.models import Record
+from arch_app.modules.embeddings.text_image_embedding import load_clip_models
+
+# search queries used if no queries are given
+DEFAULT_QUERIES = [
+    'people at the beach', 'a group photo', 'children playing', 'a dog', 'a house in the city', 'a car on the street',
+    'a birthday party', 'mountains in winter', 'a handwritten letter', 'Menschen beim Essen',
+]
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-8)
+
+
+class Command(BaseCommand):
+    help = 'compares the accuracy and latency of the ONNX and the torch CLIP models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=200, help='number of random image records')
+        parser.add_argument('--query', action='append', dest='queries', help='search query (can be repeated)')
+        parser.add_argument('--top-k', type=int, default=10, help='number of search results compared per query')
+        parser.add_argument('--fp32-reference', action='store_true',
+                            help='compare with the torch models without quantization')
+
+    def handle(self, *args, **options):
+        queries = options['queries'] or DEFAULT_QUERIES
+        images = []
+        for record in Record.objects.filter(type='Image').order_by('?')[:options['records']]:
+            try:
+                with Image.open(record.media_file.path) as img:
+                    images.append(img.convert('RGB'))
+            except OSError as error:
+                self.stderr.write(f'Skipping record {record.id}: {error}')
+        if not images:
+            raise CommandError('There are no image records to compare.')
+        top_k = min(options['top_k'], len(images))
+
+        backends = {
+            'torch': (False if options['fp32_reference'] else settings.QUANTIZE_CLIP_MODELS),
+            'onnx': settings.QUANTIZE_CLIP_MODELS,
+        }
+        image_embeddings, text_embeddings = {}, {}
+        for backend, quantize in backends.items():
+            image_model, text_model = load_clip_models(backend, quantize)
+            start = time.perf_counter()
+            image_embeddings[backend] = normalize(
+                image_model.encode(images, batch_size=settings.IMAGE_EMBEDDING_BATCH_SIZE, show_progress_bar=False))
+            image_time = (time.perf_counter() - start) / len(images)
+            start = time.perf_counter()
+            # queries are encoded one at a time, as by the search
+            text_embeddings[backend] = normalize([text_model.encode(query) for query in queries])
+            query_time = (time.perf_counter() - start) / len(queries)
+            self.stdout.write(f"{backend}{' (int8)' if quantize else ''}: {image_time * 1000:.1f} ms per image "
+                              f"({1 / image_time:.1f} images/s), {query_time * 1000:.1f} ms per query")
+
+        image_similarity = np.sum(image_embeddings['torch'] * image_embeddings['onnx'], axis=1)
+        text_similarity = np.sum(text_embeddings['torch'] * text_embeddings['onnx'], axis=1)
+        recalls = []
+        for index in range(len(queries)):
+            results = [set(np.argsort(-(image_embeddings[backend] @ text_embeddings[backend][index]))[:top_k])
+                       for backend in ('torch', 'onnx')]
+            recalls.append(len(results[0] & results[1]) / top_k)
+        self.stdout.write(f'Image embeddings: cosine similarity mean {image_similarity.mean():.4f}, '
+                          f'min {image_similarity.min():.4f} ({len(images)} images)')
+        self.stdout.write(f'Text embeddings: cosine similarity mean {text_similarity.mean():.4f}, '
+                          f'min {text_similarity.min():.4f} ({len(queries)} queries)')
+        self.stdout.write(self.style.SUCCESS(f'Recall@{top_k} of the ONNX models: {np.mean(recalls):.3f} '
+                                             f'(min {np.min(recalls):.3f})'))
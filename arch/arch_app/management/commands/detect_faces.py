@@ -0,0 +1,126 @@
+"""
+This script detects the faces on all image records which were not processed by the face detection yet, e.g. the
+images uploaded before ACTIVATE_FACE_DETECTION was set, and creates their TagBoxes. Records which already have
+TagBoxes are skipped, face regions stored in the XMP metadata of an image are imported instead of detecting its faces
+(unless FORCE_FACE_DETECTION is set). The images are decoded in a thread pool while the detector (loaded once)
+processes the previous batch, the TagBoxes of a batch are inserted at once. Processed records are marked
+(Record.faces_detected), so an interrupted run continues with the remaining records when it is restarted.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from arch_app.models import Record, TagBox
+from arch_app.modules.computer_vision.image_loading import remove_overlapping_boxes
+from arch_app.modules.metadata_extraction.face_regions import extract_face_regions
+
+import logging
+file_logger = logging.getLogger('ARCH_file_logger')
+
+
+class Command(BaseCommand):
+    help = 'detects the faces on all image records which were not processed by the face detection yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=32, help='number of records processed and saved at once')
+        parser.add_argument('--workers', type=int, default=settings.IMAGE_DECODE_WORKERS,
+                            help='number of threads decoding the images')
+        parser.add_argument('--limit', type=int, default=None, help='maximum number of records processed in this run')
+
+    def handle(self, *args, **options):
+        if not settings.ACTIVATE_FACE_DETECTION:
+            raise CommandError('The face detection is only used if ACTIVATE_FACE_DETECTION is set.')
+        from arch_app.modules.computer_vision import face_detection
+
+        pending = Record.objects.filter(type='Image', faces_detected__isnull=True).exclude(
+            Exists(TagBox.objects.filter(record=OuterRef('pk'))))
+        total = pending.count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+        self.stdout.write(f'Start detecting faces on {total} images ({settings.FACE_DETECTOR}) ...')
+        # the detector is loaded once and used for all images
+        face_detection.warm_up()
+
+        start = time.monotonic()
+        processed, failed, faces = 0, 0, 0
+        batches = self.record_batches(pending, options['batch_size'], total)
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            batch = next(batches, None)
+            decoding = executor.map(self.decode, batch) if batch else None
+            while batch:
+                # decode the next batch while the faces of this batch are detected
+                next_batch = next(batches, None)
+                next_decoding = executor.map(self.decode, next_batch) if next_batch else None
+                tagboxes, detected = [], []
+                for record, image in zip(batch, decoding):
+                    boxes = self.detect(face_detection, record, image)
+                    if boxes is None:
+                        failed += 1
+                        continue
+                    width, height = image[1]
+                    tagboxes.extend(TagBox(record_id=record.id, x1=x1, y1=y1, x2=x2, y2=y2, height=height, width=width)
+                                    for x1, y1, x2, y2 in boxes)
+                    detected.append(record.id)
+                with transaction.atomic():
+                    TagBox.objects.bulk_insert(tagboxes)
+                    Record.objects.filter(id__in=detected).update(faces_detected=timezone.now())
+                processed += len(batch)
+                faces += len(tagboxes)
+                elapsed = time.monotonic() - start
+                self.stdout.write(f'{processed} / {total} images, {faces} faces, {failed} failed '
+                                  f'({processed / max(elapsed, 1e-6):.1f} images/s)')
+                batch, decoding = next_batch, next_decoding
+        self.stdout.write(self.style.SUCCESS(f'Detected {faces} faces on {processed - failed} images, '
+                                             f'{failed} images failed.'))
+
+    @staticmethod
+    def record_batches(pending, batch_size, total):
+        """ yields the pending records in batches ordered by id, records which failed are not returned again """
+        last_id, count = None, 0
+        while count < total:
+            batch = pending.order_by('id').only('id', 'media_file')
+            if last_id is not None:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:min(batch_size, total - count)])
+            if not batch:
+                return
+            count += len(batch)
+            last_id = batch[-1].id
+            yield batch
+
+    @staticmethod
+    def decode(record):
+        """
+        returns tuple (image of a record decoded for the face detection or None if it is not needed, original size
+        of the image, face regions of its metadata), None on errors
+        """
+        from arch_app.modules.computer_vision.face_detection import load_face_detection_image
+        try:
+            with open(record.media_file.path, 'rb') as file:
+                size, regions = extract_face_regions(file.read())
+            if regions and not settings.FORCE_FACE_DETECTION:
+                return None, size, regions
+            return (*load_face_detection_image(record.media_file.path), regions)
+        except (OSError, ValueError) as error:
+            file_logger.error(f'Error while decoding record {record.id} ({record.media_file.name}): {error}')
+            return None
+
+    @staticmethod
+    def detect(face_detection, record, image):
+        """ returns the face boxes of a decoded image and its face regions, None if the detection failed """
+        if image is None:
+            return None
+        img, original_size, regions = image
+        if img is None:
+            return regions
+        try:
+            faces = face_detection.detect_faces_on_image(img, original_size)
+            return regions + remove_overlapping_boxes(faces, regions)
+        except Exception as error:
+            file_logger.error(f'Error while detecting faces on record {record.id} ({record.media_file.name}): {error}')
+            return None
+        finally:
+            img.close()
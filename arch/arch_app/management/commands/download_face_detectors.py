@@ -0,0 +1,28 @@
+"""
+This script downloads the weights of the OpenCV face detection backends (FACE_DETECTOR='ssd' or 'yunet') into the
+model directory and verifies their SHA-256 checksums (FACE_DETECTOR_WEIGHTS_SHA256).
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from arch_app.modules.computer_vision.face_detectors import WEIGHTS, download_weights
+
+
+class Command(BaseCommand):
+    help = 'downloads and verifies the weights of the OpenCV face detection backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', choices=list(WEIGHTS),
+                            help='backend to download the weights of (can be repeated, default FACE_DETECTOR)')
+
+    def handle(self, *args, **options):
+        backends = options['backend'] or [settings.FACE_DETECTOR]
+        for backend in backends:
+            if backend not in WEIGHTS:
+                raise CommandError(f"The {backend} face detector does not need any weights to be downloaded.")
+            self.stdout.write(f'Downloading the weights of the {backend} face detector ...')
+            try:
+                for path in download_weights(backend):
+                    self.stdout.write(path)
+            except ValueError as error:
+                raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f'The weights of {", ".join(backends)} are downloaded and verified.'))
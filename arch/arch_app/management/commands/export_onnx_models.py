@@ -0,0 +1,23 @@
+"""
+This script exports the CLIP models to ONNX files for the ONNX Runtime backend (CLIP_BACKEND='onnx') and creates
+int8 quantized copies (requires torch, sentence-transformers and onnxruntime).
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from arch_app.modules.embeddings.onnx_models import export_onnx_models
+
+
+class Command(BaseCommand):
+    help = 'exports the CLIP models to ONNX files and quantizes them to int8'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-quantize', action='store_true', help='do not create the int8 quantized models')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Start exporting the CLIP models ...')
+        files = export_onnx_models(quantize=not options['no_quantize'])
+        for path in files:
+            self.stdout.write(path)
+        if settings.CLIP_BACKEND != 'onnx':
+            self.stdout.write("Set CLIP_BACKEND to 'onnx' to use the exported models.")
+        self.stdout.write(self.style.SUCCESS(f'Successfully exported {len(files)} ONNX models.'))
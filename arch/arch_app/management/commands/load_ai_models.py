@@ -1,10 +1,10 @@
 """
 This script loads the AI models and stores them locally in the project folder.
 """
-import os
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from sentence_transformers import SentenceTransformer
+from arch_app.modules.embeddings.model_versions import get_model_path
 
 
 class Command(BaseCommand):
@@ -12,8 +12,6 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         print("load AI models ...")
-        img_model_path = os.path.join(settings.BASE_DIR, 'arch_app/ai_models/clip-ViT-B-32')
-        text_model_path = os.path.join(settings.BASE_DIR, 'arch_app/ai_models/clip-ViT-B-32-multilingual-v1')
-        SentenceTransformer('clip-ViT-B-32').save(img_model_path)
-        SentenceTransformer('sentence-transformers/clip-ViT-B-32-multilingual-v1').save(text_model_path)
+        SentenceTransformer(settings.IMAGE_EMBEDDING_MODEL).save(get_model_path(settings.IMAGE_EMBEDDING_MODEL))
+        SentenceTransformer(settings.TEXT_EMBEDDING_MODEL).save(get_model_path(settings.TEXT_EMBEDDING_MODEL))
         self.stdout.write(self.style.SUCCESS('Successfully saved AI models locally.'))
@@ -0,0 +1,80 @@
+"""
+This script measures the startup time of a new process, as paid by every gunicorn worker and qcluster worker on
+(re)start: django.setup() and the import of the URL configuration (all views) and of the tasks. The modules are
+imported in a new Python process with -X importtime, the import time is reported per package and for the slowest
+modules of the app.
+"""
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# imports measured in the new process (after django.setup())
+DEFAULT_MODULES = [settings.ROOT_URLCONF, 'arch_app.tasks']
+
+STARTUP_SCRIPT = """
+import importlib, os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', {settings_module!r})
+start = time.perf_counter()
+import django
+django.setup()
+print('django.setup', time.perf_counter() - start)
+for module in {modules!r}:
+    start = time.perf_counter()
+    importlib.import_module(module)
+    print(module, time.perf_counter() - start)
+"""
+
+
+def parse_importtime(output):
+    """
+    Parses the output of python -X importtime.
+    returns list of tuples (module, self time, cumulative time) in seconds
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(self_time) / 1e6, int(cumulative) / 1e6))
+    return imports
+
+
+class Command(BaseCommand):
+    help = 'reports the startup time of a new process and the import time per package'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', action='append', dest='modules',
+                            help=f"module imported after django.setup() (can be repeated, default: "
+                                 f"{', '.join(DEFAULT_MODULES)})")
+        parser.add_argument('--top', type=int, default=15, help='number of packages and modules listed')
+
+    def handle(self, *args, **options):
+        script = STARTUP_SCRIPT.format(settings_module=os.environ.get('DJANGO_SETTINGS_MODULE', 'arch.settings'),
+                                       modules=options['modules'] or DEFAULT_MODULES)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR)
+        if result.returncode:
+            raise CommandError(f'The startup failed:\n{result.stderr[-2000:]}')
+        imports = parse_importtime(result.stderr)
+
+        total = 0
+        for line in result.stdout.splitlines():
+            step, seconds = line.rsplit(' ', 1)
+            total += float(seconds)
+            self.stdout.write(f'{step}: {float(seconds) * 1000:.0f} ms')
+        self.stdout.write(self.style.SUCCESS(f'Startup: {total * 1000:.0f} ms ({len(imports)} modules imported)'))
+
+        packages = defaultdict(float)
+        for module, self_time, cumulative in imports:
+            packages[module.split('.')[0]] += self_time
+        self.stdout.write("\nImport time per package:")
+        for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f'{seconds * 1000:8.1f} ms  {package}')
+
+        self.stdout.write("\nSlowest modules of the app (including their imports):")
+        app_modules = sorted((item for item in imports if item[0].startswith('arch_app')), key=lambda item: -item[2])
+        for module, self_time, cumulative in app_modules[:options['top']]:
+            self.stdout.write(f'{cumulative * 1000:8.1f} ms  {module}')
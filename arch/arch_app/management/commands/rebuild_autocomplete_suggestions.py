@@ -0,0 +1,18 @@
+"""
+This script recomputes the suggestions of the autocomplete of the search bar (AutocompleteSuggestion) from the
+records, e.g. after upgrading an existing database.
+"""
+from django.core.management.base import BaseCommand
+from arch_app.models import AutocompleteSuggestion
+
+
+class Command(BaseCommand):
+    help = 'recomputes the autocomplete suggestions of all records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of records updated at once')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Start rebuilding the autocomplete suggestions ...')
+        count = AutocompleteSuggestion.objects.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt the autocomplete suggestions ({count} entries).'))
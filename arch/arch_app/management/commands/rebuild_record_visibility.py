@@ -0,0 +1,16 @@
+"""
+This script recomputes the record visibility table (RecordVisibility) from the guardian 'view_record' permissions,
+e.g. after upgrading an existing database or after changing permissions outside of ARCH.
+"""
+from django.core.management.base import BaseCommand
+from arch_app.models import RecordVisibility
+
+
+class Command(BaseCommand):
+    help = 'recomputes which users are permitted to view which records'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Start rebuilding the record visibility ...')
+        RecordVisibility.objects.refresh()
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully rebuilt the record visibility ({RecordVisibility.objects.count()} entries).'))
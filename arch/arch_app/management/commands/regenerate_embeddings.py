@@ -1,24 +1,80 @@
-import os
-from django.core.management.base import BaseCommand
-from arch_app.models import Record
-from arch_app.modules.embeddings.text_image_embedding import generate_image_embedding
+"""
+This script generates the image embeddings of all image records which have no embedding of the current image model
+(RecordEmbedding.model_version), e.g. after switching to another CLIP model or enabling the quantization.
+Records are embedded in batches, so an interrupted run continues with the remaining records when it is restarted.
+"""
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
+from arch_app.models import Record, RecordEmbedding
+from arch_app.modules.embeddings.model_versions import get_image_model_version
+from arch_app.modules.search.vector_index import save_record_embeddings
+
+import logging
+file_logger = logging.getLogger('ARCH_file_logger')
 
 
 class Command(BaseCommand):
-    help = 'regenerate embeddings for all records'
+    help = 'generates the missing or stale image embeddings of all image records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=64,
+                            help='number of records embedded and saved at once')
+        parser.add_argument('--limit', type=int, default=None, help='maximum number of records embedded in this run')
+        parser.add_argument('--delete-stale', action='store_true',
+                            help='delete the embeddings of other model versions when all records are embedded')
 
     def handle(self, *args, **options):
-        print("start regenerating image embeddings ...")
-
-        count = 0
-        records = Record.objects.filter(type='Image')
-        for r in records:
-            img_emb = generate_image_embedding(r.media_file.path)
-            if img_emb is False:
-                return False
-            r.embedding = img_emb.tolist()
-            r.save()
-            count += 1
-
-        print("finished regenerating image embeddings.")
-        print(f"Regenerated {count} image embeddings.")
+        if not settings.ACTIVATE_AI_SEARCH:
+            raise CommandError('The image embeddings are only used if ACTIVATE_AI_SEARCH is set.')
+        model_version = get_image_model_version()
+        pending = Record.objects.filter(type='Image').exclude(
+            Exists(RecordEmbedding.objects.filter(record=OuterRef('pk'), model_version=model_version)))
+        total = pending.count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+        self.stdout.write(f'Start generating {total} image embeddings ({model_version}) ...')
+
+        start = time.monotonic()
+        embedded, failed = 0, 0
+        last_id = None
+        while embedded + failed < total:
+            batch = pending.order_by('id')
+            if last_id is not None:
+                # records which failed in this run are not tried again
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:min(options['batch_size'], total - embedded - failed)])
+            if not batch:
+                break
+            embeddings = {}
+            for record, embedding in zip(batch, self.embed_images(batch)):
+                if embedding is False:
+                    failed += 1
+                    file_logger.error(f'Error while embedding record {record.id} ({record.media_file.name})')
+                else:
+                    embeddings[record.id] = embedding
+            save_record_embeddings(embeddings)
+            embedded += len(embeddings)
+            last_id = batch[-1].id
+            elapsed = time.monotonic() - start
+            self.stdout.write(f'{embedded + failed} / {total} records, {failed} failed '
+                              f'({(embedded + failed) / max(elapsed, 1e-6):.1f} images/s)')
+
+        if options['delete_stale']:
+            if pending.exists():
+                self.stdout.write('Stale embeddings are kept until all records are embedded.')
+            else:
+                count, _ = RecordEmbedding.objects.exclude(model_version=model_version).delete()
+                self.stdout.write(f'Deleted {count} stale embeddings.')
+        if settings.VECTOR_SEARCH_BACKEND in ('pgvector', 'mmap') and \
+                RecordEmbedding.objects.exclude(model_version=model_version).exists():
+            self.stdout.write('Rebuild the vector index (build_vector_index) to remove the embeddings of other '
+                              'model versions.')
+        self.stdout.write(self.style.SUCCESS(f'Generated {embedded} image embeddings, {failed} records failed.'))
+
+    @staticmethod
+    def embed_images(records):
+        """ returns the embeddings of the images of records, False for files which could not be embedded """
+        from arch_app.modules.embeddings.text_image_embedding import generate_image_embeddings
+        return generate_image_embeddings([record.media_file.path for record in records])
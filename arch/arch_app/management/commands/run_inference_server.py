@@ -0,0 +1,48 @@
+"""
+This script starts the local inference server, which hosts the AI models of the activated features (AI search, face
+detection) for all web and qcluster processes of the host (see modules/inference/server.py).
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from arch_app.modules.inference.server import InferenceServer
+
+
+def feature_not_activated(feature):
+    def batch_function(items):
+        raise ValueError(f'{feature} is not activated on the inference server')
+    return batch_function
+
+
+class Command(BaseCommand):
+    help = 'starts the inference server hosting the AI models on the socket settings.INFERENCE_SOCKET'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.IMAGE_EMBEDDING_BATCH_SIZE,
+                            help='maximum number of texts or images combined into one batch')
+
+    def handle(self, *args, **options):
+        if not settings.INFERENCE_SOCKET:
+            raise CommandError('Set INFERENCE_SOCKET to the path of the socket of the inference server.')
+        embed_texts = embed_images = feature_not_activated('AI search')
+        detect_faces = feature_not_activated('Face detection')
+        if settings.ACTIVATE_AI_SEARCH:
+            from arch_app.modules.embeddings import text_image_embedding
+            text_image_embedding.init_ai_models()
+            embed_texts = text_image_embedding.encode_texts
+            embed_images = text_image_embedding.embed_images
+        if settings.ACTIVATE_FACE_DETECTION:
+            from arch_app.modules.computer_vision import face_detection
+            face_detection.warm_up()
+
+            def detect_faces(image_paths):
+                return [face_detection.detect_faces_locally(image_path) for image_path in image_paths]
+
+        server = InferenceServer(settings.INFERENCE_SOCKET, embed_texts, embed_images, detect_faces,
+                                 max_batch_size=options['batch_size'], max_wait=settings.INFERENCE_BATCH_WAIT / 1000)
+        self.stdout.write(self.style.SUCCESS(f'Inference server listening on {settings.INFERENCE_SOCKET}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,26 @@
+"""
+This script computes the full-text search vectors of all records, e.g. after upgrading an existing database.
+"""
+from django.core.management.base import BaseCommand
+from arch_app.models import Record
+from arch_app.modules.search.full_text import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'updates the full-text search vectors of all records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='number of records updated per query')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Start updating the search vectors ...')
+        count = 0
+        record_ids = Record.objects.order_by('pk').values_list('pk', flat=True)
+        batch = []
+        for record_id in record_ids.iterator(chunk_size=options['batch_size']):
+            batch.append(record_id)
+            if len(batch) >= options['batch_size']:
+                count += update_search_vectors(Record.objects.filter(pk__in=batch))
+                batch = []
+        count += update_search_vectors(Record.objects.filter(pk__in=batch))
+        self.stdout.write(self.style.SUCCESS(f'Successfully updated the search vectors of {count} records.'))
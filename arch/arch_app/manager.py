@@ -1,5 +1,12 @@
+import datetime
 import os
-from django.db import models
+import unicodedata
+import uuid
+from collections import defaultdict
+from django.db import models, transaction
+from django.db.models import Q, Case, When, Value, Count, Exists, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from django.contrib.contenttypes.models import ContentType
 from django.http import HttpRequest
 from django.core.files.base import ContentFile
 
@@ -33,6 +40,315 @@ class RecordManager(models.Manager):
         return record
 
 
+class RecordVisibilityManager(models.Manager):
+    """
+    Manager for the RecordVisibility model, a projection of the guardian 'view_record' permissions
+    (granted to users directly or through their groups) to (user, record) rows.
+    """
+
+    def filter_records(self, user, queryset):
+        """
+        Filters a Record QuerySet by the 'view_record' permission of a user (equivalent to get_objects_for_user).
+        params:
+            user: the user
+            queryset: QuerySet of records
+        """
+        if user.is_superuser or user.has_perm(f'{queryset.model._meta.app_label}.view_record'):
+            return queryset
+        if not user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(pk__in=self.filter(user=user).values('record_id'))
+
+    def group_record_ids(self, group_ids):
+        """ returns the ids of the records the given groups have the 'view_record' permission for """
+        from guardian.models import GroupObjectPermission
+        record_model = self.model._meta.get_field('record').related_model
+        return list(GroupObjectPermission.objects.filter(group_id__in=group_ids,
+                                                         permission__codename='view_record',
+                                                         content_type=ContentType.objects.get_for_model(record_model))
+                    .values_list('object_pk', flat=True).distinct())
+
+    def refresh(self, user_ids=None, record_ids=None):
+        """
+        Recomputes the visibility rows of the given users and records from the guardian permissions.
+        params:
+            user_ids: ids of the users to update, None for all users
+            record_ids: ids of the records to update, None for all records
+        """
+        from guardian.models import UserObjectPermission, GroupObjectPermission
+        record_model = self.model._meta.get_field('record').related_model
+        user_model = self.model._meta.get_field('user').related_model
+        content_type = ContentType.objects.get_for_model(record_model)
+        user_permissions = UserObjectPermission.objects.filter(permission__codename='view_record',
+                                                               content_type=content_type)
+        group_permissions = GroupObjectPermission.objects.filter(permission__codename='view_record',
+                                                                 content_type=content_type)
+        group_members = user_model.groups.through.objects.all()
+        rows = self.all()
+        if user_ids is not None:
+            user_permissions = user_permissions.filter(user_id__in=user_ids)
+            group_members = group_members.filter(user_id__in=user_ids)
+            rows = rows.filter(user_id__in=user_ids)
+        if record_ids is not None:
+            record_ids = [str(record_id) for record_id in record_ids]
+            user_permissions = user_permissions.filter(object_pk__in=record_ids)
+            group_permissions = group_permissions.filter(object_pk__in=record_ids)
+            rows = rows.filter(record_id__in=record_ids)
+
+        # (user, record) pairs permitted directly or through a group
+        permitted = set(user_permissions.values_list('user_id', 'object_pk'))
+        group_records = defaultdict(list)
+        for group_id, object_pk in group_permissions.values_list('group_id', 'object_pk'):
+            group_records[group_id].append(object_pk)
+        for user_id, group_id in group_members.filter(group_id__in=group_records).values_list('user_id', 'group_id'):
+            permitted.update((user_id, object_pk) for object_pk in group_records[group_id])
+        permitted = {(user_id, uuid.UUID(object_pk)) for user_id, object_pk in permitted}
+        # guardian keeps the permissions of deleted records
+        existing_records = set(record_model.objects.filter(pk__in={record_id for _, record_id in permitted})
+                               .values_list('pk', flat=True))
+        permitted = {pair for pair in permitted if pair[1] in existing_records}
+
+        with transaction.atomic():
+            current = set(rows.values_list('user_id', 'record_id'))
+            revoked = defaultdict(list)
+            for user_id, record_id in current - permitted:
+                revoked[user_id].append(record_id)
+            for user_id, revoked_record_ids in revoked.items():
+                self.filter(user_id=user_id, record_id__in=revoked_record_ids).delete()
+            self.bulk_create([self.model(user_id=user_id, record_id=record_id)
+                              for user_id, record_id in permitted - current],
+                             batch_size=1000, ignore_conflicts=True)
+
+
+class AutocompleteSuggestionManager(models.Manager):
+    """
+    Manager for the AutocompleteSuggestion model: the distinct texts (titles and captions), location names and
+    names of depicted users of the records of an archive, weighted by the number of records containing them.
+    The suggestions are linked to their records (AutocompleteSource), so that they are filtered by permissions.
+    """
+
+    @staticmethod
+    def normalize(text):
+        """ returns a text in lower case, without accents and with single spaces (the form suggestions are matched) """
+        text = unicodedata.normalize('NFKD', text)
+        return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).lower().split())
+
+    @staticmethod
+    def truncate(text, max_length=70):
+        """ truncates a text to the given length (as displayed by the autocomplete of the search bar) """
+        return text[:max_length] + ('...' if len(text) > max_length else '')
+
+    def suggestion_key(self, archive_id, kind, text, user_id=None):
+        """
+        Returns the key of the suggestion of a text (archive id, kind, display text, normalized text, user id):
+        the truncated text is displayed, the terms are matched against the normalized full text (up to the length
+        of the normalized_text field).
+        """
+        max_length = self.model._meta.get_field('normalized_text').max_length
+        return archive_id, kind, self.truncate(text), self.normalize(text)[:max_length], user_id
+
+    def record_suggestions(self, record_ids):
+        """
+        Computes the suggestions of records.
+        params:
+            record_ids: ids of the records
+        returns: dict of record id to a set of suggestion keys (see suggestion_key)
+        """
+        source_model = self.model._meta.get_field('sources').related_model
+        record_model = source_model._meta.get_field('record').related_model
+        user_model = self.model._meta.get_field('user').related_model
+        suggestions = defaultdict(set)
+        records = record_model.objects.filter(pk__in=record_ids).values_list(
+            'pk', 'album__archive_id', 'depicted_users_id', 'title', 'user_caption',
+            'location__name', 'location__country', 'location__state', 'location__region')
+        record_groups = {}
+        for record_id, archive_id, group_id, title, caption, *location_names in records:
+            suggestions[record_id].update(self.suggestion_key(archive_id, 'text', text)
+                                          for text in [title, caption] if text and text.strip())
+            suggestions[record_id].update(self.suggestion_key(archive_id, 'location', name)
+                                          for name in location_names if name and name.strip())
+            if group_id:
+                record_groups[group_id] = (record_id, archive_id)
+        depicted_users = user_model.groups.through.objects.filter(group_id__in=record_groups).values_list(
+            'group_id', 'user_id', 'user__username', 'user__first_name', 'user__last_name')
+        for group_id, user_id, *names in depicted_users:
+            record_id, archive_id = record_groups[group_id]
+            suggestions[record_id].update(self.suggestion_key(archive_id, 'person', name, user_id)
+                                          for name in names if name and name.strip())
+        return suggestions
+
+    def update_records(self, record_ids):
+        """
+        Updates the suggestions of records after they were created or changed, or before they are deleted.
+        params:
+            record_ids: ids of the records
+        """
+        source_model = self.model._meta.get_field('sources').related_model
+        record_ids = list(record_ids)
+        desired = {(record_id, key) for record_id, keys in self.record_suggestions(record_ids).items()
+                   for key in keys}
+        with transaction.atomic():
+            current = {}
+            for source_id, record_id, suggestion_id, *key in source_model.objects.filter(
+                    record_id__in=record_ids).values_list('pk', 'record_id', 'suggestion_id',
+                                                          'suggestion__archive_id', 'suggestion__kind',
+                                                          'suggestion__display_text', 'suggestion__normalized_text',
+                                                          'suggestion__user_id'):
+                current[(record_id, tuple(key))] = (source_id, suggestion_id)
+            removed = [current[pair] for pair in current.keys() - desired]
+            added = desired - current.keys()
+            if not removed and not added:
+                return
+            changed = {suggestion_id for _, suggestion_id in removed}
+            source_model.objects.filter(pk__in=[source_id for source_id, _ in removed]).delete()
+            if added:
+                keys = {key for _, key in added}
+                self.bulk_create([self.model(archive_id=archive_id, kind=kind, display_text=display_text,
+                                             normalized_text=normalized_text, user_id=user_id)
+                                  for archive_id, kind, display_text, normalized_text, user_id in keys],
+                                 batch_size=1000, ignore_conflicts=True)
+                suggestion_ids = {}
+                for suggestion_id, *key in self.filter(display_text__in={key[2] for key in keys}).values_list(
+                        'pk', 'archive_id', 'kind', 'display_text', 'normalized_text', 'user_id'):
+                    suggestion_ids[tuple(key)] = suggestion_id
+                source_model.objects.bulk_create([source_model(suggestion_id=suggestion_ids[key], record_id=record_id)
+                                                  for record_id, key in added],
+                                                 batch_size=1000, ignore_conflicts=True)
+                changed.update(suggestion_ids[key] for key in keys)
+            self.update_weights(changed)
+
+    def remove_records(self, record_ids):
+        """ removes records from their suggestions (e.g. before the records are deleted) """
+        source_model = self.model._meta.get_field('sources').related_model
+        with transaction.atomic():
+            sources = source_model.objects.filter(record_id__in=list(record_ids))
+            changed = set(sources.values_list('suggestion_id', flat=True))
+            sources.delete()
+            self.update_weights(changed)
+
+    def update_weights(self, suggestion_ids=None):
+        """
+        Sets the weight of suggestions to the number of their records and deletes suggestions without records.
+        params:
+            suggestion_ids: ids of the suggestions to update, None for all suggestions
+        """
+        source_model = self.model._meta.get_field('sources').related_model
+        suggestions = self.all() if suggestion_ids is None else self.filter(pk__in=suggestion_ids)
+        counts = source_model.objects.filter(suggestion=OuterRef('pk')).values('suggestion') \
+            .annotate(count=Count('pk')).values('count')
+        suggestions.update(weight=Coalesce(Subquery(counts, output_field=IntegerField()), 0))
+        suggestions.filter(weight=0).delete()
+
+    def rebuild(self, batch_size=1000):
+        """ recomputes the suggestions of all records, returns the number of suggestions """
+        source_model = self.model._meta.get_field('sources').related_model
+        record_model = source_model._meta.get_field('record').related_model
+        record_ids = list(record_model.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(record_ids), batch_size):
+            self.update_records(record_ids[start:start + batch_size])
+        # suggestions of records which were deleted without the signal handlers (e.g. by a raw query)
+        self.update_weights()
+        return self.count()
+
+    def suggest(self, user, kind, term, limit=10):
+        """
+        Returns the display texts of the suggestions of a kind matching a term, which occur in records the user is
+        permitted to view. Prefixes of the suggestions are ranked first, then the suggestions in the most records.
+        Terms of at least 3 characters also match inside of suggestions and, if there are less than limit matches,
+        similar words (trigram word similarity, e.g. for typos).
+        params:
+            user: the user
+            kind: 'text', 'location' or 'person'
+            term: the term entered by the user
+            limit: maximum number of suggestions
+        """
+        term = self.normalize(term)
+        if not term or not user.is_authenticated:
+            return []
+        source_model = self.model._meta.get_field('sources').related_model
+        user_model = self.model._meta.get_field('user').related_model
+        suggestions = self.filter(kind=kind)
+        if not (user.is_superuser or user.has_perm(f'{source_model._meta.app_label}.view_record')):
+            visibility_model = source_model._meta.get_field('record').related_model \
+                ._meta.get_field('visibility').related_model
+            visible_records = visibility_model.objects.filter(user=user).values('record_id')
+            suggestions = suggestions.filter(Exists(source_model.objects.filter(suggestion=OuterRef('pk'),
+                                                                                record_id__in=visible_records)))
+        if kind == 'person':
+            # only active members of the archives of the user are suggested
+            membership_model = user_model.archives.through
+            suggestions = suggestions.filter(user__in=membership_model.objects.filter(
+                Q(end_date__isnull=True) | Q(end_date__gte=datetime.date.today()),
+                archive__in=membership_model.objects.filter(user=user).values('archive_id')
+            ).values('user_id'))
+        if len(term) < 3:
+            # the trigram index does not support shorter terms
+            matches = suggestions.filter(normalized_text__startswith=term)
+        else:
+            matches = suggestions.filter(normalized_text__contains=term)
+        matches = matches.annotate(
+            prefix=Case(When(normalized_text__startswith=term, then=Value(1)), default=Value(0))
+        ).order_by('-prefix', '-weight', 'display_text')
+        # the same text may be suggested in several archives
+        results = list(dict.fromkeys(matches.values_list('display_text', flat=True)[:limit * 2]))[:limit]
+        if len(results) < limit and len(term) >= 3:
+            similar = suggestions.filter(normalized_text__trigram_word_similar=term) \
+                .exclude(normalized_text__contains=term).order_by('-weight', 'display_text')
+            results = list(dict.fromkeys(results + list(similar.values_list('display_text', flat=True)[:limit * 2])))
+        return results[:limit]
+
+
+class TagBoxManager(models.Manager):
+    """
+    Manager for the TagBox model (multi-table inheritance of Tag)
+    """
+
+    def bulk_insert(self, tagboxes, batch_size=500):
+        """
+        Inserts many TagBox objects with a few queries: the Tag rows with bulk_create, then the TagBox rows.
+        No signals are sent, the depicted users of the records are not updated (the boxes should have no user,
+        see create_for_record).
+        params:
+            tagboxes: unsaved TagBox objects
+            batch_size: number of rows per INSERT query
+        """
+        tag_model = self.model._meta.get_field('tag_ptr').related_model
+        with transaction.atomic(using=self.db):
+            tags = tag_model.objects.using(self.db).bulk_create(
+                [tag_model(record_id=tagbox.record_id, user_id=tagbox.user_id, visible=tagbox.visible)
+                 for tagbox in tagboxes], batch_size=batch_size)
+            for tagbox, tag in zip(tagboxes, tags):
+                tagbox.id = tagbox.tag_ptr_id = tag.pk
+            # bulk_create does not support multi-table inheritance, the child rows are inserted as by Model.save
+            for start in range(0, len(tagboxes), batch_size):
+                self._insert(tagboxes[start:start + batch_size], fields=self.model._meta.local_concrete_fields,
+                             using=self.db)
+        for tagbox in tagboxes:
+            tagbox._state.adding = False
+            tagbox._state.db = self.db
+        return tagboxes
+
+    def create_for_record(self, record, tagboxes):
+        """
+        Creates the TagBoxes of a record in one transaction, e.g. all faces detected on an image. Instead of the
+        signal handlers (update_user_on_save), which save the record once per box, the visible tagged users are
+        added to the depicted users at once and the record is saved once.
+        params:
+            record: the record
+            tagboxes: unsaved TagBox objects, the record is set
+        """
+        with transaction.atomic(using=self.db):
+            for tagbox in tagboxes:
+                tagbox.record = record
+            self.bulk_insert(tagboxes)
+            user_ids = {tagbox.user_id for tagbox in tagboxes if tagbox.user_id and tagbox.visible == 'visible'}
+            if user_ids:
+                record.depicted_users.user_set.add(*user_ids)
+                # updates the autocomplete suggestions of the depicted users
+                record.save(update_fields=['depicted_users'])
+        return tagboxes
+
+
 # adapted from https://github.com/jose-lpa/django-tracking-analyzer
 class TrackerManager(models.Manager):
     """
@@ -1,4 +1,9 @@
+import json
 import os
+import sys
+import secrets
+
+import numpy as np
 
 from django.conf import global_settings
 from django.conf import settings
@@ -7,21 +12,62 @@ import datetime
 
 from django.core.exceptions import ObjectDoesNotExist
 # from django.utils import timezone
-from django.db import models
+from django.db import models, connections, transaction
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import Group
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models.functions import Upper
 from guardian.shortcuts import assign_perm, remove_perm
-from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, pre_migrate, \
+    post_migrate, m2m_changed
 from django.dispatch import receiver
 from django.utils.translation import gettext as _
 from .file_validators import FileValidator
-from .manager import TrackerManager, RecordManager
+from .manager import TrackerManager, RecordManager, RecordVisibilityManager, AutocompleteSuggestionManager, \
+    TagBoxManager
+from .modules.search.full_text import record_search_vector, update_search_vectors
+from .modules.computer_vision.preview_rendering import delete_previews
 
 
 # from django.core.mail import send_mail
 
+
+@receiver(pre_migrate)
+def create_database_extensions(sender, app_config, using, **kwargs):
+    """ Installs the PostgreSQL extensions used by the search module before the ARCH models are migrated """
+    if app_config.label != 'arch_app':
+        return
+    extensions = ['pg_trgm']
+    if settings.VECTOR_SEARCH_BACKEND == 'pgvector':
+        extensions.append('vector')
+    with connections[using].cursor() as cursor:
+        for extension in extensions:
+            cursor.execute(f"CREATE EXTENSION IF NOT EXISTS {extension}")
+
+
+@receiver(post_migrate)
+def schedule_periodic_tasks(sender, app_config, using, **kwargs):
+    """ Registers the periodic Django Q tasks of ARCH (executed by the qcluster) """
+    if app_config.label != 'arch_app':
+        return
+    from django_q.models import Schedule
+    Schedule.objects.using(using).get_or_create(func='arch_app.tasks.clear_expired_result_sets',
+                                                defaults={'name': 'Clear expired result sets',
+                                                          'schedule_type': Schedule.HOURLY})
+
+
+def trigram_index(field_name, name):
+    """
+    Returns a GIN trigram index on the upper case value of a field. The index is used by icontains lookups,
+    which compare UPPER(field), and by the trigram operators on Upper(field_name).
+    """
+    return GinIndex(OpClass(Upper(field_name), name='gin_trgm_ops'), name=name)
+
+
 #######################
 ###  Basic Models  ###
 
@@ -37,6 +83,12 @@ class Location(models.Model):
 
     class Meta:
         verbose_name_plural = "Locations"
+        indexes = [
+            trigram_index('name', 'location_name_trgm'),
+            trigram_index('country', 'location_country_trgm'),
+            trigram_index('state', 'location_state_trgm'),
+            trigram_index('region', 'location_region_trgm'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.country_code})"
@@ -146,6 +198,13 @@ class User(AbstractUser):
     consent = models.BooleanField(null=False, default=False)
     visible = models.BooleanField(null=False, default=True)
 
+    class Meta:
+        indexes = [
+            trigram_index('username', 'user_username_trgm'),
+            trigram_index('first_name', 'user_first_name_trgm'),
+            trigram_index('last_name', 'user_last_name_trgm'),
+        ]
+
     def get_full_name(self):
         """
         Returns the first_name plus the last_name, with a space in between.
@@ -386,7 +445,7 @@ class Record(models.Model):
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     media_file = models.FileField(upload_to=media_get_path, null=True)
-    preview_file = models.FileField(upload_to=media_get_path, null=True, blank=True)
+    preview_file = models.FileField(upload_to=media_get_path, max_length=255, null=True, blank=True)
     title = models.CharField(max_length=80, null=True, blank=True)
     MEDIA_TYPES = (
         ('Image', 'Image'),
@@ -409,15 +468,37 @@ class Record(models.Model):
     location = models.OneToOneField(Location, on_delete=models.SET_NULL, null=True, blank=True)
     language = models.CharField(max_length=20, choices=global_settings.LANGUAGES, null=True, blank=True)
     duration = models.IntegerField(null=True, blank=True)
-    embedding = models.JSONField(null=True, blank=True)
+    # full-text search vector of title, caption, location and visible comments (see save)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # time of the automatic face detection, images without it are processed by the detect_faces command
+    faces_detected = models.DateTimeField(null=True, blank=True, editable=False)
 
     objects = RecordManager()
 
+    class Meta:
+        indexes = [
+            trigram_index('title', 'record_title_trgm'),
+            trigram_index('user_caption', 'record_caption_trgm'),
+            GinIndex(fields=['search_vector'], name='record_search_vector'),
+        ]
+
     def __str__(self):
         if self.title:
             return self.title
         return str(self.id)
 
+    def save(self, *args, **kwargs):
+        """
+        Saves the record, the full-text search vector is computed by the same INSERT or UPDATE statement if the text,
+        location or language may have changed (all saves without update_fields)
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'title', 'user_caption', 'location', 'language'} & set(update_fields):
+            self.search_vector = record_search_vector(self)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'search_vector'}
+        super().save(*args, **kwargs)
+
     @property
     def get_file_extension(self):
         """ returns the file extension of the record file """
@@ -467,6 +548,9 @@ def auto_delete_file_on_delete(sender, instance, **kwargs):
         media_file_path = instance.media_file.path
         if os.path.isfile(media_file_path):
             os.remove(media_file_path)
+        # previews rendered from the image (see preview_rendering)
+        if instance.type == 'Image':
+            delete_previews(instance)
     if instance.preview_file:
         preview_file_path = instance.preview_file.path
         if os.path.isfile(preview_file_path):
@@ -502,6 +586,175 @@ def auto_delete_location_on_delete(sender, instance, **kwargs):
         instance.location.delete()
 
 
+class RecordEmbedding(models.Model):
+    """
+    The image embedding of a record computed by a model (see get_image_model_version), stored as binary
+    float32 or float16 values in a separate table, so that queries of records do not load it.
+    """
+    DTYPES = (
+        ('float32', 'float32'),
+        ('float16', 'float16'),
+    )
+    record = models.ForeignKey(Record, on_delete=models.CASCADE, related_name='embeddings')
+    model_version = models.CharField(max_length=128)
+    dtype = models.CharField(max_length=7, choices=DTYPES, default='float32')
+    vector = models.BinaryField()
+    date_created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['record', 'model_version'], name='record_embedding_unique'),
+        ]
+
+    @staticmethod
+    def encode(embedding, dtype):
+        """ returns the bytes of an embedding (list or numpy array) in the given number type """
+        return np.asarray(embedding, dtype=dtype).tobytes()
+
+    def get_vector(self):
+        """ returns the embedding as a float32 numpy array """
+        return np.frombuffer(self.vector, dtype=self.dtype).astype(np.float32)
+
+    @staticmethod
+    def dimensions(vector, dtype):
+        """ returns the number of dimensions of an embedding stored as bytes in the given number type """
+        return len(vector) // np.dtype(dtype).itemsize
+
+    def __str__(self):
+        return f"Embedding of {self.record_id} ({self.model_version})"
+
+
+# table holding the embeddings of the former JSON column Record.embedding during the migration
+LEGACY_EMBEDDING_TABLE = 'arch_app_legacy_record_embedding'
+
+
+@receiver(pre_migrate)
+def keep_legacy_embeddings(sender, app_config, using, **kwargs):
+    """
+    Copies the embeddings of the former JSON column Record.embedding into a temporary table before the migration
+    removes the column, they are converted to RecordEmbedding rows after the migration (see convert_legacy_embeddings)
+    """
+    if app_config.label != 'arch_app':
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if Record._meta.db_table not in connection.introspection.table_names(cursor):
+            return
+        columns = [column.name for column in
+                   connection.introspection.get_table_description(cursor, Record._meta.db_table)]
+        if 'embedding' in columns:
+            cursor.execute(f"DROP TABLE IF EXISTS {LEGACY_EMBEDDING_TABLE}")
+            cursor.execute(f"CREATE TABLE {LEGACY_EMBEDDING_TABLE} AS SELECT id AS record_id, embedding "
+                           f"FROM {Record._meta.db_table} WHERE embedding IS NOT NULL")
+
+
+@receiver(post_migrate)
+def convert_legacy_embeddings(sender, app_config, using, verbosity=1, stdout=sys.stdout, **kwargs):
+    """ Converts the embeddings kept by keep_legacy_embeddings to RecordEmbedding rows of the current image model """
+    if app_config.label != 'arch_app':
+        return
+    from .modules.embeddings.model_versions import get_image_model_version
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        tables = connection.introspection.table_names(cursor)
+        if LEGACY_EMBEDDING_TABLE not in tables:
+            return
+        columns = [column.name for column in
+                   connection.introspection.get_table_description(cursor, Record._meta.db_table)]
+    # the copy is kept until the migration removed the column and created the table of the embeddings
+    if 'embedding' in columns or RecordEmbedding._meta.db_table not in tables:
+        return
+    # the copy is only dropped if all embeddings were converted
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # read the rows in chunks (server side cursor)
+        legacy_rows = connection.chunked_cursor()
+        legacy_rows.execute(f"SELECT record_id, embedding FROM {LEGACY_EMBEDDING_TABLE} "
+                            f"WHERE record_id IN (SELECT id FROM {Record._meta.db_table})")
+        model_version = get_image_model_version()
+        count = 0
+        while True:
+            rows = legacy_rows.fetchmany(1000)
+            if not rows:
+                break
+            RecordEmbedding.objects.using(using).bulk_create([
+                RecordEmbedding(record_id=record_id, model_version=model_version, dtype=settings.EMBEDDING_DTYPE,
+                                vector=RecordEmbedding.encode(
+                                    json.loads(embedding) if isinstance(embedding, str) else embedding,
+                                    settings.EMBEDDING_DTYPE))
+                for record_id, embedding in rows
+            ], ignore_conflicts=True)
+            count += len(rows)
+        legacy_rows.close()
+        cursor.execute(f"DROP TABLE {LEGACY_EMBEDDING_TABLE}")
+    if verbosity >= 1:
+        stdout.write(f"  Converted {count} record embeddings.\n")
+
+
+class RecordVisibility(models.Model):
+    """
+    A user who is permitted to view a record (guardian 'view_record' permission of the user or one of their groups).
+    Maintained by the signal handlers below, so that search results are filtered by permissions with an indexed
+    semi-join instead of the guardian permission tables.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False, related_name='visible_records')
+    record = models.ForeignKey(Record, on_delete=models.CASCADE, related_name='visibility')
+
+    objects = RecordVisibilityManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'record'], name='record_visibility_unique'),
+        ]
+
+
+def is_record_permission(instance):
+    """ checks if a guardian object permission is a 'view_record' permission """
+    return ContentType.objects.get_for_id(instance.content_type_id).model_class() is Record and \
+        instance.permission.codename == 'view_record'
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+def update_visibility_on_user_permission(sender, instance, **kwargs):
+    """ Updates the record visibility if a 'view_record' permission is assigned to or removed from a user """
+    if is_record_permission(instance):
+        RecordVisibility.objects.refresh(user_ids=[instance.user_id], record_ids=[instance.object_pk])
+
+
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+def update_visibility_on_group_permission(sender, instance, **kwargs):
+    """ Updates the record visibility if a 'view_record' permission is assigned to or removed from a group """
+    if is_record_permission(instance):
+        RecordVisibility.objects.refresh(record_ids=[instance.object_pk])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def update_visibility_on_group_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Updates the record visibility if users are added to or removed from a group, e.g. the archive moderators
+    (Membership), the album group (Album) or the depicted users of a record (Tag)
+    """
+    if action == 'pre_clear':
+        # remember the users (or groups) before they are removed
+        related = getattr(instance, 'user_set' if reverse else 'groups')
+        instance._cleared_pks = list(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_pks', [])
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if reverse:
+        # group.user_set changed
+        user_ids, group_ids = pk_set, [instance.pk]
+    else:
+        # user.groups changed
+        user_ids, group_ids = [instance.pk], pk_set
+    if user_ids and group_ids:
+        RecordVisibility.objects.refresh(user_ids=user_ids,
+                                         record_ids=RecordVisibility.objects.group_record_ids(group_ids))
+
+
 class Tag(models.Model):
     """ a Tag to a Record """
     record = models.ForeignKey(Record, on_delete=models.CASCADE, related_name='tags', null=True)
@@ -526,6 +779,8 @@ class TagBox(Tag):
     height = models.IntegerField()
     width = models.IntegerField()
 
+    objects = TagBoxManager()
+
     def __str__(self):
         return f"{self.user.username if self.user else 'Unknown'} on {self.record.title}"
 
@@ -601,6 +856,15 @@ class Comment(models.Model):
         return 'Comment "{}" by {}'.format(self.text, self.user.username)
 
 
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def update_search_vector_on_comment(sender, instance, **kwargs):
+    """ Updates the full-text search vector of the record if a comment is created, changed, hidden or deleted """
+    record = Record.objects.filter(pk=instance.record_id).select_related('location').first()
+    if record:
+        Record.objects.filter(pk=record.pk).update(search_vector=record_search_vector(record))
+
+
 # adapted from https://github.com/jose-lpa/django-tracking-analyzer
 class Tracker(models.Model):
     """
@@ -647,3 +911,131 @@ class Tracker(models.Model):
     def __str__(self):
         return '{0} :: {1}, {2}'.format(
             self.content_object, self.user, self.timestamp)
+
+
+def generate_result_set_token():
+    """ returns a short random token identifying a result set """
+    return secrets.token_urlsafe(9)
+
+
+class ResultSet(models.Model):
+    """
+    A ranked list of records (e.g. search results or the records of an album), stored in the database
+    so that pagination and the navigation between records only reference it by its token.
+    Result sets expire after settings.RESULT_SET_TTL seconds.
+    """
+    token = models.CharField(max_length=16, unique=True, default=generate_result_set_token, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='result_sets')
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    # identifies the records of the result set (e.g. of an album), so that it is reused (see get_or_create_result_set)
+    key = models.CharField(max_length=64, blank=True, default='', editable=False)
+
+    def __str__(self):
+        return f'Result set {self.token} of {self.user}'
+
+
+class ResultSetEntry(models.Model):
+    """ the position (rank) of a record in a result set, ranks start at 0 and may have gaps """
+    result_set = models.ForeignKey(ResultSet, on_delete=models.CASCADE, related_name='entries')
+    rank = models.PositiveIntegerField()
+    record = models.ForeignKey(Record, on_delete=models.CASCADE, related_name='result_set_entries')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['result_set', 'rank'], name='result_set_rank_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['result_set', 'record'], name='result_set_record'),
+        ]
+
+
+class AutocompleteSuggestion(models.Model):
+    """
+    A suggestion of the autocomplete of the search bar: a distinct title or caption ('text'), location name or name
+    of a depicted user ('person') of the records of an archive. The weight is the number of records containing it.
+    Maintained by the signal handlers below, so that the autocomplete does not scan the records.
+    """
+    KINDS = (
+        ('text', 'text'),
+        ('location', 'location'),
+        ('person', 'person'),
+    )
+    archive = models.ForeignKey(Archive, on_delete=models.CASCADE, null=True, related_name='suggestions')
+    kind = models.CharField(max_length=19, choices=KINDS)
+    display_text = models.CharField(max_length=160)
+    # full text (not truncated like display_text) in lower case and without accents, matched against the terms
+    # (see AutocompleteSuggestionManager.normalize)
+    normalized_text = models.CharField(max_length=400)
+    # the depicted user of a 'person' suggestion
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='suggestions')
+    weight = models.PositiveIntegerField(default=0)
+
+    objects = AutocompleteSuggestionManager()
+
+    class Meta:
+        constraints = [
+            # texts which only differ after the truncation of display_text are distinct suggestions
+            models.UniqueConstraint(fields=['archive', 'kind', 'display_text', 'normalized_text', 'user'],
+                                    name='autocomplete_suggestion_unique'),
+            # NULL values are distinct in unique constraints
+            models.UniqueConstraint(fields=['archive', 'kind', 'display_text', 'normalized_text'],
+                                    condition=models.Q(user=None),
+                                    name='autocomplete_suggestion_unique_text'),
+        ]
+        indexes = [
+            # prefix lookups (LIKE 'term%')
+            models.Index(fields=['kind', 'normalized_text'], opclasses=['varchar_pattern_ops', 'varchar_pattern_ops'],
+                         name='autocomplete_prefix'),
+            # substring and similar word lookups
+            GinIndex(OpClass('normalized_text', name='gin_trgm_ops'), name='autocomplete_trgm'),
+        ]
+
+    def __str__(self):
+        return f"{self.display_text} ({self.kind}, {self.weight})"
+
+
+class AutocompleteSource(models.Model):
+    """ a record containing the text of an autocomplete suggestion """
+    suggestion = models.ForeignKey(AutocompleteSuggestion, on_delete=models.CASCADE, related_name='sources')
+    record = models.ForeignKey(Record, on_delete=models.CASCADE, related_name='suggestion_sources')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['suggestion', 'record'], name='autocomplete_source_unique'),
+        ]
+
+
+@receiver(post_save, sender=Record)
+def update_suggestions(sender, instance, update_fields=None, **kwargs):
+    """
+    Updates the autocomplete suggestions of a record if its texts, location, album or depicted users
+    (saved by the Tag handlers) may have changed
+    """
+    if update_fields and not {'title', 'user_caption', 'location', 'album', 'depicted_users'} & set(update_fields):
+        return
+    AutocompleteSuggestion.objects.update_records([instance.pk])
+
+
+@receiver(pre_delete, sender=Record)
+def remove_suggestions(sender, instance, **kwargs):
+    """ Removes a deleted record from its autocomplete suggestions """
+    AutocompleteSuggestion.objects.remove_records([instance.pk])
+
+
+@receiver(post_save, sender=Location)
+def update_suggestions_on_location(sender, instance, **kwargs):
+    """ Updates the search vectors and the autocomplete suggestions of the records of a changed location """
+    record_ids = list(Record.objects.filter(location=instance).values_list('pk', flat=True))
+    if record_ids:
+        update_search_vectors(Record.objects.filter(pk__in=record_ids))
+        AutocompleteSuggestion.objects.update_records(record_ids)
+
+
+@receiver(post_save, sender=User)
+def update_suggestions_on_user(sender, instance, created, update_fields=None, **kwargs):
+    """ Updates the autocomplete suggestions of the records depicting a user if the name of the user changed """
+    if created or (update_fields and not {'username', 'first_name', 'last_name'} & set(update_fields)):
+        return
+    record_ids = list(Record.objects.filter(depicted_users__user=instance).values_list('pk', flat=True))
+    if record_ids:
+        AutocompleteSuggestion.objects.update_records(record_ids)
@@ -1,13 +1,63 @@
-import cv2
-import cvlib  # see https://www.cvlib.net/
+"""
+Face detection with the backend selected by settings.FACE_DETECTOR (see face_detectors), which is loaded on the
+first detection.
+"""
+import numpy as np
+from django.conf import settings
+from .face_detectors import create_detector
+from .image_loading import load_image, scale_boxes
+from ..inference import client as inference_client
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# face detectors of this process by backend
+detectors = {}
+
+
+def get_detector():
+    """ returns the face detector of settings.FACE_DETECTOR, it is created on the first use """
+    if settings.FACE_DETECTOR not in detectors:
+        detectors[settings.FACE_DETECTOR] = create_detector(settings.FACE_DETECTOR)
+    return detectors[settings.FACE_DETECTOR]
 
 
 def detect_faces(image_path):
     """ Detect faces on an image. """
-    img_raw = cv2.imread(image_path)                # load image
-    img = cv2.cvtColor(img_raw, cv2.COLOR_BGR2RGB)  # correct color coding
-    faces, confidences = cvlib.detect_face(img)     # detect faces
-    return faces
+    if settings.INFERENCE_SOCKET:
+        try:
+            return inference_client.detect_faces(image_path)
+        except inference_client.InferenceError as error:
+            console_logger.error(f"{error}, the faces are detected in this process")
+    return detect_faces_locally(image_path)
+
+
+def detect_faces_locally(image_path):
+    """
+    Detect faces on an image with the model of this process. The image is decoded at reduced size
+    (settings.FACE_DETECTION_IMAGE_SIZE), the boxes refer to the original image (rotated according to EXIF).
+    """
+    return detect_faces_on_image(*load_face_detection_image(image_path))
+
+
+def load_face_detection_image(image_path):
+    """ decodes an image at the size used for face detection, returns tuple (RGB image, original size) """
+    return load_image(image_path, settings.FACE_DETECTION_IMAGE_SIZE or None, side='long')
+
+
+def detect_faces_on_image(img, original_size):
+    """
+    Detect faces on a decoded image (see load_face_detection_image).
+    :param img: RGB image
+    :param original_size: size (width, height) of the original image, the boxes refer to it
+    """
+    faces = get_detector().detect(np.asarray(img))
+    return scale_boxes(faces, img.size, original_size)
+
+
+def warm_up():
+    """ Loads the face detection model by running it on an empty image. """
+    get_detector().detect(np.zeros((64, 64, 3), dtype=np.uint8))
 
 
 # alternative face detection using haar cascade classifier
@@ -0,0 +1,186 @@
+"""
+Face detection backends (settings.FACE_DETECTOR). Every detector takes an RGB image (numpy array) and returns the
+face boxes as list of (x1, y1, x2, y2) tuples of integer pixel coordinates of this image.
+
+- 'cvlib': cvlib.detect_face (requires cvlib, which imports TensorFlow)
+- 'ssd': the ResNet-10 SSD model used by cvlib, run directly with the DNN module of OpenCV (same boxes as 'cvlib',
+  without TensorFlow)
+- 'yunet': the YuNet ONNX model of the OpenCV model zoo, run with cv2.FaceDetectorYN (requires opencv>=4.8)
+
+The weights of the OpenCV backends are downloaded into the model directory (see get_model_path) by
+manage.py download_face_detectors and verified with the SHA-256 checksums of settings.FACE_DETECTOR_WEIGHTS_SHA256,
+the detectors do not download them.
+"""
+import hashlib
+import os
+import urllib.request
+import numpy as np
+from django.conf import settings
+from ..embeddings.model_versions import get_model_path
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# weights of the SSD model (release v0.1 of the files of cvlib) and of the YuNet model (OpenCV model zoo at the commit
+# settings.FACE_DETECTOR_YUNET_REVISION), by backend: directory in the model directory and urls of the files
+CVLIB_FILES_URL = 'https://github.com/arunponnusamy/cvlib-files/releases/download/v0.1/'
+YUNET_URL = 'https://github.com/opencv/opencv_zoo/raw/{revision}/models/face_detection_yunet/'
+WEIGHTS = {
+    'ssd': ('face_detection_ssd', [CVLIB_FILES_URL + 'deploy.prototxt',
+                                   CVLIB_FILES_URL + 'res10_300x300_ssd_iter_140000.caffemodel']),
+    'yunet': ('face_detection_yunet', [YUNET_URL + 'face_detection_yunet_2023mar.onnx']),
+}
+
+
+def file_sha256(path):
+    """ returns the SHA-256 checksum (hex) of a file """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 ** 2), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_weights(path, name=None):
+    """
+    Raises a ValueError if the checksum of a weights file is not configured or does not match.
+    :param path: path of the file
+    :param name: name of the file in settings.FACE_DETECTOR_WEIGHTS_SHA256, defaults to the name of the path
+    """
+    name = name or os.path.basename(path)
+    expected = settings.FACE_DETECTOR_WEIGHTS_SHA256.get(name)
+    checksum = file_sha256(path)
+    if not expected:
+        raise ValueError(f"No SHA-256 checksum of {name} is configured (the file has {checksum}), compare it with "
+                         f"the published checksum and add it to FACE_DETECTOR_WEIGHTS_SHA256")
+    if checksum != expected.lower():
+        raise ValueError(f"The SHA-256 checksum of {name} is {checksum} instead of {expected}")
+
+
+def weight_files(backend):
+    """ returns the paths and urls {path: url} of the weights of a backend (see WEIGHTS) """
+    directory, urls = WEIGHTS[backend]
+    if backend == 'yunet':
+        if not settings.FACE_DETECTOR_YUNET_REVISION:
+            raise ValueError("Set FACE_DETECTOR_YUNET_REVISION to the commit of the OpenCV model zoo to download the "
+                             "YuNet model from")
+        urls = [url.format(revision=settings.FACE_DETECTOR_YUNET_REVISION) for url in urls]
+    return {os.path.join(get_model_path(directory), url.rsplit('/', 1)[1]): url for url in urls}
+
+
+def download_weights(backend):
+    """
+    Downloads the missing weights of a backend into the model directory and verifies their checksums, a file with a
+    wrong checksum is not kept.
+    :param backend: name of the backend (see WEIGHTS)
+    returns list of the paths of the downloaded files
+    """
+    downloaded = []
+    for path, url in weight_files(backend).items():
+        if os.path.exists(path):
+            verify_weights(path)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        console_logger.info(f"Downloading {url}")
+        # the file is renamed when it is complete and verified, an interrupted download is repeated
+        urllib.request.urlretrieve(url, path + '.part')
+        try:
+            verify_weights(path + '.part', os.path.basename(path))
+        except ValueError:
+            os.remove(path + '.part')
+            raise
+        os.replace(path + '.part', path)
+        downloaded.append(path)
+    return downloaded
+
+
+def load_weights(backend):
+    """ returns the paths of the verified weights of a backend, they have to be downloaded before """
+    directory, urls = WEIGHTS[backend]
+    paths = [os.path.join(get_model_path(directory), url.rsplit('/', 1)[1]) for url in urls]
+    for path in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The weights {path} of the {backend} face detector do not exist, download them "
+                                    f"with 'python manage.py download_face_detectors'")
+        verify_weights(path)
+    return paths
+
+
+class FaceDetector:
+    """ interface of the face detection backends """
+    name = None
+
+    def detect(self, image):
+        """
+        Detect the faces on an image.
+        :param image: RGB image as numpy array (height, width, 3)
+        returns list of boxes (x1, y1, x2, y2)
+        """
+        raise NotImplementedError
+
+
+class CvlibFaceDetector(FaceDetector):
+    name = 'cvlib'
+
+    def __init__(self, threshold=0.5):
+        import cvlib  # see https://www.cvlib.net/
+        self.cvlib = cvlib
+        self.threshold = threshold
+
+    def detect(self, image):
+        # the RGB image is passed as before the backends were added, so the detected faces do not change
+        faces, confidences = self.cvlib.detect_face(image, threshold=self.threshold)
+        return [tuple(int(value) for value in face) for face in faces]
+
+
+class SsdFaceDetector(FaceDetector):
+    """ the model and the pre- and postprocessing of cvlib.detect_face """
+    name = 'ssd'
+    input_size = (300, 300)
+    mean = (104.0, 117.0, 123.0)
+
+    def __init__(self, threshold=0.5):
+        import cv2
+        self.cv2 = cv2
+        prototxt, caffemodel = load_weights('ssd')
+        self.net = cv2.dnn.readNetFromCaffe(prototxt, caffemodel)
+        self.threshold = threshold
+
+    def detect(self, image):
+        height, width = image.shape[:2]
+        # the image is passed in the channel order of the cvlib backend (RGB), so both find the same boxes
+        blob = self.cv2.dnn.blobFromImage(self.cv2.resize(image, self.input_size), 1.0, self.input_size, self.mean)
+        self.net.setInput(blob)
+        detections = self.net.forward()[0, 0]
+        boxes = detections[detections[:, 2] >= self.threshold, 3:7] * np.array([width, height, width, height])
+        return [tuple(int(value) for value in box) for box in boxes.astype('int')]
+
+
+class YuNetFaceDetector(FaceDetector):
+    name = 'yunet'
+
+    def __init__(self, threshold=0.8, nms_threshold=0.3, top_k=5000):
+        import cv2
+        self.cv2 = cv2
+        model, = load_weights('yunet')
+        self.detector = cv2.FaceDetectorYN.create(model, '', (320, 320), threshold, nms_threshold, top_k)
+
+    def detect(self, image):
+        height, width = image.shape[:2]
+        self.detector.setInputSize((width, height))
+        _, faces = self.detector.detect(np.ascontiguousarray(image[:, :, ::-1]))
+        if faces is None:
+            return []
+        # rows of (x, y, width, height, 5 landmarks, score), the boxes may exceed the image
+        return [(max(0, int(x)), max(0, int(y)), min(width, int(x + w)), min(height, int(y + h)))
+                for x, y, w, h in faces[:, :4]]
+
+
+DETECTORS = {detector.name: detector for detector in (CvlibFaceDetector, SsdFaceDetector, YuNetFaceDetector)}
+
+
+def create_detector(name):
+    """ returns a new detector of a backend (see DETECTORS) """
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector {name}, choose one of {', '.join(DETECTORS)}")
+    return DETECTORS[name]()
@@ -0,0 +1,89 @@
+"""
+Decoding of images at the resolution needed by the AI models (image embedding, face detection).
+
+JPEG images are decoded with DCT scaling (PIL draft mode) at 1/2, 1/4 or 1/8 of their size, which is much faster
+and needs much less memory than decoding a 12-48 MP photo and downscaling it afterwards. The images are rotated
+according to their EXIF orientation, so coordinates refer to the image as it is displayed.
+"""
+from PIL import Image, ImageOps
+
+# EXIF orientations which swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION = 274
+
+
+def get_image_size(image_path):
+    """ returns the size (width, height) of an image as it is displayed (EXIF orientation), reads only the header """
+    with Image.open(image_path) as img:
+        return _oriented_size(img)
+
+
+def _oriented_size(img):
+    width, height = img.size
+    if img.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def load_image(image_path, target_size=None, side='short'):
+    """
+    Decode an image as RGB image, reduced so that one side has (about) the target size. Images are never enlarged.
+    :param image_path: path to the image
+    :param target_size: size in pixels of the side, None decodes the full image
+    :param side: 'short' (e.g. for CLIP, which crops the center square) or 'long' side of the image
+    returns tuple (image, original size (width, height) of the displayed image)
+    """
+    img = Image.open(image_path)
+    try:
+        original_size = _oriented_size(img)
+        scale = 1
+        if target_size:
+            side_size = min(img.size) if side == 'short' else max(img.size)
+            scale = min(1.0, target_size / side_size)
+        if scale < 1 and img.format == 'JPEG':
+            # decode at the smallest DCT scale which is not smaller than the requested size
+            img.draft('RGB', (int(img.width * scale) + 1, int(img.height * scale) + 1))
+        decoded = ImageOps.exif_transpose(img)
+        if decoded.mode != 'RGB':
+            decoded = decoded.convert('RGB')
+        if scale < 1:
+            size = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+            if decoded.size != size:
+                decoded = decoded.resize(size, Image.BICUBIC)
+        decoded.load()
+    except Exception:
+        img.close()
+        raise
+    # the file is closed after loading, the image data of a new image must not be released
+    if decoded is not img:
+        img.close()
+    return decoded, original_size
+
+
+def scale_boxes(boxes, from_size, to_size):
+    """
+    Convert box coordinates (x1, y1, x2, y2) from an image size to another size of the same image.
+    :param boxes: list of boxes
+    :param from_size: size (width, height) of the image the boxes were detected on
+    :param to_size: size (width, height) of the image the boxes should refer to
+    returns list of boxes with integer coordinates
+    """
+    scale_x, scale_y = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    return [(round(x1 * scale_x), round(y1 * scale_y), round(x2 * scale_x), round(y2 * scale_y))
+            for x1, y1, x2, y2 in boxes]
+
+
+def box_iou(box, other):
+    """ returns the intersection over union of two boxes (x1, y1, x2, y2) """
+    width = min(box[2], other[2]) - max(box[0], other[0])
+    height = min(box[3], other[3]) - max(box[1], other[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area = (box[2] - box[0]) * (box[3] - box[1]) + (other[2] - other[0]) * (other[3] - other[1])
+    return intersection / (area - intersection)
+
+
+def remove_overlapping_boxes(boxes, existing, threshold=0.5):
+    """ returns the boxes which do not overlap one of the existing boxes with an IoU of at least the threshold """
+    return [box for box in boxes if not any(box_iou(box, other) >= threshold for other in existing)]
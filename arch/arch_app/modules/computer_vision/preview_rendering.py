@@ -0,0 +1,183 @@
+"""
+Rendering of the public preview of image records. The original image (media_file) is never changed, the preview is
+rendered from it with all hidden TagBoxes (visible is not 'visible') blurred in a single decode and encode pass, so
+hiding and showing tags does not accumulate JPEG generation loss.
+
+The rendered previews are stored in the directory 'previews' next to the records, named by a hash of the original
+file and the blurred boxes. Showing a tag again (or hiding it again) reuses the preview rendered before. The previews
+are written to a temporary file and renamed, a preview is rendered under a lock of the record (a lock file, so that
+the lock holds for all gunicorn and qcluster processes).
+"""
+import fcntl
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from django.conf import settings
+from PIL import Image, ImageFilter, ImageOps
+from .image_loading import get_image_size, scale_boxes
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# changes the hash of all previews if the rendering is changed (e.g. the blur)
+RENDER_VERSION = 1
+# number of rendered previews kept per record (the current one and the most recently used ones)
+KEPT_PREVIEWS = 4
+JPEG_QUALITY = 90
+# fields of a TagBox which describe its box (see tagbox_boxes)
+BOX_FIELDS = ('x1', 'y1', 'x2', 'y2', 'width', 'height')
+
+
+def preview_directory(record):
+    """ returns the absolute path of the directory of the rendered previews of a record """
+    return os.path.join(os.path.dirname(record.media_file.path), 'previews')
+
+
+@contextmanager
+def record_lock(record):
+    """ locks the previews of a record for all processes """
+    directory = preview_directory(record)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'{record.id}.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def tagbox_boxes(tagboxes, image_size):
+    """
+    returns the sorted boxes (x1, y1, x2, y2) of TagBoxes, scaled to the size (width, height) of the displayed image
+    :param tagboxes: values of the BOX_FIELDS of the TagBoxes, e.g. TagBox.objects.values_list(*BOX_FIELDS)
+    """
+    boxes = []
+    for x1, y1, x2, y2, width, height in tagboxes:
+        if width and height:
+            boxes.extend(scale_boxes([(x1, y1, x2, y2)], (width, height), image_size))
+        else:
+            boxes.append((x1, y1, x2, y2))
+    return sorted(boxes)
+
+
+def preview_hash(original_path, boxes):
+    """ returns the hash of a preview, it changes with the original file (size, modification time) and the boxes """
+    stat = os.stat(original_path)
+    key = f'{RENDER_VERSION}|{os.path.basename(original_path)}|{stat.st_size}|{stat.st_mtime_ns}|{boxes}'
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def blur_boxes(img, boxes):
+    """ blurs the boxes (x1, y1, x2, y2) of an image, the radius depends on the size of a box """
+    for x1, y1, x2, y2 in boxes:
+        radius = max(5, int((x2 - x1 + y2 - y1) / 20))
+        crop = img.crop((x1, y1, x2, y2))
+        img.paste(crop.filter(ImageFilter.BoxBlur(radius=radius)), (x1, y1, x2, y2))
+    return img
+
+
+def render_image(source_path, boxes, target_path):
+    """
+    Renders an image with blurred boxes: decodes the source once (rotated according to its EXIF orientation, the
+    boxes refer to the displayed image), blurs all boxes, encodes it once and replaces the target atomically. Without
+    boxes the source file is copied, it is not re-encoded.
+    :param source_path: path to the image
+    :param boxes: list of boxes (x1, y1, x2, y2)
+    :param target_path: path of the rendered image (may be the source path)
+    """
+    directory = os.path.dirname(target_path)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    os.close(file_descriptor)
+    try:
+        if not boxes:
+            shutil.copyfile(source_path, temp_path)
+        else:
+            with Image.open(source_path) as original:
+                image_format = original.format
+                img = ImageOps.exif_transpose(original)
+                # the orientation is removed from the EXIF data by exif_transpose
+                options = {key: img.info[key] for key in ('exif', 'icc_profile') if img.info.get(key)}
+            if img.mode not in ('RGB', 'RGBA', 'L'):
+                img = img.convert('RGBA' if 'A' in img.mode or 'transparency' in img.info else 'RGB')
+            if image_format == 'JPEG':
+                if img.mode == 'RGBA':
+                    img = img.convert('RGB')
+                options['quality'] = JPEG_QUALITY
+            blur_boxes(img, boxes)
+            img.save(temp_path, format=image_format, **options)
+        os.replace(temp_path, target_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def render_preview(record):
+    """
+    Sets the preview of an image record to the original with its hidden TagBoxes blurred, renders it if it does not
+    exist yet. Call it after the visibility of a TagBox has changed.
+    :param record: image record
+    returns the path of the preview
+    """
+    original_path = record.media_file.path
+    with record_lock(record):
+        hidden = record.get_tagboxes.exclude(visible='visible')
+        # images without hidden faces are copied, they are not decoded (e.g. SVG images)
+        boxes = tagbox_boxes(hidden.values_list(*BOX_FIELDS), get_image_size(original_path)) \
+            if hidden.exists() else []
+        extension = os.path.splitext(original_path)[1].lower()
+        preview_path = os.path.join(preview_directory(record),
+                                    f'{record.id}_{preview_hash(original_path, boxes)}{extension}')
+        if os.path.exists(preview_path):
+            # marks the preview as recently used
+            os.utime(preview_path)
+        else:
+            render_image(original_path, boxes, preview_path)
+            console_logger.info(f'Rendered preview of record {record.id} with {len(boxes)} blurred faces')
+
+        old_path = record.preview_file.path if record.preview_file else None
+        name = os.path.relpath(preview_path, settings.MEDIA_ROOT)
+        if record.preview_file.name != name:
+            record.preview_file.name = name
+            type(record).objects.filter(pk=record.pk).update(preview_file=name)
+        # the preview copied at the upload (before the previews were rendered) is not needed anymore
+        if old_path and old_path not in (preview_path, original_path) \
+                and os.path.dirname(old_path) != preview_directory(record) and os.path.isfile(old_path):
+            os.remove(old_path)
+        _remove_unused_previews(record, keep=preview_path)
+    return preview_path
+
+
+def blur_original(record, tagboxes):
+    """
+    Blurs TagBoxes in the original image of a record permanently (e.g. the faces of a deleted account), the preview
+    has to be rendered again afterwards (see render_preview). All previews rendered before are removed, as they show
+    the faces unblurred.
+    :param record: image record
+    :param tagboxes: values of the BOX_FIELDS of TagBoxes of the record (they may have been deleted meanwhile)
+    """
+    with record_lock(record):
+        boxes = tagbox_boxes(tagboxes, get_image_size(record.media_file.path))
+        if boxes:
+            render_image(record.media_file.path, boxes, record.media_file.path)
+            for path in glob.glob(os.path.join(preview_directory(record), f'{record.id}_*')):
+                os.remove(path)
+
+
+def _remove_unused_previews(record, keep):
+    """ removes the previews of a record except the one in use and the most recently used ones """
+    paths = [path for path in glob.glob(os.path.join(preview_directory(record), f'{record.id}_*')) if path != keep]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[KEPT_PREVIEWS - 1:]:
+        os.remove(path)
+
+
+def delete_previews(record):
+    """ removes all rendered previews and the lock file of a record """
+    directory = preview_directory(record)
+    for path in glob.glob(os.path.join(directory, f'{record.id}_*')) + glob.glob(
+            os.path.join(directory, f'{record.id}.lock')):
+        os.remove(path)
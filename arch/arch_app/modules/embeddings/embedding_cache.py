@@ -0,0 +1,125 @@
+"""
+Cache for the embeddings of search queries, so that repeated queries (e.g. when paging back and forth)
+do not run the text model again.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from django.core.cache import caches
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+
+def normalize_query(query):
+    """
+    Normalize the whitespace of a search query, so that equivalent queries share a cache entry. The case is kept, the
+    text model distinguishes it (e.g. names of persons and places).
+    """
+    return ' '.join(query.split())
+
+
+class EmbeddingCache:
+    """
+    Bounded, thread-safe LRU cache of embeddings in the memory of the process, with an optional second tier
+    in a Django cache backend shared by all processes (e.g. memcached or redis).
+    Entries are keyed by the model version and the normalized query.
+    """
+
+    def __init__(self, max_size=1024, shared_cache=None, shared_timeout=None, log_interval=100):
+        """
+        :param max_size: maximum number of embeddings kept in memory, 0 disables the in-memory tier
+        :param shared_cache: name of a cache in settings.CACHES or None
+        :param shared_timeout: seconds an entry is kept in the shared cache, None for the cache default
+        :param log_interval: log the statistics every log_interval lookups, 0 disables logging
+        """
+        self.max_size = max_size
+        self.shared_cache = shared_cache
+        self.shared_timeout = shared_timeout
+        self.log_interval = log_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.inference_time = 0.0
+
+    @staticmethod
+    def _shared_key(key):
+        """ returns a key which is valid for all cache backends (e.g. memcached limits length and characters) """
+        return 'text_embedding:' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, model_version, query, compute):
+        """
+        Return the embedding of a query from the cache or compute and store it.
+        :param model_version: identifier of the model which computes the embedding
+        :param query: normalized search query
+        :param compute: function computing the embedding of the query
+        """
+        key = (model_version, query)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if embedding is None and self.shared_cache:
+            data = caches[self.shared_cache].get(self._shared_key(key))
+            if data is not None:
+                embedding = np.frombuffer(data, dtype=np.float32)
+                with self._lock:
+                    self.shared_hits += 1
+                self._store(key, embedding)
+        if embedding is None:
+            start = time.perf_counter()
+            embedding = np.asarray(compute(query), dtype=np.float32)
+            with self._lock:
+                self.misses += 1
+                self.inference_time += time.perf_counter() - start
+            self._store(key, embedding)
+            if self.shared_cache:
+                caches[self.shared_cache].set(self._shared_key(key), embedding.tobytes(), self.shared_timeout)
+        self._log_statistics()
+        return embedding
+
+    def _store(self, key, embedding):
+        """ store an embedding in memory and evict the least recently used entries """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def info(self):
+        """ returns the statistics of the cache, including an estimate of the saved inference time """
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            average_inference_time = self.inference_time / self.misses if self.misses else 0.0
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                'inference_time': self.inference_time,
+                'saved_inference_time': average_inference_time * (self.hits + self.shared_hits),
+            }
+
+    def clear(self):
+        """ removes all entries from memory and resets the statistics """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+            self.inference_time = 0.0
+
+    def _log_statistics(self):
+        if not self.log_interval:
+            return
+        info = self.info()
+        if (info['hits'] + info['shared_hits'] + info['misses']) % self.log_interval == 0:
+            console_logger.info(f"Text embedding cache: {info['hits']} hits, {info['shared_hits']} shared hits, "
+                                f"{info['misses']} misses, saved {info['saved_inference_time']:.1f}s inference time")
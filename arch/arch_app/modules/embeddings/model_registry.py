@@ -0,0 +1,146 @@
+"""
+Registry of the AI models of a process. Every model is loaded independently on its first use (a web process, which
+only encodes search queries, never loads the image model) and evicted again when it was not used for
+settings.AI_MODEL_IDLE_TIMEOUT seconds. Pinned models (preloaded by the qcluster workers and the inference server)
+are never evicted. Loads and evictions are logged and kept for the model status (see status()).
+"""
+import gc
+import os
+import resource
+import threading
+import time
+from collections import deque
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# number of load and evict events kept for the status
+MAX_EVENTS = 50
+
+
+def resident_memory():
+    """ returns the current resident memory of the process in MB (the peak resident memory if it is unknown) """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ModelRegistry:
+    """ Loads models lazily by name and evicts idle models """
+
+    def __init__(self, idle_timeout=0, clock=time.monotonic):
+        """
+        :param idle_timeout: seconds after the last use until a model is evicted, 0 keeps the models loaded
+        :param clock: function returning the current time in seconds
+        """
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.loaders = {}
+        self.models = {}
+        self.last_used = {}
+        self.pinned = set()
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.timer = None
+
+    def register(self, name, loader):
+        """ registers the function loading a model, it is called on the first use of the model """
+        self.loaders[name] = loader
+        self.load_locks[name] = threading.Lock()
+
+    def get(self, name, pin=False):
+        """
+        Returns a model, it is loaded if it is not loaded yet.
+        :param name: name of the registered model
+        :param pin: never evict the model
+        """
+        # only one thread loads a model, the other models stay usable meanwhile
+        with self.load_locks[name]:
+            model = self.models.get(name)
+            if model is None:
+                start = self.clock()
+                model = self.loaders[name]()
+                self._record_event('load', name, self.clock() - start)
+            with self.lock:
+                self.models[name] = model
+                self.last_used[name] = self.clock()
+                if pin:
+                    self.pinned.add(name)
+        self._schedule_eviction()
+        return model
+
+    def is_loaded(self, name):
+        return name in self.models
+
+    def evict(self, name, idle_timeout=None):
+        """
+        Removes a model from the registry.
+        :param name: name of the registered model
+        :param idle_timeout: only evict the model if it was not used for this number of seconds
+        returns whether the model was evicted
+        """
+        with self.load_locks[name]:
+            with self.lock:
+                if idle_timeout is not None and (name in self.pinned or name not in self.last_used or
+                                                 self.clock() - self.last_used[name] < idle_timeout):
+                    return False
+                model = self.models.pop(name, None)
+                self.last_used.pop(name, None)
+                self.pinned.discard(name)
+            if model is None:
+                return False
+            del model
+            # release the weights now instead of at the next garbage collection
+            gc.collect()
+            self._record_event('evict', name)
+        return True
+
+    def evict_idle(self):
+        """ evicts the models which were not used within the idle timeout, returns the names of the evicted models """
+        if not self.idle_timeout:
+            return []
+        with self.lock:
+            loaded = list(self.models)
+        # a model is evicted only if it is still idle when its load lock is acquired
+        return [name for name in loaded if self.evict(name, self.idle_timeout)]
+
+    def _schedule_eviction(self):
+        """ checks for idle models regularly (in a daemon thread) as long as unpinned models are loaded """
+        with self.lock:
+            if not self.idle_timeout or (self.timer and self.timer.is_alive()) or \
+                    not set(self.models) - self.pinned:
+                return
+            self.timer = threading.Timer(self.idle_timeout / 2, self._check_idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _check_idle(self):
+        try:
+            self.evict_idle()
+        except Exception as error:
+            console_logger.error(f"Eviction of idle AI models failed: {error}")
+        with self.lock:
+            self.timer = None
+        self._schedule_eviction()
+
+    def _record_event(self, event, name, seconds=None):
+        memory = resident_memory()
+        self.events.append({'event': event, 'model': name, 'time': time.time(), 'seconds': seconds,
+                            'memory_mb': round(memory)})
+        took = f' in {seconds:.1f} s' if seconds is not None else ''
+        console_logger.info(f"AI model {name} {'loaded' if event == 'load' else 'evicted'}{took} "
+                            f"(process {os.getpid()}, {memory:.0f} MB resident)")
+
+    def status(self):
+        """ returns the loaded models with their idle time, the recent load and evict events and the memory """
+        now = self.clock()
+        with self.lock:
+            models = {name: {'loaded': name in self.models, 'pinned': name in self.pinned,
+                             'idle_seconds': round(now - self.last_used[name], 1) if name in self.last_used else None}
+                      for name in self.loaders}
+            events = list(self.events)
+        return {'pid': os.getpid(), 'memory_mb': round(resident_memory()), 'idle_timeout': self.idle_timeout,
+                'models': models, 'events': events}
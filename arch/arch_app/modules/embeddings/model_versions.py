@@ -0,0 +1,34 @@
+"""
+Identifiers of the embedding models. The identifier of the image model is stored with every record embedding
+(RecordEmbedding.model_version), so that embeddings of different models are never compared and embeddings of a
+previous model are recognized as stale (see the regenerate_embeddings command).
+This module does not import the AI packages (torch, sentence-transformers).
+"""
+import os
+from django.conf import settings
+
+
+def get_model_path(model_name):
+    """ returns the local directory of a model (name on huggingface.co) """
+    return os.path.join(settings.BASE_DIR, 'arch_app/ai_models', model_name.split('/')[-1])
+
+
+def _model_version(model_name):
+    """
+    identifier of a model: name of its directory and the quantization flag, the runtime only matters for quantized
+    models (the ONNX and torch models compute the same embeddings without quantization)
+    """
+    quantization = ''
+    if settings.QUANTIZE_CLIP_MODELS:
+        quantization = '-onnx-qint8' if settings.CLIP_BACKEND == 'onnx' else '-qint8'
+    return f"{os.path.basename(get_model_path(model_name))}{quantization}"
+
+
+def get_image_model_version():
+    """ returns an identifier of the image model, which changes if another model or quantization is used """
+    return _model_version(settings.IMAGE_EMBEDDING_MODEL)
+
+
+def get_text_model_version():
+    """ returns an identifier of the text model, which changes if another model or quantization is used """
+    return _model_version(settings.TEXT_EMBEDDING_MODEL)
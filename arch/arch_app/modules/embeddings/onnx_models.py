@@ -0,0 +1,174 @@
+"""
+ONNX Runtime backend of the CLIP models (settings.CLIP_BACKEND = 'onnx'), which runs the models on the CPU without
+torch. The models are exported from the sentence-transformers models once (export_onnx_models, requires torch and
+sentence-transformers), int8 quantized copies are created if settings.QUANTIZE_CLIP_MODELS is set.
+The encoders have the encode method of SentenceTransformer, so they can replace the torch models.
+"""
+import os
+import numpy as np
+from django.conf import settings
+from PIL import Image
+from .model_versions import get_model_path
+
+# preprocessing of the images of the OpenAI CLIP models (as computed by CLIPProcessor)
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+# ONNX operator set used for the export
+OPSET_VERSION = 14
+
+
+def get_onnx_path(model_name, quantized=False):
+    """ returns the path of the exported (or quantized) ONNX file of a model """
+    return os.path.join(get_model_path(model_name) + '-onnx', 'model-int8.onnx' if quantized else 'model.onnx')
+
+
+def preprocess_images(images):
+    """
+    Resizes (shortest side), center crops and normalizes images for the CLIP image model.
+    :param images: list of PIL images
+    returns array of the pixel values (batch, 3, 224, 224)
+    """
+    pixels = np.empty((len(images), 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE), dtype=np.float32)
+    for index, img in enumerate(images):
+        scale = CLIP_IMAGE_SIZE / min(img.size)
+        width = max(CLIP_IMAGE_SIZE, round(img.width * scale))
+        height = max(CLIP_IMAGE_SIZE, round(img.height * scale))
+        resized = img.convert('RGB').resize((width, height), Image.BICUBIC)
+        left, top = (width - CLIP_IMAGE_SIZE) // 2, (height - CLIP_IMAGE_SIZE) // 2
+        cropped = resized.crop((left, top, left + CLIP_IMAGE_SIZE, top + CLIP_IMAGE_SIZE))
+        pixels[index] = ((np.asarray(cropped, dtype=np.float32) / 255 - CLIP_MEAN) / CLIP_STD).transpose(2, 0, 1)
+    return pixels
+
+
+def _create_session(path):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+class OnnxImageEncoder:
+    """ CLIP image model in ONNX Runtime """
+
+    def __init__(self, path):
+        self.session = _create_session(path)
+
+    def encode(self, images, batch_size=32, show_progress_bar=False):
+        """ returns the embedding of an image or the embeddings (one row per image) of a list of PIL images """
+        single = isinstance(images, Image.Image)
+        images = [images] if single else list(images)
+        embeddings = np.concatenate(
+            [self.session.run(None, {'pixel_values': preprocess_images(images[start:start + batch_size])})[0]
+             for start in range(0, len(images), batch_size)]) if images else np.empty((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+class OnnxTextEncoder:
+    """ multilingual CLIP text model in ONNX Runtime, the tokenizer is stored next to the model """
+
+    def __init__(self, path):
+        from transformers import AutoTokenizer
+        self.session = _create_session(path)
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(path))
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False):
+        """ returns the embedding of a text or the embeddings (one row per text) of a list of texts """
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            tokens = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True,
+                                    return_tensors='np')
+            embeddings.append(self.session.run(None, {
+                'input_ids': tokens['input_ids'].astype(np.int64),
+                'attention_mask': tokens['attention_mask'].astype(np.int64),
+            })[0])
+        embeddings = np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def load_onnx_image_model(quantize):
+    """
+    Load the ONNX image model, the models have to be exported before (manage.py export_onnx_models).
+    :param quantize: use the int8 quantized model
+    """
+    return OnnxImageEncoder(_exported_path(settings.IMAGE_EMBEDDING_MODEL, quantize))
+
+
+def load_onnx_text_model(quantize):
+    """
+    Load the ONNX text model, the models have to be exported before (manage.py export_onnx_models).
+    :param quantize: use the int8 quantized model
+    """
+    return OnnxTextEncoder(_exported_path(settings.TEXT_EMBEDDING_MODEL, quantize))
+
+
+def _exported_path(model_name, quantize):
+    """ returns the path of an exported model, the export (with torch) is not run in the web and worker processes """
+    path = get_onnx_path(model_name, quantize)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The ONNX model {path} does not exist, export the models with "
+                                f"'python manage.py export_onnx_models'"
+                                + ("" if quantize else " (or set QUANTIZE_CLIP_MODELS)"))
+    return path
+
+
+def export_onnx_models(quantize):
+    """
+    Export the sentence-transformers models (without quantization) to ONNX files and quantize them to int8.
+    :param quantize: also create the int8 quantized models
+    returns list of the created files
+    """
+    import torch
+    from .text_image_embedding import load_image_model, load_text_model
+
+    image_model = load_image_model('torch', quantize=False)
+    text_model = load_text_model('torch', quantize=False)
+
+    class ImageEncoder(torch.nn.Module):
+        def __init__(self, clip_model):
+            super().__init__()
+            self.clip_model = clip_model
+
+        def forward(self, pixel_values):
+            return self.clip_model.get_image_features(pixel_values=pixel_values)
+
+    class TextEncoder(torch.nn.Module):
+        def __init__(self, sentence_transformer):
+            super().__init__()
+            self.sentence_transformer = sentence_transformer
+
+        def forward(self, input_ids, attention_mask):
+            features = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            return self.sentence_transformer(features)['sentence_embedding']
+
+    image_path = get_onnx_path(settings.IMAGE_EMBEDDING_MODEL)
+    text_path = get_onnx_path(settings.TEXT_EMBEDDING_MODEL)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    os.makedirs(os.path.dirname(text_path), exist_ok=True)
+    with torch.no_grad():
+        # the first module of the image model wraps the transformers CLIPModel
+        torch.onnx.export(ImageEncoder(image_model[0].model).eval(),
+                          (torch.zeros(1, 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE),), image_path,
+                          input_names=['pixel_values'], output_names=['embeddings'],
+                          dynamic_axes={'pixel_values': {0: 'batch'}, 'embeddings': {0: 'batch'}},
+                          opset_version=OPSET_VERSION)
+        tokens = text_model.tokenizer(['an example text'], return_tensors='pt')
+        torch.onnx.export(TextEncoder(text_model).eval(), (tokens['input_ids'], tokens['attention_mask']), text_path,
+                          input_names=['input_ids', 'attention_mask'], output_names=['embeddings'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'embeddings': {0: 'batch'}},
+                          opset_version=OPSET_VERSION)
+    # the tokenizer truncates the texts like the sentence-transformers model
+    text_model.tokenizer.model_max_length = text_model.max_seq_length
+    text_model.tokenizer.save_pretrained(os.path.dirname(text_path))
+    files = [image_path, text_path]
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        for model_name in (settings.IMAGE_EMBEDDING_MODEL, settings.TEXT_EMBEDDING_MODEL):
+            quantized_path = get_onnx_path(model_name, quantized=True)
+            quantize_dynamic(get_onnx_path(model_name), quantized_path, weight_type=QuantType.QInt8)
+            files.append(quantized_path)
+    return files
@@ -1,42 +1,83 @@
 """
 
 """
-import os
-from sentence_transformers import SentenceTransformer
+import time
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from PIL import Image, UnidentifiedImageError
+from PIL import UnidentifiedImageError
+from .embedding_cache import EmbeddingCache, normalize_query
+from .model_registry import ModelRegistry
+from .model_versions import get_model_path, get_text_model_version
+from .onnx_models import CLIP_IMAGE_SIZE
+from ..computer_vision.image_loading import load_image
+from ..inference import client as inference_client
 
-# global variables
-img_model = None
-text_model = None
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# the models are loaded on their first use and evicted when they are idle (see model_registry)
+ai_models = ModelRegistry(idle_timeout=settings.AI_MODEL_IDLE_TIMEOUT)
+text_embedding_cache = EmbeddingCache(max_size=settings.TEXT_EMBEDDING_CACHE_SIZE,
+                                      shared_cache=settings.TEXT_EMBEDDING_SHARED_CACHE)
 
 
 def init_ai_models():
     """
-    Load the AI models for image and text embeddings.
+    Load the AI models for image and text embeddings and keep them loaded (qcluster workers, inference server).
+    """
+    console_logger.info("load AI models ...")
+    ai_models.get('image', pin=True)
+    ai_models.get('text', pin=True)
+
+
+def load_clip_models(backend, quantize):
+    """
+    Load the image and the text model.
+    :param backend: 'torch' (sentence-transformers) or 'onnx' (ONNX Runtime, see onnx_models)
+    :param quantize: quantize the models to int8
+    returns tuple (image model, text model)
     """
-    # get directory from settings
-    global img_model, text_model
-    img_model_path = os.path.join(settings.BASE_DIR, 'arch_app/ai_models/clip-ViT-B-32')
-    text_model_path = os.path.join(settings.BASE_DIR, 'arch_app/ai_models/clip-ViT-B-32-multilingual-v1')
-    print("load AI models ...")
+    return load_image_model(backend, quantize), load_text_model(backend, quantize)
+
+
+def load_image_model(backend, quantize):
+    """ Load the image model, the parameters are those of load_clip_models. """
+    if backend == 'onnx':
+        from .onnx_models import load_onnx_image_model
+        return load_onnx_image_model(quantize)
+    return _load_sentence_transformer(settings.IMAGE_EMBEDDING_MODEL, quantize)
+
+
+def load_text_model(backend, quantize):
+    """ Load the text model, the parameters are those of load_clip_models. """
+    if backend == 'onnx':
+        from .onnx_models import load_onnx_text_model
+        return load_onnx_text_model(quantize)
+    return _load_sentence_transformer(settings.TEXT_EMBEDDING_MODEL, quantize)
+
+
+def _load_sentence_transformer(model_name, quantize):
+    """ loads a sentence-transformers model from the model directory, it is downloaded on the first use """
+    from sentence_transformers import SentenceTransformer
+    model_path = get_model_path(model_name)
     try:
-        img_model = SentenceTransformer(img_model_path, local_files_only=True)
-        text_model = SentenceTransformer(text_model_path, local_files_only=True)
-        print('AI search models loaded locally')
+        model = SentenceTransformer(model_path, local_files_only=True)
+        console_logger.info(f'AI model {model_name} loaded locally')
     except ValueError:
-        img_model = SentenceTransformer('clip-ViT-B-32')
-        img_model.save(img_model_path)
-        text_model = SentenceTransformer('sentence-transformers/clip-ViT-B-32-multilingual-v1')
-        text_model.save(text_model_path)
-        print('AI search models loaded from huggingface.co')
-    # Quantize the models
-    if settings.QUANTIZE_CLIP_MODELS:
+        model = SentenceTransformer(model_name)
+        model.save(model_path)
+        console_logger.info(f'AI model {model_name} loaded from huggingface.co')
+    # Quantize the model
+    if quantize:
         from torch.quantization import quantize_dynamic
         import torch
         import torch.nn as nn
-        img_model = quantize_dynamic(img_model, {nn.Linear}, dtype=torch.qint8)
-        text_model = quantize_dynamic(text_model, {nn.Linear}, dtype=torch.qint8)
+        model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+ai_models.register('image', lambda: load_image_model(settings.CLIP_BACKEND, settings.QUANTIZE_CLIP_MODELS))
+ai_models.register('text', lambda: load_text_model(settings.CLIP_BACKEND, settings.QUANTIZE_CLIP_MODELS))
 
 
 def generate_image_embedding(image_path):
@@ -44,15 +85,73 @@ def generate_image_embedding(image_path):
     :param image_path: path to the image
     returns image embedding or False
     """
-    if img_model is None:
-        init_ai_models()
+    return generate_image_embeddings([image_path])[0]
+
+
+def generate_image_embeddings(image_paths, batch_size=None, workers=None):
+    """
+    Generate the embeddings of many images. The images are decoded in a thread pool while the image model
+    encodes the previous batch.
+    :param image_paths: paths to the images
+    :param batch_size: number of images encoded at once, defaults to settings.IMAGE_EMBEDDING_BATCH_SIZE
+    :param workers: number of decoding threads, defaults to settings.IMAGE_DECODE_WORKERS
+    returns list of image embeddings in the order of the paths, False for files which could not be embedded
+    """
+    if settings.INFERENCE_SOCKET:
+        try:
+            return inference_client.embed_images(image_paths)
+        except inference_client.InferenceError as error:
+            console_logger.error(f"{error}, the images are embedded in this process")
+    return embed_images(image_paths, batch_size, workers)
+
+
+def embed_images(image_paths, batch_size=None, workers=None):
+    """ Generate the embeddings of many images with the image model of this process (see generate_image_embeddings) """
+    img_model = ai_models.get('image')
+    batch_size = batch_size or settings.IMAGE_EMBEDDING_BATCH_SIZE
+    batches = [image_paths[start:start + batch_size] for start in range(0, len(image_paths), batch_size)]
+    embeddings = []
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers or settings.IMAGE_DECODE_WORKERS) as executor:
+        # decode the first batch, then always one batch ahead of the encoder
+        decoding = executor.map(_load_image, batches[0]) if batches else None
+        for index in range(len(batches)):
+            images = list(decoding)
+            if index + 1 < len(batches):
+                decoding = executor.map(_load_image, batches[index + 1])
+            embeddings.extend(_encode_images(img_model, images))
+    if len(image_paths) > 1:
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        console_logger.info(f"Embedded {len(image_paths)} images ({len(image_paths) / elapsed:.1f} images/s)")
+    return embeddings
+
+
+def _load_image(image_path):
+    """ decodes an image at the input size of the image model, returns None if the file cannot be read """
     try:
-        img = Image.open(image_path)
-    except UnidentifiedImageError:
-        return False
-    img_emb = img_model.encode(img, show_progress_bar=True)
-    img.close()
-    return img_emb
+        return load_image(image_path, CLIP_IMAGE_SIZE, side='short')[0]
+    except (UnidentifiedImageError, OSError) as error:
+        console_logger.error(f"Error while decoding image {image_path}: {error}")
+        return None
+
+
+def _encode_images(img_model, images):
+    """ encodes a batch of decoded images, returns an embedding or False per image """
+    valid = [img for img in images if img is not None]
+    try:
+        encoded = list(img_model.encode(valid, batch_size=len(valid), show_progress_bar=False)) if valid else []
+    except Exception as error:
+        if len(valid) == 1:
+            console_logger.error(f"Error while encoding an image: {error}")
+            encoded = [False]
+        else:
+            # isolate the image which cannot be encoded
+            encoded = [embedding for img in valid for embedding in _encode_images(img_model, [img])]
+    encoded = iter(encoded)
+    embeddings = [False if img is None else next(encoded) for img in images]
+    for img in valid:
+        img.close()
+    return embeddings
 
 
 def generate_text_embedding(sentences):
@@ -60,7 +159,25 @@ def generate_text_embedding(sentences):
     Encode a text query:
     :param sentences: string
     """
-    if text_model is None:
-        init_ai_models()
-    text_emb = text_model.encode(sentences)
-    return text_emb
+    return text_embedding_cache.get_or_compute(get_text_model_version(), normalize_query(sentences), encode_text)
+
+
+def encode_text(sentences):
+    """
+    Encode a text with the text model (without cache)
+    :param sentences: string
+    """
+    if settings.INFERENCE_SOCKET:
+        try:
+            return inference_client.embed_texts([sentences])[0]
+        except inference_client.InferenceError as error:
+            console_logger.error(f"{error}, the text is embedded in this process")
+    return encode_texts([sentences])[0]
+
+
+def encode_texts(texts):
+    """
+    Encode texts with the text model of this process
+    :param texts: list of strings
+    """
+    return list(ai_models.get('text').encode(texts))
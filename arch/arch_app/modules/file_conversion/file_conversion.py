@@ -3,8 +3,8 @@ module for converting media files to browser compatible formats
 """
 import os
 from pathlib import Path
-from ffmpeg import FFmpeg
 from arch_app.models import Record
+from arch_app.modules.computer_vision.preview_rendering import render_preview
 
 import logging
 console_logger = logging.getLogger('ARCH_console_logger')
@@ -18,6 +18,7 @@ def convert_file(source: Path, target: Path) -> Path:
     :param target: path to the target file
     :return: path to the converted file
     """
+    from ffmpeg import FFmpeg
     try:
         FFmpeg().input(source).output(target).execute()
         return target
@@ -48,10 +49,8 @@ def generate_preview(record: Record, file_extension: str, subtype) -> Path | Non
                 if file_extension in audio_formats_to_convert:
                     target = os.path.splitext(record.media_file.path)[0].replace(record.title, "preview.mp3")
                     return convert_file(source=record.media_file.path, target=target)
-            case 'Image':  # save original image as preview
-                with open(record.media_file.path, 'rb') as media_file:
-                    record.preview_file.save(f"preview.{file_extension}", media_file, save=True)
-                    return record.preview_file.path
+            case 'Image':  # the original image with the hidden faces blurred (see preview_rendering)
+                return render_preview(record)
             case _:  # no preview for other types, e.g. text documents, so return True
                 return None
         return None
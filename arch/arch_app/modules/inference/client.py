@@ -0,0 +1,48 @@
+"""
+Client of the local inference server (see server.py), used by the embedding and face detection modules if
+settings.INFERENCE_SOCKET is set. Every request opens a new connection, so the client can be used by any number of
+threads and processes.
+"""
+import socket
+from django.conf import settings
+from .protocol import send_message, receive_message, decode_embeddings
+
+
+class InferenceError(Exception):
+    """ The inference server is not reachable or could not answer a request """
+
+
+def request(header):
+    """ sends a request to the inference server and returns the header and payload of the response """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(settings.INFERENCE_TIMEOUT)
+            sock.connect(settings.INFERENCE_SOCKET)
+            send_message(sock, header)
+            response, payload = receive_message(sock)
+    except OSError as error:
+        raise InferenceError(f'inference server at {settings.INFERENCE_SOCKET} not available: {error}') from error
+    if 'error' in response:
+        raise InferenceError(response['error'])
+    return response, payload
+
+
+def embed_texts(texts):
+    """ returns the embeddings of texts """
+    return decode_embeddings(*request({'op': 'embed_texts', 'texts': list(texts)}))
+
+
+def embed_images(image_paths):
+    """ returns the embeddings of images, False for files which could not be embedded """
+    return decode_embeddings(*request({'op': 'embed_images', 'paths': [str(path) for path in image_paths]}))
+
+
+def detect_faces(image_path):
+    """ returns the face boxes (x1, y1, x2, y2) of an image """
+    response, _payload = request({'op': 'detect_faces', 'path': str(image_path)})
+    return [tuple(face) for face in response['faces']]
+
+
+def status():
+    """ returns the number of requests and batches per kind of request """
+    return request({'op': 'status'})[0]
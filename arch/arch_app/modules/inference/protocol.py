@@ -0,0 +1,54 @@
+"""
+Messages between the inference server and its clients (see server.py): a 4 byte length, a JSON header and an
+optional binary payload (e.g. the bytes of an embedding matrix) whose size is given in the header.
+"""
+import json
+import struct
+import numpy as np
+
+
+def send_message(sock, header, payload=b''):
+    """ sends a header (dictionary) and a binary payload """
+    header = json.dumps(dict(header, payload_size=len(payload))).encode()
+    sock.sendall(struct.pack('!I', len(header)) + header + payload)
+
+
+def receive_message(sock):
+    """ returns the header and the payload of the next message, raises ConnectionError if the socket is closed """
+    size, = struct.unpack('!I', _receive(sock, 4))
+    header = json.loads(_receive(sock, size))
+    payload = _receive(sock, header.pop('payload_size'))
+    return header, payload
+
+
+def _receive(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def encode_embeddings(embeddings):
+    """
+    returns the header fields and the payload of a list of embeddings, False (failed) entries are sent as rows of
+    zeros and listed in 'failed'
+    """
+    failed = [index for index, embedding in enumerate(embeddings) if embedding is False]
+    rows = [embedding for embedding in embeddings if embedding is not False]
+    dimension = len(rows[0]) if rows else 0
+    matrix = np.zeros((len(embeddings), dimension), dtype=np.float32)
+    for index, embedding in enumerate(embeddings):
+        if embedding is not False:
+            matrix[index] = embedding
+    return {'shape': list(matrix.shape), 'failed': failed}, matrix.tobytes()
+
+
+def decode_embeddings(header, payload):
+    """ returns the list of embeddings (numpy arrays or False) of a message created with encode_embeddings """
+    matrix = np.frombuffer(payload, dtype=np.float32).reshape(header['shape'])
+    failed = set(header['failed'])
+    return [False if index in failed else matrix[index] for index in range(len(matrix))]
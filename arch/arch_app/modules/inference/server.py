@@ -0,0 +1,132 @@
+"""
+Local inference server (manage.py run_inference_server), which hosts the AI models once per host instead of once per
+web and qcluster process. The processes send their requests over a Unix socket (settings.INFERENCE_SOCKET, see
+client.py), concurrent requests of the same kind are combined into one batch of the model.
+
+Requests (JSON header, see protocol.py):
+    {'op': 'embed_texts', 'texts': [...]}       returns the text embeddings
+    {'op': 'embed_images', 'paths': [...]}      returns the image embeddings, failed images are listed in 'failed'
+    {'op': 'detect_faces', 'path': ...}         returns the face boxes {'faces': [[x1, y1, x2, y2], ...]}
+    {'op': 'status'}                            returns the number of requests and batches per kind
+"""
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from .protocol import send_message, receive_message, encode_embeddings
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+
+class MicroBatcher:
+    """ Collects concurrent requests of one kind and processes them with one call of a batch function """
+
+    def __init__(self, function, max_batch_size, max_wait):
+        """
+        :param function: batch function, returns a list of results for a list of items
+        :param max_batch_size: number of items after which a batch is processed without waiting for more requests
+        :param max_wait: seconds to wait for further requests after the first request of a batch
+        """
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items):
+        """ returns the results of the items when their batch was processed """
+        future = Future()
+        self._queue.put((list(items), future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                requests.append(request)
+                size += len(request[0])
+            self.requests += len(requests)
+            self.batches += 1
+            items = [item for request_items, _future in requests for item in request_items]
+            try:
+                results = self.function(items)
+            except Exception as error:
+                console_logger.error(f"Inference server: batch of {len(items)} items failed: {error}")
+                for _items, future in requests:
+                    future.set_exception(error)
+                continue
+            start = 0
+            for request_items, future in requests:
+                future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+
+class InferenceRequestHandler(socketserver.BaseRequestHandler):
+    """ Answers one request of a connection """
+
+    def handle(self):
+        try:
+            header, _payload = receive_message(self.request)
+        except (ConnectionError, ValueError):
+            return
+        try:
+            response = self.server.dispatch(header)
+        except Exception as error:
+            response = {'error': str(error)}, b''
+        send_message(self.request, *response)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Unix socket server answering each connection in a thread, the models are only used by the batchers """
+    daemon_threads = True
+
+    def __init__(self, socket_path, embed_texts, embed_images, detect_faces, max_batch_size=16, max_wait=0.005):
+        """
+        :param socket_path: path of the Unix socket, an existing socket file is replaced
+        :param embed_texts: batch function for text embeddings
+        :param embed_images: batch function for image embeddings (False for images which cannot be embedded)
+        :param detect_faces: batch function returning the face boxes per image
+        :param max_batch_size: maximum number of items combined into one batch
+        :param max_wait: seconds to wait for concurrent requests
+        """
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, InferenceRequestHandler)
+        # only processes of the same user or group may connect
+        os.chmod(socket_path, 0o660)
+        self.batchers = {
+            'embed_texts': MicroBatcher(embed_texts, max_batch_size, max_wait),
+            'embed_images': MicroBatcher(embed_images, max_batch_size, max_wait),
+            'detect_faces': MicroBatcher(detect_faces, max_batch_size, max_wait),
+        }
+
+    def dispatch(self, header):
+        """ returns the response (header, payload) to a request """
+        operation = header.get('op')
+        if operation == 'embed_texts':
+            return encode_embeddings(self.batchers[operation].submit(header['texts']))
+        if operation == 'embed_images':
+            return encode_embeddings(self.batchers[operation].submit(header['paths']))
+        if operation == 'detect_faces':
+            faces = self.batchers[operation].submit([header['path']])[0]
+            return {'faces': [[int(value) for value in face] for face in faces]}, b''
+        if operation == 'status':
+            return {name: {'requests': batcher.requests, 'batches': batcher.batches}
+                    for name, batcher in self.batchers.items()}, b''
+        raise ValueError(f'unknown operation {operation}')
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
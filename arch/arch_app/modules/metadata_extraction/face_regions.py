@@ -0,0 +1,141 @@
+"""
+Extraction of the face regions stored in the XMP metadata of images by cameras, phones and photo management software
+(e.g. Lightroom, Picasa, digiKam, Windows Photo Gallery), so that no face detection is needed for these images.
+
+Supported are the regions of the Metadata Working Group (mwg-rs:Regions, areas given by their center, width and
+height) and of Microsoft (MP:RegionInfo, rectangles given by their top left corner, width and height), both with
+coordinates normalized to the size of the image.
+"""
+import io
+import xml.etree.ElementTree as ElementTree
+from PIL import Image, UnidentifiedImageError
+from ..computer_vision.image_loading import TRANSPOSED_ORIENTATIONS, EXIF_ORIENTATION
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+NAMESPACES = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'mwg-rs': 'http://www.metadataworkinggroup.com/schemas/regions/',
+    'stArea': 'http://ns.adobe.com/xmp/sType/Area#',
+    'stDim': 'http://ns.adobe.com/xap/1.0/sType/Dimensions#',
+    'MP': 'http://ns.microsoft.com/photo/1.2/',
+    'MPRI': 'http://ns.microsoft.com/photo/1.2/t/RegionInfo#',
+    'MPReg': 'http://ns.microsoft.com/photo/1.2/t/Region#',
+}
+
+
+def extract_face_regions(file_read):
+    """
+    Reads the face regions of an image from its XMP metadata.
+    :param file_read: content of the image file
+    returns tuple (size (width, height) of the displayed image, list of face boxes (x1, y1, x2, y2) in pixels of the
+    displayed image), the list is empty if the image has no face regions
+    """
+    packet = _xmp_packet(file_read)
+    if packet is None:
+        return None, []
+    try:
+        root = ElementTree.fromstring(packet)
+        with Image.open(io.BytesIO(file_read)) as img:
+            stored_size = img.size
+            orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    except (ElementTree.ParseError, UnidentifiedImageError, OSError) as error:
+        console_logger.error(f'Error extracting face regions: {error}')
+        return None, []
+    transposed = orientation in TRANSPOSED_ORIENTATIONS
+    width, height = (stored_size[1], stored_size[0]) if transposed else stored_size
+
+    regions = _mwg_regions(root, stored_size, orientation) + _microsoft_regions(root)
+    boxes = []
+    for x1, y1, x2, y2 in regions:
+        x1, y1, x2, y2 = (max(0.0, min(1.0, value)) for value in (x1, y1, x2, y2))
+        if x2 > x1 and y2 > y1:
+            boxes.append((round(x1 * width), round(y1 * height), round(x2 * width), round(y2 * height)))
+    return (width, height), boxes
+
+
+def _xmp_packet(file_read):
+    """ returns the XMP packet of an image file (JPEG, PNG, TIFF, WebP or HEIC) or None """
+    start = file_read.find(b'<x:xmpmeta')
+    if start < 0:
+        return None
+    end = file_read.find(b'</x:xmpmeta>', start)
+    if end < 0:
+        return None
+    return file_read[start:end + len(b'</x:xmpmeta>')]
+
+
+def _value(element, name):
+    """ returns a property of an element, stored as attribute or as child element """
+    prefix, local = name.split(':')
+    qualified = f'{{{NAMESPACES[prefix]}}}{local}'
+    if qualified in element.attrib:
+        return element.attrib[qualified]
+    child = element.find(name, NAMESPACES)
+    return child.text if child is not None else None
+
+
+def _mwg_regions(root, stored_size, orientation):
+    """ returns the normalized boxes of the MWG face regions in the displayed image """
+    boxes = []
+    for regions in root.iterfind('.//mwg-rs:Regions', NAMESPACES):
+        # the regions refer to the displayed image, unless their dimensions show that they refer to the stored
+        # image of a rotated photo (written by some applications)
+        dimensions = regions.find('mwg-rs:AppliedToDimensions', NAMESPACES)
+        applied_to_stored = False
+        if dimensions is not None and orientation in TRANSPOSED_ORIENTATIONS and stored_size[0] != stored_size[1]:
+            try:
+                applied_width = float(_value(dimensions, 'stDim:w'))
+                applied_height = float(_value(dimensions, 'stDim:h'))
+                applied_to_stored = (applied_width > applied_height) == (stored_size[0] > stored_size[1])
+            except (TypeError, ValueError):
+                pass
+        for region in regions.iterfind('mwg-rs:RegionList/rdf:Bag/rdf:li', NAMESPACES):
+            description = region.find('rdf:Description', NAMESPACES)
+            region = description if description is not None else region
+            if (_value(region, 'mwg-rs:Type') or 'Face') != 'Face':
+                continue
+            area = region.find('mwg-rs:Area', NAMESPACES)
+            if area is None:
+                continue
+            try:
+                x, y, w, h = (float(_value(area, f'stArea:{name}')) for name in ('x', 'y', 'w', 'h'))
+            except (TypeError, ValueError):
+                continue
+            box = (x - w / 2, y - h / 2, x + w / 2, y + h / 2)
+            if applied_to_stored:
+                box = _orient_box(box, orientation)
+            boxes.append(box)
+    return boxes
+
+
+def _microsoft_regions(root):
+    """ returns the normalized boxes of the Microsoft face regions (which refer to the displayed image) """
+    boxes = []
+    for region in root.iterfind('.//MPRI:Regions/rdf:Bag/rdf:li', NAMESPACES):
+        description = region.find('rdf:Description', NAMESPACES)
+        rectangle = _value(description if description is not None else region, 'MPReg:Rectangle')
+        try:
+            x, y, w, h = (float(value) for value in rectangle.split(','))
+        except (AttributeError, ValueError):
+            continue
+        boxes.append((x, y, x + w, y + h))
+    return boxes
+
+
+def _orient_box(box, orientation):
+    """ converts a normalized box of the stored image to the image displayed according to the EXIF orientation """
+    transforms = {
+        2: lambda u, v: (1 - u, v),
+        3: lambda u, v: (1 - u, 1 - v),
+        4: lambda u, v: (u, 1 - v),
+        5: lambda u, v: (v, u),
+        6: lambda u, v: (1 - v, u),
+        7: lambda u, v: (1 - v, 1 - u),
+        8: lambda u, v: (v, 1 - u),
+    }
+    if orientation not in transforms:
+        return box
+    (u1, v1), (u2, v2) = transforms[orientation](box[0], box[1]), transforms[orientation](box[2], box[3])
+    return min(u1, u2), min(v1, v2), max(u1, u2), max(v1, v2)
@@ -2,8 +2,6 @@ import exifread
 from exifread.heic import NoParser
 import magic  # https://pypi.org/project/python-magic/')
 # install libmagic: sudo apt-get install libmagic1
-import reverse_geocoder as rg  # https://pypi.org/project/reverse_geocoder/
-# Reverse Geocoding uses data from the GeoNames geographical database (https://www.geonames.org/ )
 from datetime import datetime
 
 import logging
@@ -41,6 +39,9 @@ def extract_metadata(f):
         coordinates = (convert_to_degrees(latitude_tag),
                        convert_to_degrees(longitude_tag))
         # latitudes and longitudes are reverse geocoded to determine City, State, and Country.
+        # Reverse Geocoding uses data from the GeoNames geographical database (https://www.geonames.org/ ),
+        # reverse_geocoder is imported on first use as it loads scipy (https://pypi.org/project/reverse_geocoder/)
+        import reverse_geocoder as rg
         results = rg.search(coordinates, mode=1)  # mode 1 is for Single-threaded K-D Tree processing
         metadata['location'] = results[0]
     elif 'QuickTime:Location' in tags.keys():
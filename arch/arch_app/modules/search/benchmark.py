@@ -0,0 +1,300 @@
+"""
+Benchmark of the search: generates a synthetic archive and replays a mix of search and autocomplete requests.
+
+The synthetic records are inserted in bulk (bypassing the signal handlers), hence the groups, permissions, tags,
+search vectors, the record visibility and the autocomplete suggestions are created here the same way the handlers
+would create them.
+"""
+import random
+import resource
+import time
+import tracemalloc
+import uuid
+import datetime
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, reset_queries, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from arch_app.models import Archive, Album, Membership, User, Location, Record, Tag, Comment, RecordVisibility, \
+    AutocompleteSuggestion, RecordEmbedding
+from arch_app.modules.embeddings.model_versions import get_image_model_version
+from .full_text import update_search_vectors
+from . import mmap_index
+from .helpers import SearchMixin
+from .vector_index import vector_search_scope
+
+ARCHIVE_PREFIX = 'Benchmark Archive'
+USER_PREFIX = 'benchmark_user_'
+
+WORDS = [
+    'beach', 'birthday', 'bridge', 'camp', 'castle', 'celebration', 'children', 'choir', 'church', 'city', 'concert',
+    'dinner', 'dog', 'excursion', 'family', 'farm', 'festival', 'football', 'forest', 'friends', 'garden', 'graduation',
+    'harbour', 'hiking', 'holiday', 'house', 'kitchen', 'lake', 'market', 'meeting', 'mountain', 'museum', 'music',
+    'parade', 'party', 'picnic', 'portrait', 'river', 'school', 'snow', 'station', 'street', 'summer', 'swimming',
+    'theatre', 'tower', 'train', 'village', 'wedding', 'winter', 'Bahnhof', 'Garten', 'Hafen', 'Hochzeit', 'Häuser',
+    'Kirche', 'Schule', 'Sommerfest', 'Strand', 'Wanderung',
+]
+PLACES = [
+    ('Osnabrück', 'Germany', 'Lower Saxony', 'Osnabrück'), ('Bremen', 'Germany', 'Bremen', 'Bremen'),
+    ('Hamburg', 'Germany', 'Hamburg', 'Hamburg'), ('Münster', 'Germany', 'North Rhine-Westphalia', 'Münster'),
+    ('Aberdeen', 'United Kingdom', 'Scotland', 'Aberdeenshire'), ('London', 'United Kingdom', 'England', 'London'),
+    ('Amsterdam', 'Netherlands', 'North Holland', 'Amsterdam'), ('Lyon', 'France', 'Auvergne-Rhône-Alpes', 'Rhône'),
+]
+FIRST_NAMES = ['Anna', 'Ben', 'Clara', 'David', 'Emma', 'Felix', 'Greta', 'Hannah', 'Jonas', 'Lena', 'Max', 'Mia',
+               'Noah', 'Paul', 'Sophie', 'Tom']
+LAST_NAMES = ['Becker', 'Fischer', 'Hoffmann', 'Klein', 'Meyer', 'Müller', 'Schmidt', 'Schneider', 'Wagner', 'Weber']
+
+
+def delete_benchmark_data():
+    """ deletes the archives, records and users created by generate_archive """
+    # records and memberships first, their signal handlers need the record or archive
+    Record.objects.filter(album__archive__name__startswith=ARCHIVE_PREFIX).delete()
+    Membership.objects.filter(archive__name__startswith=ARCHIVE_PREFIX).delete()
+    if settings.VECTOR_SEARCH_BACKEND == 'mmap':
+        for archive_id in Archive.objects.filter(name__startswith=ARCHIVE_PREFIX).values_list('pk', flat=True):
+            mmap_index.get_index().remove(archive_id)
+    Archive.objects.filter(name__startswith=ARCHIVE_PREFIX).delete()
+    User.objects.filter(username__startswith=USER_PREFIX).delete()
+
+
+def generate_archive(num_records, num_archives=2, num_users=50, embeddings=True, seed=0, batch_size=5000, log=None):
+    """
+    Generates a synthetic corpus of records with locations, tags, comments, embeddings and guardian permissions.
+    :param num_records: number of records (spread over the archives)
+    :param num_archives: number of archives
+    :param num_users: number of users (spread over the archives, the first user of each archive is a moderator)
+    :param embeddings: generate random image embeddings
+    :param seed: seed of the random generators
+    :param batch_size: number of records inserted per batch
+    :param log: function to report the progress, e.g. print
+    """
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    archives = [Archive.objects.create(name=f'{ARCHIVE_PREFIX} {i}', institution_name='Benchmark')
+                for i in range(num_archives)]
+    users = User.objects.bulk_create([
+        User(username=f'{USER_PREFIX}{i}', first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES),
+             password=make_password(None))
+        for i in range(num_users)])
+    archive_users = {archive.id: [] for archive in archives}
+    for i, user in enumerate(users):
+        archive = archives[i % num_archives]
+        role = 'moderator' if i < num_archives else 'member'
+        Membership.objects.create(user=user, archive=archive, role=role)
+        archive_users[archive.id].append(user)
+    archive_albums = {archive.id: [archive.inbox] + [
+        Album.objects.create(title=f'{rng.choice(WORDS)} {i}', archive=archive, creator=archive_users[archive.id][0])
+        for i in range(5)] for archive in archives}
+
+    content_type = ContentType.objects.get_for_model(Record)
+    permissions = {codename: Permission.objects.get(content_type=content_type, codename=codename)
+                   for codename in ['view_record', 'change_record', 'delete_record']}
+    created = 0
+    while created < num_records:
+        size = min(batch_size, num_records - created)
+        with transaction.atomic():
+            _generate_batch(size, archives, archive_users, archive_albums, permissions, content_type,
+                            embeddings, rng, np_rng)
+        created += size
+        if log:
+            log(f'{created} / {num_records} records')
+    # update the planner statistics of the bulk inserted tables
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    return archives, users
+
+
+def _generate_batch(size, archives, archive_users, archive_albums, permissions, content_type, embeddings, rng,
+                    np_rng):
+    """ inserts one batch of records and everything the signal handlers would create for them """
+    records, locations, groups, vectors = [], [], [], {}
+    for _ in range(size):
+        archive = rng.choice(archives)
+        record_id = uuid.uuid4()
+        location = None
+        if rng.random() < 0.6:
+            name, country, state, region = rng.choice(PLACES)
+            location = Location(name=name, country=country, state=state, region=region)
+            locations.append(location)
+        group = Group(name=f"Record Group ({record_id})")
+        groups.append(group)
+        if embeddings:
+            vector = np_rng.standard_normal(settings.IMAGE_EMBEDDING_DIMENSIONS).astype(np.float32)
+            vectors[record_id] = vector / np.linalg.norm(vector)
+        records.append(Record(
+            id=record_id,
+            title=' '.join(rng.sample(WORDS, rng.randint(1, 3))),
+            type='Image',
+            album=rng.choice(archive_albums[archive.id]),
+            creator=rng.choice(archive_users[archive.id]),
+            user_caption=' '.join(rng.choices(WORDS, k=rng.randint(5, 25))) if rng.random() < 0.7 else None,
+            date_created=datetime.date(1950, 1, 1) + datetime.timedelta(days=rng.randint(0, 26000)),
+            language=rng.choice(['en', 'de', None]),
+            location=location,
+        ))
+    Location.objects.bulk_create(locations)
+    Group.objects.bulk_create(groups)
+    for record, group in zip(records, groups):
+        record.location_id = record.location.id if record.location else None
+        record.depicted_users = group
+    Record.objects.bulk_create(records)
+
+    # permissions as assigned by the upload view and the signal handlers
+    user_permissions, group_permissions = [], []
+    tags, comments, group_members = [], [], []
+    for record in records:
+        object_pk = str(record.id)
+        moderators = record.album.archive.moderators
+        for permission in permissions.values():
+            user_permissions.append(UserObjectPermission(user=record.creator, permission=permission,
+                                                         content_type=content_type, object_pk=object_pk))
+            group_permissions.append(GroupObjectPermission(group=moderators, permission=permission,
+                                                           content_type=content_type, object_pk=object_pk))
+        group_permissions.append(GroupObjectPermission(group=record.depicted_users,
+                                                       permission=permissions['view_record'],
+                                                       content_type=content_type, object_pk=object_pk))
+        if not record.album.is_inbox:
+            group_permissions.append(GroupObjectPermission(group=record.album.group,
+                                                           permission=permissions['view_record'],
+                                                           content_type=content_type, object_pk=object_pk))
+        members = archive_users[record.album.archive_id]
+        if rng.random() < 0.3:
+            for user in rng.sample(members, min(len(members), rng.randint(1, 2))):
+                tags.append(Tag(record=record, user=user))
+                group_members.append(User.groups.through(user_id=user.id, group_id=record.depicted_users_id))
+        if rng.random() < 0.2:
+            comments.append(Comment(record=record, user=rng.choice(members),
+                                    text=' '.join(rng.choices(WORDS, k=rng.randint(3, 12)))))
+    UserObjectPermission.objects.bulk_create(user_permissions, batch_size=5000)
+    GroupObjectPermission.objects.bulk_create(group_permissions, batch_size=5000)
+    Tag.objects.bulk_create(tags, batch_size=5000)
+    User.groups.through.objects.bulk_create(group_members, batch_size=5000, ignore_conflicts=True)
+    Comment.objects.bulk_create(comments, batch_size=5000)
+
+    record_ids = [record.id for record in records]
+    update_search_vectors(Record.objects.filter(pk__in=record_ids))
+    RecordVisibility.objects.refresh(record_ids=record_ids)
+    AutocompleteSuggestion.objects.update_records(record_ids)
+    if embeddings:
+        model_version = get_image_model_version()
+        RecordEmbedding.objects.bulk_create(
+            [RecordEmbedding(record_id=record_id, model_version=model_version, dtype=settings.EMBEDDING_DTYPE,
+                             vector=RecordEmbedding.encode(vector, settings.EMBEDDING_DTYPE))
+             for record_id, vector in vectors.items()], batch_size=5000)
+    if embeddings and settings.VECTOR_SEARCH_BACKEND == 'pgvector':
+        from arch_vector.models import RecordVector
+        RecordVector.objects.bulk_create([RecordVector(record_id=record.id, model_version=model_version,
+                                                       embedding=vectors[record.id].tolist())
+                                          for record in records], batch_size=5000)
+    if embeddings and settings.VECTOR_SEARCH_BACKEND == 'mmap':
+        archive_records = {}
+        for record in records:
+            archive_records.setdefault(record.album.archive_id, []).append(record)
+        for archive_id, archive_record_list in archive_records.items():
+            mmap_index.get_index().add(archive_id, [record.id for record in archive_record_list],
+                                       [vectors[record.id] for record in archive_record_list])
+    return record_ids
+
+
+def generate_queries(num_queries, seed=0):
+    """
+    Returns a reproducible mix of requests: tuples (label, kind, parameters) where kind is 'search' (parameters are
+    the cleaned data of the search form) or 'autocomplete' (parameters are the GET parameters)
+    """
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(num_queries):
+        kind = rng.choices(['word', 'words', 'typo', 'place', 'person', 'filter', 'autocomplete'],
+                           weights=[3, 2, 1, 1, 1, 1, 3])[0]
+        cleaned_data = {'search_query': '', 'start_date': None, 'end_date': None, 'location': '',
+                        'media_type': 'All', 'depicted_users': ''}
+        if kind == 'word':
+            cleaned_data['search_query'] = rng.choice(WORDS)
+        elif kind == 'words':
+            cleaned_data['search_query'] = ' '.join(rng.sample(WORDS, rng.randint(2, 3)))
+        elif kind == 'typo':
+            word = list(rng.choice(WORDS))
+            i = rng.randrange(len(word) - 1)
+            word[i], word[i + 1] = word[i + 1], word[i]
+            cleaned_data['search_query'] = ''.join(word)
+        elif kind == 'place':
+            cleaned_data['search_query'] = rng.choice(PLACES)[0]
+        elif kind == 'person':
+            cleaned_data['search_query'] = f'{rng.choice(WORDS)} {rng.choice(FIRST_NAMES)}'
+        elif kind == 'filter':
+            cleaned_data['media_type'] = 'Image'
+            cleaned_data['location'] = rng.choice(PLACES)[1]
+            cleaned_data['start_date'] = datetime.date(rng.randint(1950, 2000), 1, 1)
+        if kind == 'autocomplete':
+            autocomplete = rng.choice(['search_input', 'search_location', 'search_depicted_users'])
+            source = {'search_input': WORDS, 'search_location': [place[0] for place in PLACES],
+                      'search_depicted_users': FIRST_NAMES}[autocomplete]
+            term = rng.choice(source)
+            requests.append((f'{autocomplete}', 'autocomplete',
+                             {'autocomplete': autocomplete, 'term': term[:rng.randint(3, len(term))]}))
+        else:
+            requests.append((f'search {kind}', 'search', cleaned_data))
+    return requests
+
+
+def run_benchmark(users, requests, trace_memory=False, page_size=20, ranking_mode=None, prefilter=None):
+    """
+    Replays requests through SearchMixin.get_search_results and the autocomplete view.
+    :param users: users sending the requests (chosen round robin)
+    :param requests: list of (label, kind, parameters) as returned by generate_queries
+    :param trace_memory: measure the peak of the memory allocated by Python during each request (slower)
+    :param page_size: number of records of the first result page, which is loaded like by the search view
+    :param ranking_mode: 'python' or 'sql', defaults to settings.SEARCH_RANKING_MODE
+    :param prefilter: whether to apply the full-text pre-filter, defaults to settings.SEARCH_FULL_TEXT_PREFILTER
+    :return: dictionary {label: list of (seconds, number of queries, peak memory in bytes or None)}
+    """
+    from arch_app.views import autocomplete
+    factory = RequestFactory()
+    measurements = {}
+    for i, (label, kind, parameters) in enumerate(requests):
+        user = users[i % len(users)]
+        if trace_memory:
+            tracemalloc.start()
+        # the query log is bounded, a full log would count no queries
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            if kind == 'search':
+                search = SearchMixin()
+                search.request = factory.get('/search/')
+                search.request.user = user
+                with vector_search_scope():
+                    list(search.get_search_results(parameters, ranking_mode=ranking_mode,
+                                                   prefilter=prefilter)[:page_size])
+            else:
+                request = factory.get('/autocomplete/', parameters)
+                request.user = user
+                autocomplete(request)
+            seconds = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        measurements.setdefault(label, []).append((seconds, len(queries), peak))
+    return measurements
+
+
+def summarize(measurements):
+    """ returns report lines with p50/p95 latency, queries per request and memory of each kind of request """
+    lines = [f"{'request':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'queries':>9}{'peak KiB':>10}"]
+    for label, values in sorted(measurements.items()):
+        seconds = np.array([value[0] for value in values]) * 1000
+        queries = np.mean([value[1] for value in values])
+        peaks = [value[2] for value in values if value[2] is not None]
+        peak = f'{max(peaks) / 1024:.0f}' if peaks else '-'
+        lines.append(f'{label:<24}{len(values):>7}{np.percentile(seconds, 50):>10.1f}'
+                     f'{np.percentile(seconds, 95):>10.1f}{seconds.max():>10.1f}{queries:>9.1f}{peak:>10}')
+    # maxrss is reported in KiB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    lines.append(f'max resident memory of the process: {max_rss:.0f} MiB')
+    return lines
@@ -0,0 +1,116 @@
+"""
+PostgreSQL full-text search over the title, caption, location and visible comments of a record.
+
+The text of a record is stemmed with the text search configuration of its language (Record.language), the search
+query is parsed with the configurations of all languages of the site (settings.LANGUAGES), so that inflected words
+(e.g. 'Häuser' and 'Haus') match.
+"""
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import F, Q, Func, Value, Case, When, FloatField, TextField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# text search configurations of PostgreSQL by language code
+SEARCH_CONFIGS = {
+    'da': 'danish',
+    'de': 'german',
+    'en': 'english',
+    'es': 'spanish',
+    'fi': 'finnish',
+    'fr': 'french',
+    'hu': 'hungarian',
+    'it': 'italian',
+    'nb': 'norwegian',
+    'nl': 'dutch',
+    'nn': 'norwegian',
+    'no': 'norwegian',
+    'pt': 'portuguese',
+    'ro': 'romanian',
+    'ru': 'russian',
+    'sv': 'swedish',
+    'tr': 'turkish',
+}
+
+
+def search_config(language):
+    """ returns the text search configuration for a language code (e.g. 'en-gb'), defaults to the site language """
+    language = (language or settings.LANGUAGE_CODE).lower()
+    return SEARCH_CONFIGS.get(language.split('-')[0], SEARCH_CONFIGS.get(settings.LANGUAGE_CODE.split('-')[0],
+                                                                        'simple'))
+
+
+def record_search_vector(record):
+    """
+    Returns the expression of the weighted search vector of a record:
+    title (A), caption (B), location names (C) and visible comments (D)
+    """
+    config = search_config(record.language)
+    location = record.location
+    location_names = [location.name, location.country, location.state, location.region] if location else []
+    comments = record.comments.filter(visible='visible').values_list('text', flat=True)
+    texts = [
+        (record.title, 'A'),
+        (record.user_caption, 'B'),
+        (' '.join(name for name in location_names if name), 'C'),
+        (' '.join(comments), 'D'),
+    ]
+    vector = None
+    for text, weight in texts:
+        field_vector = SearchVector(Value(text or ''), config=config, weight=weight)
+        vector = field_vector if vector is None else vector + field_vector
+    return vector
+
+
+def update_search_vectors(records):
+    """
+    Update the search vectors of many records with one query per text search configuration (same result as
+    record_search_vector, but computed by the database)
+    :param records: QuerySet of records
+    """
+    location_model = records.model._meta.get_field('location').related_model
+    comment_model = records.model._meta.get_field('comments').related_model
+    location_names = location_model.objects.filter(pk=OuterRef('location_id')).annotate(
+        # concat_ws skips the empty (NULL) names
+        names=Func(Value(' '), 'name', 'country', 'state', 'region', function='CONCAT_WS', output_field=TextField())
+    ).values('names')
+    comments = comment_model.objects.filter(record=OuterRef('pk'), visible='visible').values('record') \
+        .annotate(texts=StringAgg('text', delimiter=' ', output_field=TextField())).values('texts')
+    languages = set(records.values_list('language', flat=True).distinct())
+    count = 0
+    for config in {search_config(language) for language in languages}:
+        config_languages = [language for language in languages if search_config(language) == config]
+        language_filter = Q(language__in=[language for language in config_languages if language is not None])
+        if None in config_languages:
+            language_filter |= Q(language__isnull=True)
+        texts = [('title', 'A'), ('user_caption', 'B'), (Subquery(location_names), 'C'), (Subquery(comments), 'D')]
+        vector = None
+        for text, weight in texts:
+            field_vector = SearchVector(Coalesce(text, Value(''), output_field=TextField()), config=config,
+                                        weight=weight)
+            vector = field_vector if vector is None else vector + field_vector
+        count += records.filter(language_filter).update(search_vector=vector)
+    return count
+
+
+def full_text_query(search_query):
+    """ returns the search query parsed (web search syntax) with the configurations of all site languages """
+    configs = dict.fromkeys(search_config(code) for code in [settings.LANGUAGE_CODE] +
+                            [code for code, _name in settings.LANGUAGES])
+    query = None
+    for config in configs:
+        config_query = SearchQuery(search_query, config=config, search_type='websearch')
+        query = config_query if query is None else query | config_query
+    return query
+
+
+def full_text_score(search_query):
+    """
+    Returns an expression of the full-text score of a record: 0 if the record does not match the search query,
+    otherwise between 0.5 and 1 depending on the rank (frequency, proximity and weight of the matched words)
+    """
+    query = full_text_query(search_query)
+    # normalization 32 maps the rank to rank / (rank + 1)
+    rank = SearchRank(F('search_vector'), query, normalization=32)
+    return Case(When(search_vector=query, then=Value(0.5) + Value(0.5) * rank), default=Value(0.0),
+                output_field=FloatField())
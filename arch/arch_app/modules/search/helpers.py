@@ -1,16 +1,32 @@
 from datetime import date
-import numpy as np
-from arch_app.models import Record
+from arch_app.models import Record, User, Location, RecordVisibility
 from django.contrib.postgres.search import TrigramSimilarity
-from django.db.models.functions import Greatest
-from django.db.models import Q, Case, When
-from guardian.shortcuts import get_objects_for_user
+from django.db.models.functions import Greatest, Least, Coalesce, Lower, Upper, StrIndex
+from django.db.models import Q, F, Case, When, Value, Exists, OuterRef, FloatField
 from django.conf import settings
+from .vector_index import rank_by_embedding, similarity_expression
+from .full_text import full_text_query, full_text_score
 if settings.ACTIVATE_AI_SEARCH:
-    from sentence_transformers import util
     from ..embeddings.text_image_embedding import generate_text_embedding
 
 
+def similar_condition(term, *field_names):
+    """
+    Returns the aliases and the condition for objects where one of the fields contains the term or is similar to it
+    (trigram word similarity above settings.TRIGRAM_SIMILARITY_THRESHOLD).
+    Both conditions are answered by the trigram indexes on the upper case fields.
+    term: search term
+    field_names: names of the fields, e.g. 'title' or 'location__name'
+    """
+    aliases = {}
+    q = Q()
+    for field_name in field_names:
+        alias = f"{field_name}_upper"
+        aliases[alias] = Upper(field_name)
+        q |= Q(**{f"{field_name}__icontains": term}) | Q(**{f"{alias}__trigram_word_similar": term})
+    return aliases, q
+
+
 class SearchMixin():
     """
     Mixin for search view
@@ -53,79 +69,193 @@ class SearchMixin():
             )
 
         # filter the queryset based on the user's permissions
+        records = Record.objects.select_related('depicted_users')
         if q_list:
+            records = records.filter(Q(*q_list, _connector=Q.AND))
+        filtered_records = RecordVisibility.objects.filter_records(self.request.user, records)
+        return filtered_records
+
+    @staticmethod
+    def annotate_similarity(records, search_query):
+        """
+        Annotate the trigram similarity of title, location and caption to the search query.
+        Trigram similarity is a score between 0 and 1, hence they're mapped to [-1, 1]
+        """
+        return records.annotate(
+            similarity_title=2 * (TrigramSimilarity('title', search_query)) - 1,
+            # normalize to [-1, 1], replace 3 with number of fields
+            similarity_location=2 * (Greatest(
+                TrigramSimilarity('location__name', search_query),
+                TrigramSimilarity('location__country', search_query),
+                TrigramSimilarity('location__state', search_query),
+                TrigramSimilarity('location__region', search_query)
+            )) - 1,
+            # weight location higher
+            similarity_caption=2 * (TrigramSimilarity('user_caption', search_query)) - 1,
+        )
+
+    @staticmethod
+    def annotate_full_text(records, search_query):
+        """
+        Annotate the full-text score of the records: 0 if the record does not match the search query,
+        between 0.5 and 1 otherwise (see full_text_score)
+        """
+        return records.annotate(similarity_full_text=full_text_score(search_query))
+
+    def prefilter_records(self, filtered_records, search_query, query_vector=None):
+        """
+        Restrict the records to candidates which are likely to pass the similarity threshold, so that only those
+        are ranked: records matching the full-text query, with a title, caption or location containing or similar
+        to a word of the query, depicting a user mentioned in the query or among the nearest image embeddings.
+        filtered_records: QuerySet of the permitted and filtered records
+        search_query: search query of the user
+        query_vector: embedding of the search query or None
+        """
+        # the candidates are the union of subqueries which are each answered by an index (full-text, trigram, foreign
+        # and primary key), a single condition combining them with OR would be evaluated on every record
+        candidates = [
+            Record.objects.filter(search_vector=full_text_query(search_query)).values('pk'),
+            Record.objects.filter(depicted_users__in=self.users_in_query(search_query).values('groups')).values('pk'),
+        ]
+        for word in search_query.split():
+            for field_name in ('title', 'user_caption'):
+                aliases, q = similar_condition(word, field_name)
+                candidates.append(Record.objects.alias(**aliases).filter(q).values('pk'))
+            aliases, q = similar_condition(word, 'name', 'country', 'state', 'region')
+            candidates.append(Record.objects.filter(location__in=Location.objects.alias(**aliases).filter(q))
+                              .values('pk'))
+        if query_vector is not None:
+            nearest = rank_by_embedding(query_vector, filtered_records, top_k=settings.VECTOR_SEARCH_TOP_K)
+            candidates.append(Record.objects.filter(pk__in=list(nearest)).values('pk'))
+        return filtered_records.filter(pk__in=candidates[0].union(*candidates[1:]))
+
+    @staticmethod
+    def users_in_query(search_query):
+        """
+        Return the users whose username, first_name or last_name is contained in the search query.
+        Empty names are contained in every query, they are not compared.
+        """
+        query = Value(search_query.lower())
+        condition = Q()
+        for name in ('username', 'first_name', 'last_name'):
+            condition |= Q(**{f'{name}_index__gt': 0, f'{name}__isnull': False}) & ~Q(**{name: ''})
+        return User.objects.alias(
+            username_index=StrIndex(query, Coalesce(Lower('username'), Value(''))),
+            first_name_index=StrIndex(query, Coalesce(Lower('first_name'), Value(''))),
+            last_name_index=StrIndex(query, Coalesce(Lower('last_name'), Value(''))),
+        ).filter(condition)
+
+    @classmethod
+    def annotate_depicted_user_in_query(cls, records, search_query):
+        """
+        Annotate whether the username, first_name or last_name of a depicted user is contained in the search query.
+        This is computed by the database, so that the depicted users do not have to be loaded for each record.
+        """
+        depicted_user_in_query = cls.users_in_query(search_query).filter(groups=OuterRef('depicted_users'))
+        return records.annotate(depicted_user_in_query=Exists(depicted_user_in_query))
 
-            filtered_records = get_objects_for_user(self.request.user,
-                                                  "view_record",
-                                                  Record.objects.select_related('depicted_users').filter(Q(*q_list, _connector=Q.AND)))
+    def rank_records_sql(self, filtered_records, search_query, query_vector=None):
+        """
+        Return the records ordered by similarity to the search query. Unlike the default ranking in
+        get_search_results, the scores are combined, thresholded and sorted by the database.
+        filtered_records: QuerySet of the permitted and filtered records
+        search_query: search query of the user
+        query_vector: embedding of the search query or None
+        """
+        if query_vector is not None:
+            similarity_query = similarity_expression(query_vector, filtered_records)
         else:
-            filtered_records = get_objects_for_user(self.request.user,
-                                                  "view_record",
-                                                  Record.objects.select_related('depicted_users').all())
-        return filtered_records
+            similarity_query = Value(-1.0, output_field=FloatField())
 
-    def get_search_results(self, cleaned_data):
+        # select the records by id to avoid duplicates caused by the joins of the filters
+        records = self.annotate_similarity(
+            Record.objects.filter(pk__in=filtered_records.values('pk')), search_query
+        )
+        records = self.annotate_depicted_user_in_query(records, search_query)
+        records = records.alias(
+            score_title=Coalesce('similarity_title', -1.0, output_field=FloatField()),
+            score_location=Coalesce('similarity_location', -1.0, output_field=FloatField()),
+            score_caption=Coalesce('similarity_caption', -1.0, output_field=FloatField()),
+            score_query=similarity_query,
+            score_full_text=full_text_score(search_query),
+        ).alias(
+            # take max in case the sum of the scores is negative
+            score_total=Greatest(
+                F('score_title') + F('score_location') + F('score_caption') + F('score_query') +
+                F('score_full_text'),
+                'score_title', 'score_location', 'score_caption', 'score_query', 'score_full_text',
+            ),
+            # add 0.2 if a depicted user is mentioned in the search query
+            score_depicted_users=Case(When(depicted_user_in_query=True, then=Value(0.2)), default=Value(0.0)),
+        ).annotate(
+            similarity=Least(F('score_total') + F('score_depicted_users'), Value(4.0)),
+        )
+        return records.filter(similarity__gt=0.2).order_by('-similarity', 'pk')
+
+    def get_search_results(self, cleaned_data, ranking_mode=None, prefilter=None):
         """
-        Return ranked records
+        Return a QuerySet of the ranked records (ordered by their rank, evaluate it in a vector_search_scope)
         cleaned_data: cleaned data from the search form
+        ranking_mode: 'python' or 'sql', defaults to settings.SEARCH_RANKING_MODE
+        prefilter: whether to apply the full-text pre-filter, defaults to settings.SEARCH_FULL_TEXT_PREFILTER
         """
+        ranking_mode = ranking_mode or settings.SEARCH_RANKING_MODE
+        prefilter = settings.SEARCH_FULL_TEXT_PREFILTER if prefilter is None else prefilter
 
         # apply filters here:
         filtered_records = self.filter_records(cleaned_data)
 
+        query_vector = None
+        if cleaned_data['search_query'] and settings.ACTIVATE_AI_SEARCH:
+            query_vector = generate_text_embedding(cleaned_data['search_query'])
+        # only rank the records which are likely to pass the similarity threshold
+        if cleaned_data['search_query'] and prefilter:
+            filtered_records = self.prefilter_records(filtered_records, cleaned_data['search_query'], query_vector)
+
+        # rank the records in the database, the similarity of the embeddings can only be computed by the database
+        # with pgvector (otherwise the records are ranked in python)
+        if cleaned_data['search_query'] and ranking_mode == 'sql' and \
+                (query_vector is None or settings.VECTOR_SEARCH_BACKEND == 'pgvector'):
+            return self.rank_records_sql(filtered_records, cleaned_data['search_query'], query_vector)
+
         # compute similarity scores if the user provides a search query
         if cleaned_data['search_query']:
-            if settings.ACTIVATE_AI_SEARCH:
-                # compute query_vector here
-                query_vector = generate_text_embedding(cleaned_data['search_query'])
+            if query_vector is not None:
+                # rank the permitted records by their embedding using the vector index
+                similarities_query = rank_by_embedding(query_vector, filtered_records)
             else:
-                query_vector = None
+                similarities_query = {}
             records = []
 
-            # Trigram similarity is a score between 0 and 1, hence they're mapped to [-1, 1]
-            records_similarity = filtered_records.annotate(
-                similarity_title=2 * (TrigramSimilarity('title', cleaned_data['search_query'])) - 1,
-                # normalize to [-1, 1], replace 3 with number of fields
-                similarity_location=2 * (Greatest(
-                    TrigramSimilarity('location__name', cleaned_data['search_query']),
-                    TrigramSimilarity('location__country', cleaned_data['search_query']),
-                    TrigramSimilarity('location__state', cleaned_data['search_query']),
-                    TrigramSimilarity('location__region', cleaned_data['search_query'])
-                )) - 1,
-                # weight location higher
-                similarity_caption=2 * (TrigramSimilarity('user_caption', cleaned_data['search_query'])) - 1,
-
-            )
+            records_similarity = self.annotate_similarity(filtered_records,
+                                                          cleaned_data['search_query'])
+            records_similarity = self.annotate_depicted_user_in_query(records_similarity,
+                                                                      cleaned_data['search_query'])
+            records_similarity = self.annotate_full_text(records_similarity, cleaned_data['search_query'])
 
             for record in records_similarity:
-                if record.embedding is None or query_vector is None:
-                    similarity_query = -1
-                else:
-                    # similarity score is between -1 and 1
-                    similarity_query = util.cos_sim(query_vector, np.array(record.embedding, dtype=np.float32))
-                    similarity_query = similarity_query.item()
+                # similarity score is between -1 and 1, records without (nearby) embedding get -1
+                similarity_query = similarities_query.get(record.id, -1)
 
                 similarity_title = record.similarity_title if record.similarity_title is not None else -1
                 similarity_location = record.similarity_location if record.similarity_location is not None else -1
                 similarity_caption = record.similarity_caption if record.similarity_caption is not None else -1
 
-                sum_similarity = similarity_title + similarity_location + similarity_caption + similarity_query
+                # full-text score is 0 without a match, hence it only increases the sum
+                similarity_full_text = record.similarity_full_text
+
+                sum_similarity = similarity_title + similarity_location + similarity_caption + similarity_query + \
+                    similarity_full_text
                 # take max in case sum_similarity is negative
                 total_similarity = max(sum_similarity, similarity_title, similarity_location, similarity_caption,
-                                       similarity_query)
+                                       similarity_query, similarity_full_text)
 
                 # add 0.2 to total_similarity if the user is depicted in the record
-                for depicted_u in record.depicted_users.user_set.all():
-                    username = depicted_u.username.lower() if depicted_u.username else ''
-                    first_name = depicted_u.first_name.lower() if depicted_u.first_name else ''
-                    last_name = depicted_u.last_name.lower() if depicted_u.last_name else ''
-                    search_query = cleaned_data['search_query'].lower()
-                    if username in search_query or first_name in search_query or last_name in search_query:
-                        # if the query only contains the username, first_name or last_name, add 0.2 to the similarity score. This ensures that the record item is shown in the search results
-                        total_similarity += 0.2
-                        if total_similarity > 4:
-                            total_similarity = 4
-                        break
+                if record.depicted_user_in_query:
+                    # if the query only contains the username, first_name or last_name, add 0.2 to the similarity score. This ensures that the record item is shown in the search results
+                    total_similarity += 0.2
+                    if total_similarity > 4:
+                        total_similarity = 4
 
                 if total_similarity > 0.2:
                     records.append({
@@ -138,10 +268,10 @@ class SearchMixin():
 
             search_results_ids = [str(record['id']) for record in records]
             preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(search_results_ids)])
-            search_results = filtered_records.filter(pk__in=search_results_ids).order_by(preserved)
+            search_results = Record.objects.filter(pk__in=search_results_ids).order_by(preserved)
         else:
+            # select the records by id to avoid duplicates caused by the joins of the filters
+            search_results = Record.objects.filter(pk__in=filtered_records.values('pk')) \
+                .order_by('-date_created', '-date_uploaded', 'pk')
 
-            search_results = filtered_records
-            search_results_ids = [str(r.id) for r in search_results]
-
-        return search_results_ids, search_results
+        return search_results
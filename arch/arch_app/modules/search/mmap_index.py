@@ -0,0 +1,299 @@
+"""
+Exact vector index in memory-mapped .npy files, for deployments which cannot install the pgvector extension
+(settings.VECTOR_SEARCH_BACKEND = 'mmap').
+
+The normalized embeddings of each archive are stored in a shard directory (settings.VECTOR_INDEX_PATH/archive_<id>):
+    main-<n>.npy        embedding matrix (settings.VECTOR_INDEX_DTYPE, one row per record)
+    main-<n>.ids.npy    record ids of the rows (16 byte UUIDs)
+    delta-<n>.npy       embeddings added since the last compaction (with a delta-<n>.ids.npy sidecar),
+                        they replace the rows of the main matrix with the same record id
+    shard.json          names of the current main and delta files
+
+Files are never changed after they are written: an update writes new files and replaces shard.json atomically,
+so the web processes map the same files (shared through the page cache) and remap a shard when shard.json changes.
+Writers of a shard are serialized with a file lock (e.g. several qcluster workers).
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# number of rows converted to float32 at once when scoring a float16 matrix
+SCORE_CHUNK_SIZE = 512
+
+
+def _id_bytes(record_id):
+    """ returns the 16 bytes of a record id (UUID, string or bytes) """
+    if isinstance(record_id, (bytes, memoryview)):
+        return record_id
+    return (record_id if isinstance(record_id, uuid.UUID) else uuid.UUID(str(record_id))).bytes
+
+
+def _id_array(record_ids):
+    """ returns the record ids as an array of 16 byte strings """
+    return np.frombuffer(b''.join([_id_bytes(record_id) for record_id in record_ids]), dtype='S16')
+
+
+def _sorted_keys(ids):
+    """
+    Returns the order and the sorted 64 bit keys (xor of both halves) of an array of ids,
+    which are sorted and searched much faster than 16 byte strings
+    """
+    halves = np.ascontiguousarray(ids).view('<u8')
+    keys = halves[0::2] ^ halves[1::2]
+    order = np.argsort(keys)
+    return order, keys[order]
+
+
+def _record_id(value):
+    """ returns the UUID of a 16 byte string (numpy strips trailing null bytes) """
+    return uuid.UUID(bytes=bytes(value).ljust(16, b'\0'))
+
+
+def _normalize(embeddings):
+    """ returns the embeddings as float32 rows with unit length """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-8)
+
+
+class MmapVectorIndex:
+    """ Per-archive embedding shards in memory-mapped .npy files, ranked with one matrix-vector product each """
+
+    def __init__(self, path, dtype='float32', compact_size=1024):
+        """
+        :param path: directory of the shards
+        :param dtype: 'float16' or 'float32', type of the stored embeddings
+        :param compact_size: minimum number of rows of a delta before it is merged into the main matrix
+            (at least 10% of the main matrix)
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compact_size = compact_size
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def shard_path(self, archive_id):
+        return os.path.join(self.path, f'archive_{archive_id}')
+
+    # writing
+
+    @contextmanager
+    def _locked(self, archive_id):
+        """ exclusive lock of the shard of an archive (between processes) """
+        shard_path = self.shard_path(archive_id)
+        os.makedirs(shard_path, exist_ok=True)
+        with open(os.path.join(shard_path, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield shard_path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read_manifest(shard_path):
+        try:
+            with open(os.path.join(shard_path, 'shard.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'generation': 0, 'main': None, 'delta': None}
+
+    @staticmethod
+    def _save_array(path, array):
+        with open(path + '.tmp', 'wb') as file:
+            np.save(file, array)
+        os.replace(path + '.tmp', path)
+
+    def _write(self, shard_path, manifest, main=None, delta=None):
+        """
+        Writes new main and/or delta files and publishes them in shard.json.
+        main and delta are tuples (ids, embeddings), False removes the delta, None keeps the current files.
+        """
+        previous = dict(manifest)
+        manifest = dict(manifest, generation=manifest['generation'] + 1)
+        for name, arrays in (('main', main), ('delta', delta)):
+            if arrays is None:
+                continue
+            if arrays is False:
+                manifest[name] = None
+                continue
+            file_name = f"{name}-{manifest['generation']}"
+            self._save_array(os.path.join(shard_path, file_name + '.ids.npy'), arrays[0])
+            self._save_array(os.path.join(shard_path, file_name + '.npy'), arrays[1].astype(self.dtype))
+            manifest[name] = file_name
+        with open(os.path.join(shard_path, 'shard.json.tmp'), 'w') as file:
+            json.dump(manifest, file)
+        os.replace(os.path.join(shard_path, 'shard.json.tmp'), os.path.join(shard_path, 'shard.json'))
+        # processes which mapped the previous files keep them until they remap the shard
+        for name in ('main', 'delta'):
+            if previous[name] and previous[name] != manifest[name]:
+                for suffix in ('.npy', '.ids.npy'):
+                    try:
+                        os.remove(os.path.join(shard_path, previous[name] + suffix))
+                    except FileNotFoundError:
+                        pass
+
+    @staticmethod
+    def _load(shard_path, file_name, mmap_mode='r'):
+        """ returns the (ids, embeddings) of a main or delta file, empty arrays if there is none """
+        if not file_name:
+            return np.empty(0, dtype='S16'), None
+        ids = np.load(os.path.join(shard_path, file_name + '.ids.npy'), mmap_mode=mmap_mode)
+        embeddings = np.load(os.path.join(shard_path, file_name + '.npy'), mmap_mode=mmap_mode)
+        return ids, embeddings
+
+    def add(self, archive_id, record_ids, embeddings):
+        """
+        Adds or replaces the embeddings of records of an archive.
+        :param archive_id: id of the archive of the records
+        :param record_ids: ids of the records
+        :param embeddings: embeddings of the records (one row per record)
+        """
+        if not len(record_ids):
+            return
+        ids = _id_array(record_ids)
+        embeddings = _normalize(embeddings)
+        with self._locked(archive_id) as shard_path:
+            manifest = self._read_manifest(shard_path)
+            delta_ids, delta_embeddings = self._load(shard_path, manifest['delta'], mmap_mode=None)
+            if len(delta_ids):
+                keep = ~np.isin(delta_ids, ids)
+                ids = np.concatenate([delta_ids[keep], ids])
+                embeddings = np.concatenate([delta_embeddings[keep].astype(np.float32), embeddings])
+            main_ids, main_embeddings = self._load(shard_path, manifest['main'])
+            if len(ids) < max(self.compact_size, len(main_ids) // 10):
+                self._write(shard_path, manifest, delta=(ids, embeddings))
+                return
+            # merge the delta into the main matrix
+            keep = ~np.isin(main_ids, ids)
+            if len(main_ids):
+                ids = np.concatenate([main_ids[keep], ids])
+                embeddings = np.concatenate([main_embeddings[keep].astype(np.float32), embeddings])
+            self._write(shard_path, manifest, main=(ids, embeddings), delta=False)
+
+    def rebuild(self, archive_id, record_ids, embeddings):
+        """ replaces the shard of an archive with the given embeddings """
+        with self._locked(archive_id) as shard_path:
+            manifest = self._read_manifest(shard_path)
+            self._write(shard_path, manifest, main=(_id_array(record_ids), _normalize(embeddings)), delta=False)
+
+    def remove(self, archive_id):
+        """ deletes the shard of an archive """
+        shutil.rmtree(self.shard_path(archive_id), ignore_errors=True)
+        with self._lock:
+            self._shards.pop(archive_id, None)
+
+    # searching
+
+    def _map(self, shard_path, manifest):
+        """
+        Maps the main and delta files of a shard.
+        returns a list of (ids, embeddings, replaced, order, sorted keys) per file, replaced marks the rows of the
+        main file which are replaced by the delta
+        """
+        parts = []
+        delta_ids, delta_embeddings = self._load(shard_path, manifest['delta'])
+        main_ids, main_embeddings = self._load(shard_path, manifest['main'])
+        if len(main_ids):
+            replaced = np.isin(main_ids, delta_ids) if len(delta_ids) else None
+            parts.append((main_ids, main_embeddings, replaced))
+        if len(delta_ids):
+            parts.append((delta_ids, delta_embeddings, None))
+        # order of the rows by key, to look up the permitted records
+        return [(ids, embeddings, replaced, *_sorted_keys(ids)) for ids, embeddings, replaced in parts]
+
+    def _shard(self, archive_id):
+        """ returns the mapped files of the shard of an archive (see _map), remapped if the shard changed """
+        shard_path = self.shard_path(archive_id)
+        manifest_path = os.path.join(shard_path, 'shard.json')
+        for _attempt in range(3):
+            try:
+                stat = os.stat(manifest_path)
+            except FileNotFoundError:
+                return []
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            with self._lock:
+                cached = self._shards.get(archive_id)
+            if cached and cached[0] == key:
+                return cached[1]
+            try:
+                parts = self._map(shard_path, self._read_manifest(shard_path))
+            except (FileNotFoundError, ValueError):
+                # the shard was replaced while it was read
+                continue
+            with self._lock:
+                self._shards[archive_id] = (key, parts)
+            return parts
+        console_logger.warning(f'Vector index: could not read the shard of archive {archive_id}')
+        return []
+
+    @staticmethod
+    def _score(embeddings, query):
+        """ cosine similarities of the (normalized) rows of a matrix to a normalized query """
+        if embeddings.dtype == np.float32:
+            return np.asarray(embeddings @ query)
+        scores = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), SCORE_CHUNK_SIZE):
+            scores[start:start + SCORE_CHUNK_SIZE] = \
+                embeddings[start:start + SCORE_CHUNK_SIZE].astype(np.float32) @ query
+        return scores
+
+    def search(self, query_vector, archive_records, top_k=None):
+        """
+        Ranks records by the cosine similarity of their embedding to a query vector.
+        :param query_vector: embedding of the search query
+        :param archive_records: dict {archive id: ids of the permitted records of the archive}
+        :param top_k: maximum number of records to return
+        :return: dictionary {record_id: similarity}
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-8)
+        result_ids, result_scores = [], []
+        for archive_id, record_ids in archive_records.items():
+            parts = self._shard(archive_id)
+            if not parts:
+                continue
+            permitted = _id_array(record_ids)
+            order, permitted_keys = _sorted_keys(permitted)
+            permitted = permitted[order]
+            for ids, embeddings, replaced, row_order, row_keys in parts:
+                # find the rows of the permitted records: matching keys and ids
+                positions = np.searchsorted(row_keys, permitted_keys)
+                found = positions < len(row_keys)
+                rows = row_order[positions[found]]
+                rows = rows[(row_keys[positions[found]] == permitted_keys[found]) & (ids[rows] == permitted[found])]
+                if replaced is not None:
+                    rows = rows[~replaced[rows]]
+                if not len(rows):
+                    continue
+                scores = self._score(embeddings, query)
+                result_ids.append(ids[rows])
+                result_scores.append(scores[rows])
+        if not result_ids:
+            return {}
+        ids = np.concatenate(result_ids)
+        scores = np.concatenate(result_scores)
+        if top_k and top_k < len(ids):
+            indices = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            indices = range(len(ids))
+        return {_record_id(ids[i]): float(scores[i]) for i in indices}
+
+
+_index = None
+
+
+def get_index():
+    """ returns the index of the process for settings.VECTOR_INDEX_PATH and settings.VECTOR_INDEX_DTYPE """
+    global _index
+    from django.conf import settings
+    if _index is None or (_index.path, _index.dtype) != (settings.VECTOR_INDEX_PATH,
+                                                         np.dtype(settings.VECTOR_INDEX_DTYPE)):
+        _index = MmapVectorIndex(settings.VECTOR_INDEX_PATH, settings.VECTOR_INDEX_DTYPE)
+    return _index
@@ -0,0 +1,138 @@
+"""
+Navigation context of the search and album views, stored as a ranked result set in the database.
+
+The session only holds the token of the current result set (request.session['result_set']). Pagination and the
+previous/next navigation of the record view select records by their rank in the result set, so the list of ids is
+never copied into the session or into the SQL of a query.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import transaction, connection
+from django.db.models import F, OrderBy, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from arch_app.models import Record, ResultSet, ResultSetEntry
+
+SESSION_KEY = 'result_set'
+
+
+def create_result_set(request, records, key=''):
+    """
+    Store a ranked list of records as the navigation context of the session, replacing the previous one.
+    The records are inserted by the database (INSERT ... SELECT), they are not loaded by the web process.
+    :param request: request of the user
+    :param records: ordered QuerySet of the records
+    :param key: identifies the records, e.g. of an album (see get_or_create_result_set)
+    :return: the new ResultSet
+    """
+    with transaction.atomic():
+        previous_token = request.session.get(SESSION_KEY)
+        if previous_token:
+            ResultSet.objects.filter(token=previous_token, user=request.user).delete()
+        result_set = ResultSet.objects.create(user=request.user, key=key)
+        insert_entries(result_set, records)
+    request.session[SESSION_KEY] = result_set.token
+    return result_set
+
+
+def get_or_create_result_set(request, records, key):
+    """
+    Returns the current result set of the session if it was created with the same key and is not expired, otherwise
+    stores the records as the new navigation context (see create_result_set).
+    :param request: request of the user
+    :param records: ordered QuerySet of the records
+    :param key: identifies the records, it has to change when the records change (e.g. contain their number)
+    """
+    result_set = get_result_set(request)
+    if result_set and result_set.key == key:
+        return result_set
+    return create_result_set(request, records, key)
+
+
+def delete_album_result_sets(albums, keep=None):
+    """
+    Deletes the result sets of albums (of all users) after the order of their records changed without a change of
+    their number (e.g. a record was moved or its date was edited), they are created again by the next page load.
+    :param albums: the albums (or their ids)
+    :param keep: token of a result set which is not deleted (e.g. updated by the caller)
+    """
+    album_keys = Q()
+    for album in albums:
+        album_keys |= Q(key__startswith=f'album:{getattr(album, "pk", album)}:')
+    ResultSet.objects.filter(album_keys).exclude(token=keep).delete()
+
+
+def insert_entries(result_set, records):
+    """
+    Inserts the records of an ordered QuerySet into a result set with a single INSERT ... SELECT, the ranks are
+    numbered by the database in the order of the QuerySet (ROW_NUMBER() OVER (ORDER BY ...)).
+    """
+    ranked = records.annotate(result_set_rank=Window(RowNumber(), order_by=window_ordering(records))) \
+        .order_by().values('pk', 'result_set_rank')
+    try:
+        sql, params = ranked.query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. filtered by an empty list of ids
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {connection.ops.quote_name(ResultSetEntry._meta.db_table)} "
+                       f"(result_set_id, rank, record_id) "
+                       f"SELECT %s, ranked.result_set_rank - 1, ranked.id FROM ({sql}) AS ranked",
+                       [result_set.pk, *params])
+
+
+def window_ordering(records):
+    """ returns the ordering of a QuerySet as expressions (for a window function), ties are ordered by pk """
+    ordering = []
+    for field in records.query.order_by:
+        if isinstance(field, str):
+            ordering.append(F(field[1:]).desc() if field.startswith('-') else F(field).asc())
+        else:
+            ordering.append(field if isinstance(field, OrderBy) else field.asc())
+    if 'pk' not in records.query.order_by:
+        ordering.append(F('pk').asc())
+    return ordering
+
+
+def get_result_set(request):
+    """ returns the current (not expired) ResultSet of the session or None """
+    token = request.session.get(SESSION_KEY)
+    if not token:
+        return None
+    return ResultSet.objects.filter(token=token, user=request.user,
+                                    created_on__gte=timezone.now() - timedelta(seconds=settings.RESULT_SET_TTL)) \
+        .first()
+
+
+def ranked_records(result_set):
+    """ returns a QuerySet of the records of a result set, ordered by their rank """
+    return Record.objects.filter(result_set_entries__result_set=result_set) \
+        .order_by('result_set_entries__rank')
+
+
+def get_position(result_set, record_id):
+    """
+    Locate a record in a result set.
+    :return: tuple (index, id of the previous record, id of the next record), index is None if the record is not
+        in the result set
+    """
+    entries = ResultSetEntry.objects.filter(result_set=result_set)
+    rank = entries.filter(record_id=record_id).values_list('rank', flat=True).first()
+    if rank is None:
+        return None, None, None
+    index = entries.filter(rank__lt=rank).count()
+    prev_id = entries.filter(rank__lt=rank).order_by('-rank').values_list('record_id', flat=True).first()
+    next_id = entries.filter(rank__gt=rank).order_by('rank').values_list('record_id', flat=True).first()
+    return index, prev_id, next_id
+
+
+def remove_record(result_set, record_id):
+    """ removes a record from a result set, the ranks of the other records are kept """
+    ResultSetEntry.objects.filter(result_set=result_set, record_id=record_id).delete()
+
+
+def delete_expired_result_sets():
+    """ deletes all result sets older than settings.RESULT_SET_TTL seconds, returns the number of result sets """
+    expired = ResultSet.objects.filter(created_on__lt=timezone.now() - timedelta(seconds=settings.RESULT_SET_TTL))
+    return expired.delete()[1].get(ResultSet._meta.label, 0)
@@ -0,0 +1,190 @@
+"""
+Vector index for ranking records by the similarity of their image embedding to a query embedding.
+
+The backend is selected with settings.VECTOR_SEARCH_BACKEND:
+    'python':   exact cosine similarity, computed with one matrix-vector product over the permitted records
+    'pgvector': approximate nearest neighbour search using an HNSW index on the RecordVector table
+                (app arch_vector, only installed with this backend)
+    'mmap':     exact cosine similarity over memory-mapped embedding files per archive (see mmap_index)
+"""
+from contextlib import contextmanager
+import numpy as np
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import Case, When, Value, F, Func, FloatField, BinaryField
+from arch_app.models import Record, RecordEmbedding
+from arch_app.modules.embeddings.model_versions import get_image_model_version
+from . import mmap_index
+
+
+def save_record_embedding(record_id, embedding):
+    """
+    Store the embedding of a record and keep the vector index up to date.
+    :param record_id: id of the record
+    :param embedding: embedding as a list or numpy array
+    """
+    save_record_embeddings({record_id: embedding})
+
+
+def save_record_embeddings(embeddings):
+    """
+    Store the embeddings of many records (of the current image model) and keep the vector index up to date.
+    :param embeddings: dictionary {record_id: embedding as a list or numpy array}
+    """
+    if not embeddings:
+        return
+    embeddings = {record_id: np.asarray(embedding, dtype=np.float32) for record_id, embedding in embeddings.items()}
+    record_ids = list(embeddings)
+    model_version = get_image_model_version()
+    with transaction.atomic():
+        RecordEmbedding.objects.filter(record_id__in=record_ids, model_version=model_version).delete()
+        RecordEmbedding.objects.bulk_create([
+            RecordEmbedding(record_id=record_id, model_version=model_version, dtype=settings.EMBEDDING_DTYPE,
+                            vector=RecordEmbedding.encode(embedding, settings.EMBEDDING_DTYPE))
+            for record_id, embedding in embeddings.items()
+        ])
+        if settings.VECTOR_SEARCH_BACKEND == 'pgvector':
+            from arch_vector.models import RecordVector
+            RecordVector.objects.filter(record_id__in=record_ids).delete()
+            RecordVector.objects.bulk_create([RecordVector(record_id=record_id, model_version=model_version,
+                                                           embedding=embedding.tolist())
+                                              for record_id, embedding in embeddings.items()])
+    if settings.VECTOR_SEARCH_BACKEND == 'mmap':
+        # record ids may be given as strings
+        vectors = {str(record_id): embedding for record_id, embedding in embeddings.items()}
+        archive_records = {}
+        for record_id, archive_id in Record.objects.filter(id__in=record_ids) \
+                .values_list('id', 'album__archive_id'):
+            archive_records.setdefault(archive_id, []).append(record_id)
+        for archive_id, archive_record_ids in archive_records.items():
+            mmap_index.get_index().add(archive_id, archive_record_ids,
+                                       [vectors[str(record_id)] for record_id in archive_record_ids])
+
+
+def rank_by_embedding(query_vector, records, top_k=None):
+    """
+    Rank records by the cosine similarity between their embedding and a query vector.
+    Records are filtered (e.g. by permissions) before they are ranked.
+    :param query_vector: embedding of the search query
+    :param records: QuerySet of the records which may be returned
+    :param top_k: maximum number of records to return, defaults to settings.VECTOR_SEARCH_TOP_K for pgvector
+    :return: dictionary {record_id: similarity} with similarities between -1 and 1
+    """
+    if settings.VECTOR_SEARCH_BACKEND == 'pgvector':
+        return _rank_pgvector(query_vector, records, top_k or settings.VECTOR_SEARCH_TOP_K)
+    if settings.VECTOR_SEARCH_BACKEND == 'mmap':
+        return _rank_mmap(query_vector, records, top_k)
+    return _rank_exact(query_vector, records, top_k)
+
+
+def load_embeddings(records):
+    """
+    Load the embeddings of the current image model of records.
+    :param records: QuerySet of records
+    :return: tuple (list of record ids, float32 matrix with one embedding per row) or (ids, None) without embeddings
+    """
+    rows = RecordEmbedding.objects.filter(record__in=records.values('pk'), model_version=get_image_model_version()) \
+        .values_list('record_id', 'dtype', 'vector')
+    ids, vectors = [], []
+    for record_id, dtype, vector in rows.iterator(chunk_size=10000):
+        ids.append(record_id)
+        vectors.append(np.frombuffer(vector, dtype=dtype))
+    if not ids:
+        return ids, None
+    return ids, np.array(vectors, dtype=np.float32)
+
+
+def _rank_exact(query_vector, records, top_k=None):
+    """ Exact ranking with a single matrix-vector product over all embeddings of the given records """
+    ids, matrix = load_embeddings(records)
+    if not ids:
+        return {}
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-8)
+    query = np.asarray(query_vector, dtype=np.float32)
+    scores = matrix @ (query / max(float(np.linalg.norm(query)), 1e-8))
+    if top_k and top_k < len(ids):
+        indices = np.argpartition(-scores, top_k)[:top_k]
+    else:
+        indices = range(len(ids))
+    return {ids[i]: float(scores[i]) for i in indices}
+
+
+def _rank_mmap(query_vector, records, top_k=None):
+    """ Exact ranking over the memory-mapped embeddings of the archives of the given records """
+    archive_records = {}
+    # the ids as 16 bytes (uuid_send) instead of UUID objects
+    records = records.annotate(id_bytes=Func('pk', function='uuid_send', output_field=BinaryField()))
+    for record_id, archive_id in records.values_list('id_bytes', 'album__archive_id'):
+        archive_records.setdefault(archive_id, []).append(record_id)
+    return mmap_index.get_index().search(query_vector, archive_records, top_k)
+
+
+@contextmanager
+def vector_search_scope(top_k=None):
+    """
+    Transaction in which the nearest neighbour queries of the pgvector backend (rank_by_embedding and the queries
+    using similarity_expression) return up to top_k records (default settings.VECTOR_SEARCH_TOP_K)
+    """
+    with transaction.atomic():
+        if settings.VECTOR_SEARCH_BACKEND == 'pgvector':
+            with connection.cursor() as cursor:
+                # the index scan returns at most ef_search rows, which must cover top_k (pgvector supports up to 1000)
+                cursor.execute("SET LOCAL hnsw.ef_search = %s",
+                               [min(max(top_k or settings.VECTOR_SEARCH_TOP_K, 40), 1000)])
+                if settings.VECTOR_SEARCH_ITERATIVE_SCAN:
+                    # the rows of records which may not be returned are filtered after the index scan, the scan is
+                    # continued until top_k permitted rows are found (pgvector >= 0.8)
+                    cursor.execute("SET LOCAL hnsw.iterative_scan = relaxed_order")
+        yield
+
+
+def exact_scan(records):
+    """
+    Returns whether the nearest records of the pgvector backend are searched without the HNSW index: the index scan
+    filters its candidates after the scan, so only a few (or none) of a small set of permitted records would be found.
+    :param records: QuerySet of the records which may be returned
+    """
+    limit = settings.VECTOR_SEARCH_EXACT_LIMIT
+    return records.order_by().values('pk')[:limit + 1].count() <= limit
+
+
+def _nearest_vectors(query, records, top_k):
+    """
+    Returns the RecordVectors of the top_k records nearest to a query vector, using the HNSW index unless the
+    permitted records are few enough to compare all of them (see exact_scan)
+    """
+    from pgvector.django import CosineDistance
+    from arch_vector.models import RecordVector
+    # vectors of a previous image model are not compared until they are replaced (see build_vector_index)
+    vectors = RecordVector.objects.filter(record__in=records.values('pk'), model_version=get_image_model_version()) \
+        .annotate(distance=CosineDistance('embedding', query))
+    if exact_scan(records):
+        # the index is only used for the ascending order of the distance itself
+        return vectors.order_by((Value(1.0) - F('distance')).desc())[:top_k]
+    return vectors.order_by('distance')[:top_k]
+
+
+def _rank_pgvector(query_vector, records, top_k):
+    """ Approximate ranking using the HNSW index of the RecordVector table (exact for few permitted records) """
+    vectors = _nearest_vectors(np.asarray(query_vector, dtype=np.float32), records, top_k) \
+        .values_list('record_id', 'distance')
+    with vector_search_scope(top_k):
+        return {record_id: 1 - distance for record_id, distance in vectors}
+
+
+def similarity_expression(query_vector, records, top_k=None):
+    """
+    Return a database expression for the similarity between the embedding of a record and a query vector, to rank
+    records inside the database (only with the pgvector backend, evaluate it in a vector_search_scope). As with
+    rank_by_embedding, the top k nearest records get their similarity, all other records get -1.
+    :param query_vector: embedding of the search query
+    :param records: QuerySet of the records which may be returned
+    :param top_k: number of nearest records, defaults to settings.VECTOR_SEARCH_TOP_K
+    """
+    if settings.VECTOR_SEARCH_BACKEND != 'pgvector':
+        raise ValueError('The similarity is only computed by the database with VECTOR_SEARCH_BACKEND=pgvector')
+    from pgvector.django import CosineDistance
+    query = np.asarray(query_vector, dtype=np.float32)
+    nearest = _nearest_vectors(query, records, top_k or settings.VECTOR_SEARCH_TOP_K).values('record_id')
+    return Case(When(pk__in=nearest, then=Value(1.0) - CosineDistance('vector__embedding', query)),
+                default=Value(-1.0), output_field=FloatField())
@@ -1,14 +1,18 @@
-""" Django Q2 tasks for asynchronous processing of tasks """
+"""
+Django Q2 tasks for asynchronous processing of tasks.
+
+The modules of the AI models and of ffmpeg are imported by the tasks using them, the web processes import this module
+(to queue the tasks) without loading TensorFlow, torch or ffmpeg.
+"""
 import os
 from .models import Record, TagBox
-from PIL import Image
+from .modules.computer_vision.image_loading import get_image_size, remove_overlapping_boxes, scale_boxes
+from .modules.computer_vision.preview_rendering import render_preview, blur_original
 
 from django.conf import settings
-if settings.ACTIVATE_AI_SEARCH:
-    from .modules.embeddings.text_image_embedding import generate_image_embedding
-if settings.ACTIVATE_FACE_DETECTION:
-    from .modules.computer_vision.face_detection import detect_faces
-from .modules.file_conversion.file_conversion import generate_preview
+from django.utils import timezone
+from .modules.search.vector_index import save_record_embeddings
+from .modules.search.result_sets import delete_expired_result_sets
 
 import logging
 console_logger = logging.getLogger('ARCH_console_logger')
@@ -26,18 +30,34 @@ def create_tagboxes_and_save(record_id):
         console_logger.error(f"Error when trying to create tagboxes. Record with id {record_id} does not exist.")
         file_logger.error(f"Error when trying to create tagboxes. Record with id {record_id} does not exist.")
         return False
-    img = Image.open(record.media_file.path)
-    width, height = img.size
+    from .modules.computer_vision.face_detection import detect_faces
+    # size of the displayed image, the boxes refer to it
+    width, height = get_image_size(record.media_file.path)
     faces = detect_faces(image_path=record.media_file.path)
-    for face in faces:
-        x1, y1, x2, y2 = face
-        record = Record.objects.get(id=record_id)  # reload record to avoid concurrency issues
-        tagbox = TagBox(record=record, x1=x1, y1=y1, x2=x2, y2=y2, height=height, width=width)
-        tagbox.save()
-    img.close()
+    # faces imported from the metadata of the image (see FileUploadView) are not tagged twice
+    existing = []
+    for x1, y1, x2, y2, box_width, box_height in \
+            TagBox.objects.filter(record=record).values_list('x1', 'y1', 'x2', 'y2', 'width', 'height'):
+        if box_width and box_height:
+            existing.extend(scale_boxes([(x1, y1, x2, y2)], (box_width, box_height), (width, height)))
+    save_face_boxes(record, (width, height), remove_overlapping_boxes(faces, existing))
     return True
 
 
+def save_face_boxes(record, image_size, boxes):
+    """
+    Create the TagBoxes of the faces on an image (detected or read from its metadata) and mark the record as
+    processed by the face detection (see the detect_faces command).
+    :param record: the record
+    :param image_size: size (width, height) of the displayed image, the boxes refer to it
+    :param boxes: list of boxes (x1, y1, x2, y2)
+    """
+    width, height = image_size
+    TagBox.objects.create_for_record(record, [TagBox(x1=x1, y1=y1, x2=x2, y2=y2, height=height, width=width)
+                                              for x1, y1, x2, y2 in boxes])
+    Record.objects.filter(id=record.id).update(faces_detected=timezone.now())
+
+
 def generate_preview_and_save(record_id, file_extension, mime_type, subtype):
     """ Generate a preview file for a given record.
 
@@ -50,6 +70,7 @@ def generate_preview_and_save(record_id, file_extension, mime_type, subtype):
         console_logger.error(f"Error when trying to generate preview. Record with id {record_id} does not exist.")
         file_logger.error(f"Error when trying to generate preview. Record with id {record_id} does not exist.")
         return False
+    from .modules.file_conversion.file_conversion import generate_preview
     preview_path = generate_preview(record, file_extension, subtype)
     if preview_path:
         record.preview_file.name = os.path.relpath(preview_path, settings.MEDIA_ROOT)
@@ -58,21 +79,69 @@ def generate_preview_and_save(record_id, file_extension, mime_type, subtype):
     return False
 
 
-def generate_image_embedding_and_save(record_id):
+def render_preview_and_save(record_id):
     """
-    Generate an image embedding for a given record and save it.
+    Render the preview of an image record with its hidden TagBoxes blurred (see render_preview), e.g. after the
+    TagBoxes of a user were hidden or shown again.
     :param record_id: id of the record
     """
     try:
         record = Record.objects.get(id=record_id)
     except Record.DoesNotExist:
-        console_logger.error(f"Error when trying to generate image embedding. Record with id {record_id} does not exist.")
-        file_logger.error(f"Error when trying to generate image embedding. Record with id {record_id} does not exist.")
+        console_logger.error(f"Error when trying to render preview. Record with id {record_id} does not exist.")
+        file_logger.error(f"Error when trying to render preview. Record with id {record_id} does not exist.")
         return False
-    img_emb = generate_image_embedding(record.media_file.path)
-    if img_emb is False:
+    render_preview(record)
+    return True
+
+
+def blur_faces_and_save(record_id, tagboxes):
+    """
+    Blur faces in the original image of a record permanently (the faces of a deleted account) and render its preview
+    again.
+    :param record_id: id of the record
+    :param tagboxes: list of the values of the BOX_FIELDS of the TagBoxes (see blur_original)
+    """
+    try:
+        record = Record.objects.get(id=record_id)
+    except Record.DoesNotExist:
+        console_logger.error(f"Error when trying to blur faces. Record with id {record_id} does not exist.")
+        file_logger.error(f"Error when trying to blur faces. Record with id {record_id} does not exist.")
         return False
-    record = Record.objects.get(id=record_id)  # reload record to avoid concurrency issues
-    record.embedding = img_emb.tolist()
-    record.save(update_fields=['embedding'])
+    blur_original(record, tagboxes)
+    render_preview(record)
     return True
+
+
+def generate_image_embedding_and_save(record_id):
+    """
+    Generate an image embedding for a given record and save it.
+    :param record_id: id of the record
+    """
+    return generate_image_embeddings_and_save([record_id])
+
+
+def generate_image_embeddings_and_save(record_ids):
+    """
+    Generate the image embeddings of records in batches (see generate_image_embeddings) and save them.
+    :param record_ids: ids of the records
+    :return: True if all embeddings were saved
+    """
+    records = list(Record.objects.filter(id__in=record_ids).only('id', 'media_file'))
+    if len(records) < len(record_ids):
+        console_logger.error(f"Error when trying to generate image embeddings. "
+                             f"{len(record_ids) - len(records)} records do not exist.")
+        file_logger.error(f"Error when trying to generate image embeddings. "
+                          f"{len(record_ids) - len(records)} records do not exist.")
+    from .modules.embeddings.text_image_embedding import generate_image_embeddings
+    embeddings = generate_image_embeddings([record.media_file.path for record in records])
+    save_record_embeddings({record.id: embedding for record, embedding in zip(records, embeddings)
+                            if embedding is not False})
+    return len(records) == len(record_ids) and all(embedding is not False for embedding in embeddings)
+
+
+def clear_expired_result_sets():
+    """ Delete expired search result sets, scheduled periodically (see schedule_periodic_tasks) """
+    count = delete_expired_result_sets()
+    console_logger.info(f"Deleted {count} expired result sets.")
+    return count
@@ -1,16 +1,58 @@
 import base64
+import glob
+import hashlib
 import os
+import tempfile
+import subprocess
+import sys
+import threading
+from io import BytesIO, StringIO
+from unittest.mock import patch
+import numpy as np
+from PIL import Image
 
 from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.tokens import default_token_generator
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, Client, RequestFactory, override_settings, modify_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
 from django.conf import settings
 from django_q.conf import Conf
+from django_q.signals import post_spawn
+from guardian.shortcuts import assign_perm, remove_perm, get_objects_for_user
+from django.core.management import call_command
 
 from ..forms import SearchForm
+from ..modules.search.helpers import SearchMixin
+from ..modules.embeddings.embedding_cache import EmbeddingCache, normalize_query
+from ..modules.embeddings.model_registry import ModelRegistry, resident_memory
+from ..modules.embeddings.model_versions import get_image_model_version
+from ..modules.embeddings.text_image_embedding import generate_text_embedding
+from ..modules.embeddings.onnx_models import preprocess_images, load_onnx_image_model, CLIP_MEAN, CLIP_STD
+from ..modules.computer_vision.image_loading import load_image, get_image_size, scale_boxes
+from ..modules.computer_vision import face_detection, preview_rendering
+from ..modules.computer_vision.preview_rendering import render_preview
+from ..modules.computer_vision.face_detectors import FaceDetector, CvlibFaceDetector, create_detector, \
+    download_weights, load_weights
+from ..modules.metadata_extraction.face_regions import extract_face_regions
+from ..modules.search.full_text import full_text_query
+from ..modules.search.result_sets import create_result_set, delete_expired_result_sets
+from ..modules.search.vector_index import save_record_embedding, rank_by_embedding, similarity_expression, \
+    exact_scan, vector_search_scope, _nearest_vectors
+from ..modules.search.mmap_index import MmapVectorIndex
+from ..modules.inference import client as inference_client
+from ..modules.inference.server import InferenceServer
+from ..workers import fits_memory_budget
+from ..management.commands.profile_startup import parse_importtime
+from ..management.commands.benchmark_face_detectors import box_iou, match_boxes
+from ..tasks import create_tagboxes_and_save
 from ..views import AlbumView, AlbumCreateView, FileUploadView, delete_record
-from ..models import User, Archive, Album, Membership, Record
+from ..models import User, Archive, Album, Membership, Record, ResultSet, RecordVisibility, Comment, Location, Tag, \
+    AutocompleteSuggestion, RecordEmbedding, TagBox
 import datetime
 
 
@@ -235,6 +277,1110 @@ class SearchTest(TestCase, BaseSetup):
         self.assertIn('video_4_arch_2',[i.title for i in response.context_data['record_list']])
 
 
+    def get_search_results(self, user, search_query):
+        """ runs the search of the search view for the given user and query """
+        search = SearchMixin()
+        search.request = RequestFactory().get(reverse('arch_app:search'))
+        search.request.user = user
+        cleaned_data = {'search_query': search_query, 'start_date': None, 'end_date': None, 'location': '',
+                        'media_type': 'All', 'depicted_users': ''}
+        results = search.get_search_results(cleaned_data)
+        return [str(pk) for pk in results.values_list('pk', flat=True)], results
+
+    def test_search_ranking_modes(self):
+        """ ranking in the database returns the same results as ranking in python """
+        record = Record.objects.get(title='image')
+        record.depicted_users.user_set.add(self.user2)
+        for search_query in ['video', 'video2 member2', 'image member2', 'text']:
+            with override_settings(SEARCH_RANKING_MODE='python'):
+                ids_python, results_python = self.get_search_results(self.user3, search_query)
+            with override_settings(SEARCH_RANKING_MODE='sql'):
+                ids_sql, results_sql = self.get_search_results(self.user3, search_query)
+            self.assertEqual(ids_python, ids_sql)
+            self.assertEqual([r.id for r in results_python], [r.id for r in results_sql])
+            if search_query == 'video':
+                self.assertEqual(len(ids_sql), 2)
+
+
+    def test_search_ranking_modes_top_k(self):
+        """ both ranking modes return the same records if there are more records than nearest embeddings """
+        records = list(Record.objects.order_by('title'))
+        for i, record in enumerate(records):
+            save_record_embedding(record.id, [1.0, i / len(records)] + [0.0] * 510)
+        query_vector = [1.0, 0.5] + [0.0] * 510
+        with override_settings(ACTIVATE_AI_SEARCH=True, VECTOR_SEARCH_TOP_K=2), \
+                patch('arch_app.modules.search.helpers.generate_text_embedding', create=True,
+                      return_value=query_vector):
+            for search_query in ['video', 'member2', 'nothing']:
+                with override_settings(SEARCH_RANKING_MODE='python'):
+                    ids_python, results_python = self.get_search_results(self.user3, search_query)
+                with override_settings(SEARCH_RANKING_MODE='sql'):
+                    ids_sql, results_sql = self.get_search_results(self.user3, search_query)
+                self.assertEqual(ids_python, ids_sql)
+                self.assertGreater(len(ids_sql), 2)
+
+    def test_depicted_user_empty_name(self):
+        """ users without first or last name are not considered to be mentioned in every search query """
+        record = Record.objects.get(title='image')
+        User.objects.filter(pk=self.user2.pk).update(first_name='', last_name='')
+        record.depicted_users.user_set.add(self.user2)
+        for search_query, mentioned in [('nothing', False), (self.user2.username, True)]:
+            records = SearchMixin.annotate_depicted_user_in_query(Record.objects.filter(pk=record.pk), search_query)
+            self.assertEqual(records.get().depicted_user_in_query, mentioned)
+        with override_settings(SEARCH_FULL_TEXT_PREFILTER=True):
+            ids, results = self.get_search_results(self.user3, 'nothing')
+        self.assertEqual(ids, [])
+
+    def test_search_query_count(self):
+        """ the number of queries does not depend on the number of records with depicted users """
+        for record in Record.objects.all():
+            record.depicted_users.user_set.add(self.user1, self.user2)
+        # fill the caches (e.g. content types) before counting
+        self.get_search_results(self.user3, 'video')
+        with CaptureQueriesContext(connection) as queries:
+            ids, results = self.get_search_results(self.user3, 'video')
+        num_queries = len(queries)
+        self.assertIn(str(Record.objects.get(title='video').id), ids)
+
+        for i in range(5):
+            record = Record.objects.create(title=f'video {i}', type='Video', album=self.archive1.inbox)
+            assign_perm('view_record', self.archive1.moderators, record)
+            record.depicted_users.user_set.add(self.user1, self.user2)
+        with self.assertNumQueries(num_queries):
+            ids, results = self.get_search_results(self.user3, 'video')
+        self.assertEqual(len(ids), 7)
+
+    def test_full_text_search(self):
+        """ inflected words of the title, caption and visible comments are found using the record language """
+        record = Record.objects.get(title='image')
+        record.user_caption = 'Die Häuser am Hafen'
+        record.language = 'de'
+        record.save()
+        self.assertEqual(list(Record.objects.filter(search_vector=full_text_query('Haus'))), [record])
+        comment = Comment.objects.create(record=record, user=self.user1, text='Sommerfest im Garten')
+        self.assertEqual(list(Record.objects.filter(search_vector=full_text_query('Gärten'))), [record])
+        comment.visible = 'hidden_by_mod'
+        comment.save()
+        self.assertFalse(Record.objects.filter(search_vector=full_text_query('Garten')).exists())
+        # the search vectors of the records of an edited location are updated
+        record.location = Location.objects.create(name='Bremen')
+        record.save()
+        record.location.name = 'Lübeck'
+        record.location.save()
+        self.assertEqual(list(Record.objects.filter(search_vector=full_text_query('Lübeck'))), [record])
+        self.assertFalse(Record.objects.filter(search_vector=full_text_query('Bremen')).exists())
+        # full-text matches pass the similarity threshold in both ranking modes
+        for mode in ['python', 'sql']:
+            with override_settings(SEARCH_RANKING_MODE=mode):
+                ids, results = self.get_search_results(self.user3, 'Haus')
+            self.assertEqual(ids, [str(record.id)])
+
+    def test_search_vector_on_save(self):
+        """ the search vector is written by the UPDATE of the record, saves of other fields do not compute it """
+        record = Record.objects.get(title='image')
+        record.title = 'Hafen'
+        with CaptureQueriesContext(connection) as queries:
+            record.save()
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE "arch_app_record"')]), 1)
+        self.assertEqual(list(Record.objects.filter(search_vector=full_text_query('Hafen'))), [record])
+        with CaptureQueriesContext(connection) as queries:
+            record.save(update_fields=['depicted_users'])
+        self.assertFalse([query for query in queries if 'search_vector' in query['sql']])
+
+    def test_search_prefilter(self):
+        """ the full-text pre-filter does not change the results of queries matching words of the records """
+        for search_query in ['video', 'video2 member2', 'image', 'imagine']:
+            with override_settings(SEARCH_FULL_TEXT_PREFILTER=False):
+                ids, results = self.get_search_results(self.user3, search_query)
+            with override_settings(SEARCH_FULL_TEXT_PREFILTER=True):
+                ids_prefiltered, results_prefiltered = self.get_search_results(self.user3, search_query)
+            self.assertEqual(ids, ids_prefiltered)
+        # the candidates are a union of indexed subqueries, not an OR with a correlated subquery
+        sql = str(SearchMixin().prefilter_records(Record.objects.all(), 'video2 member2').query)
+        self.assertIn('UNION', sql)
+        self.assertNotIn('EXISTS', sql)
+
+    def test_autocomplete_search_input(self):
+        """ autocomplete suggests titles which contain or are similar to the term """
+        self.client.login(username='member1', password='123')
+        response = self.client.get(reverse('arch_app:autocomplete'),
+                                   data={'autocomplete': 'search_input', 'term': 'vide'})
+        self.assertEqual(response.json(), ['video'])
+        # similar word
+        response = self.client.get(reverse('arch_app:autocomplete'),
+                                   data={'autocomplete': 'search_input', 'term': 'videos'})
+        self.assertEqual(response.json(), ['video'])
+        # records of other users are not suggested
+        response = self.client.get(reverse('arch_app:autocomplete'),
+                                   data={'autocomplete': 'search_input', 'term': 'video_3_arch_2'})
+        self.assertEqual(response.json(), [])
+
+    def test_result_set_insert_select(self):
+        """ the ranked records are inserted into the result set by the database, ranked as ordered by the query """
+        request = RequestFactory().get(reverse('arch_app:search'))
+        request.user, request.session = self.user3, {}
+        with override_settings(SEARCH_RANKING_MODE='sql'):
+            ids, results = self.get_search_results(self.user3, 'video')
+        with CaptureQueriesContext(connection) as queries:
+            result_set = create_result_set(request, results)
+        self.assertEqual(len([query for query in queries if 'INSERT INTO "arch_app_resultsetentry"' in query['sql']
+                              and 'ROW_NUMBER() OVER' in query['sql']]), 1)
+        self.assertEqual([str(pk) for pk in result_set.entries.order_by('rank').values_list('record_id', flat=True)],
+                         ids)
+        self.assertEqual(list(result_set.entries.order_by('rank').values_list('rank', flat=True)),
+                         list(range(len(ids))))
+
+    def test_album_result_set_changes(self):
+        """ the result sets of an album are created again after a record is moved or its date is edited """
+        self.client.login(username='mod1', password='123')
+        self.client.get(reverse('arch_app:album', kwargs={'pk': self.archive1.inbox.id}))
+        token = self.client.session['result_set']
+        moderator = Client()
+        moderator.login(username='mod1', password='123')
+        # records without a date are listed first
+        record = Record.objects.filter(album=self.archive1.inbox).order_by('pk').first()
+        moderator.post(reverse('arch_app:record', kwargs={'pk': record.id}), HTTP_REFERER='/',
+                       data={'action': 'save', 'date_created': '2000-01-01', 'title': record.title})
+        self.assertFalse(ResultSet.objects.filter(token=token).exists())
+        response = self.client.get(reverse('arch_app:album', kwargs={'pk': self.archive1.inbox.id}))
+        self.assertEqual(list(response.context_data['record_list'])[-1], record)
+        result_set = ResultSet.objects.get(token=self.client.session['result_set'])
+        self.assertEqual(result_set.entries.order_by('rank').last().record, record)
+        # a record moved to another album
+        album = Album.objects.create(title='album', creator=self.user3, archive=self.archive1)
+        moderator.post(reverse('arch_app:update_record'), HTTP_REFERER='/',
+                       data={'album': album.id, 'record_id': record.id})
+        self.assertFalse(ResultSet.objects.filter(id=result_set.id).exists())
+
+    def test_search_result_set(self):
+        """ the records of an album or search are stored in a result set, used for pagination and navigation """
+        self.client.login(username='mod1', password='123')
+        response = self.client.get(reverse('arch_app:album', kwargs={'pk': self.archive1.inbox.id}))
+        records = list(response.context_data['record_list'])
+        self.assertEqual(len(records), 4)
+        result_set = ResultSet.objects.get(token=self.client.session['result_set'])
+        self.assertEqual([entry.record for entry in result_set.entries.order_by('rank')], records)
+        # the result set is reused by the next page loads until records are added
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('arch_app:album', kwargs={'pk': self.archive1.inbox.id}))
+        self.assertEqual(self.client.session['result_set'], result_set.token)
+        self.assertFalse([query for query in queries if 'INSERT INTO "arch_app_resultsetentry"' in query['sql']])
+        # navigation between the records of the result set
+        response = self.client.get(reverse('arch_app:record', kwargs={'pk': records[1].id}))
+        self.assertEqual(response.context_data['prev_record'], records[0])
+        self.assertEqual(response.context_data['next_record'], records[2])
+        self.assertEqual(response.context_data['current_page'], 1)
+        response = self.client.get(reverse('arch_app:record', kwargs={'pk': records[0].id}))
+        self.assertIsNone(response.context_data['prev_record'])
+        new_record = Record.objects.create(title='new', type='Text', album=self.archive1.inbox)
+        assign_perm('view_record', self.archive1.moderators, new_record)
+        self.client.get(reverse('arch_app:album', kwargs={'pk': self.archive1.inbox.id}))
+        self.assertFalse(ResultSet.objects.filter(id=result_set.id).exists())
+        result_set = ResultSet.objects.get(token=self.client.session['result_set'])
+        self.assertEqual(result_set.entries.count(), 5)
+        # a new search replaces the result set
+        self.client.post(reverse('arch_app:search'), data={'media_type': 'Video'})
+        self.assertFalse(ResultSet.objects.filter(id=result_set.id).exists())
+        response = self.client.get(reverse('arch_app:search'))
+        self.assertEqual(len(response.context_data['record_list']), 2)
+        # expired result sets are deleted
+        ResultSet.objects.update(created_on=datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=settings.RESULT_SET_TTL + 1))
+        self.assertEqual(delete_expired_result_sets(), 1)
+        response = self.client.get(reverse('arch_app:search'))
+        self.assertEqual(len(response.context_data['record_list']), 0)
+
+
+class VectorIndexTest(TestCase, BaseSetup):
+    """ Test for ranking records by their embeddings """
+    def setUp(self):
+        self.setUpDB()
+        self.record_a = Record.objects.create(title='a', type='Image', album=self.archive1.inbox)
+        self.record_b = Record.objects.create(title='b', type='Image', album=self.archive1.inbox)
+        self.record_c = Record.objects.create(title='c', type='Image', album=self.archive2.inbox)
+        self.record_d = Record.objects.create(title='d', type='Image', album=self.archive1.inbox)
+        save_record_embedding(self.record_a.id, self.vector(1.0, 0.0))
+        save_record_embedding(self.record_b.id, self.vector(0.6, 0.8))
+        save_record_embedding(self.record_c.id, self.vector(1.0, 0.1))
+
+    @staticmethod
+    def vector(*values):
+        """ returns a 512-dimensional embedding starting with the given values """
+        return list(values) + [0.0] * (512 - len(values))
+
+    def test_rank_by_embedding(self):
+        """ records are ranked by cosine similarity, records without embedding are skipped """
+        similarities = rank_by_embedding(self.vector(2.0), Record.objects.all())
+        self.assertEqual(len(similarities), 3)
+        self.assertAlmostEqual(similarities[self.record_a.id], 1.0, places=5)
+        self.assertAlmostEqual(similarities[self.record_b.id], 0.6, places=5)
+        self.assertNotIn(self.record_d.id, similarities)
+
+    def test_rank_by_embedding_filtered(self):
+        """ only the given records are ranked """
+        similarities = rank_by_embedding(self.vector(1.0), Record.objects.filter(album=self.archive1.inbox))
+        self.assertNotIn(self.record_c.id, similarities)
+        similarities = rank_by_embedding(self.vector(1.0), Record.objects.all(), top_k=1)
+        self.assertEqual(list(similarities), [self.record_a.id])
+
+    def test_similarity_expression(self):
+        """ the similarity is only computed by the database with pgvector, the similarities are not passed as SQL """
+        with self.assertRaises(ValueError):
+            similarity_expression(self.vector(1.0), Record.objects.all())
+
+    def test_pgvector_few_permitted_records(self):
+        """
+        the HNSW index filters the permitted records after the scan, a user who may see only a few records is searched
+        without the index, the index scan of the others is continued until enough permitted records are found
+        """
+        assign_perm('view_record', self.user2, self.record_c)
+        for record in (self.record_a, self.record_b, self.record_c, self.record_d):
+            assign_perm('view_record', self.user1, record)
+        few = RecordVisibility.objects.filter_records(self.user2, Record.objects.all())
+        many = RecordVisibility.objects.filter_records(self.user1, Record.objects.all())
+        self.assertEqual(list(few), [self.record_c])
+        with override_settings(VECTOR_SEARCH_BACKEND='pgvector', VECTOR_SEARCH_EXACT_LIMIT=2), \
+                modify_settings(INSTALLED_APPS={'append': 'arch_vector.apps.ArchVectorConfig'}):
+            self.assertTrue(exact_scan(few))
+            self.assertFalse(exact_scan(many))
+            # only the ascending order of the distance is answered by the index
+            self.assertIn('DESC', str(_nearest_vectors(np.ones(512, dtype=np.float32), few, 10).query))
+            self.assertNotIn('DESC', str(_nearest_vectors(np.ones(512, dtype=np.float32), many, 10).query))
+            # the vectors of a previous image model are not compared
+            self.assertIn('model_version', str(_nearest_vectors(np.ones(512, dtype=np.float32), many, 10).query))
+            with CaptureQueriesContext(connection) as queries, vector_search_scope():
+                pass
+            self.assertIn('hnsw.iterative_scan', ' '.join(query['sql'] for query in queries))
+
+    def test_mmap_backend(self):
+        """ the memory-mapped index returns the same ranking as the exact ranking in python """
+        expected = rank_by_embedding(self.vector(1.0, 0.2), Record.objects.all())
+        with tempfile.TemporaryDirectory() as path, \
+                override_settings(VECTOR_SEARCH_BACKEND='mmap', VECTOR_INDEX_PATH=path, VECTOR_INDEX_DTYPE='float32'):
+            call_command('build_vector_index', stdout=StringIO())
+            similarities = rank_by_embedding(self.vector(1.0, 0.2), Record.objects.all())
+            self.assertEqual(similarities.keys(), expected.keys())
+            for record_id, similarity in expected.items():
+                self.assertAlmostEqual(similarities[record_id], similarity, places=5)
+            # new embeddings are added to the shard of the archive of the record
+            save_record_embedding(self.record_d.id, self.vector(0.0, 1.0))
+            similarities = rank_by_embedding(self.vector(0.0, 1.0), Record.objects.filter(album=self.archive1.inbox),
+                                             top_k=1)
+            self.assertEqual(list(similarities), [self.record_d.id])
+
+    def test_mmap_dimensions(self):
+        """ the index is built with the width of the stored embeddings of the image model """
+        with tempfile.TemporaryDirectory() as path, \
+                override_settings(VECTOR_SEARCH_BACKEND='mmap', VECTOR_INDEX_PATH=path, VECTOR_INDEX_DTYPE='float32'):
+            for record in (self.record_a, self.record_b, self.record_c):
+                save_record_embedding(record.id, np.ones(8, dtype=np.float32))
+            save_record_embedding(self.record_d.id, -np.ones(8, dtype=np.float32))
+            call_command('build_vector_index', stdout=StringIO())
+            similarities = rank_by_embedding(-np.ones(8, dtype=np.float32), Record.objects.all(), top_k=1)
+            self.assertEqual(list(similarities), [self.record_d.id])
+        self.assertEqual(RecordEmbedding.dimensions(b'\x00' * 16, 'float16'), 8)
+
+    def test_mmap_index_updates(self):
+        """ added embeddings replace the previous embedding of a record, the delta is merged into the matrix """
+        with tempfile.TemporaryDirectory() as path:
+            index = MmapVectorIndex(path, dtype='float16', compact_size=2)
+            reader = MmapVectorIndex(path, dtype='float16')
+            ids = [self.record_a.id, self.record_b.id, self.record_c.id]
+            index.add(1, ids[:1], [self.vector(1.0)])
+            self.assertEqual(list(reader.search(self.vector(1.0), {1: ids})), ids[:1])
+            index.add(1, ids[1:], [self.vector(0.0, 1.0), self.vector(1.0, 1.0)])
+            index.add(1, ids[:1], [self.vector(0.0, -1.0)])
+            similarities = reader.search(self.vector(0.0, 1.0), {1: ids})
+            self.assertAlmostEqual(similarities[self.record_a.id], -1.0, places=3)
+            self.assertAlmostEqual(similarities[self.record_b.id], 1.0, places=3)
+            # only the permitted records of the requested archives are ranked
+            self.assertEqual(list(reader.search(self.vector(1.0), {1: ids[1:2], 2: ids})), ids[1:2])
+            # the files of previous versions are removed (lock, shard.json, main and delta with their ids)
+            self.assertEqual(len(os.listdir(index.shard_path(1))), 6)
+
+    @override_settings(EMBEDDING_DTYPE='float16')
+    def test_embedding_storage(self):
+        """ embeddings are stored in binary form per model version and are not selected with the records """
+        save_record_embedding(self.record_a.id, self.vector(0.5, 0.25))
+        embedding = RecordEmbedding.objects.get(record=self.record_a)
+        self.assertEqual((embedding.dtype, len(embedding.vector)), ('float16', 512 * 2))
+        self.assertEqual(embedding.get_vector()[:3].tolist(), [0.5, 0.25, 0.0])
+        self.assertEqual(self.record_a.embeddings.count(), 1)
+        with CaptureQueriesContext(connection) as queries:
+            list(Record.objects.all())
+        self.assertNotIn('embedding', queries[0]['sql'])
+
+    @override_settings(ACTIVATE_AI_SEARCH=True)
+    def test_regenerate_stale_embeddings(self):
+        """ only missing and stale embeddings are generated, a failing record does not stop the command """
+        def embed_images(records):
+            return [False if record == self.record_b else self.vector(0.0, 1.0) for record in records]
+
+        def embedded_records(embed):
+            return [record for call in embed.call_args_list for record in call.args[0]]
+
+        with patch('arch_app.management.commands.regenerate_embeddings.Command.embed_images',
+                   side_effect=embed_images) as embed:
+            call_command('regenerate_embeddings', stdout=StringIO())
+            # only record_d has no embedding
+            self.assertEqual(embedded_records(embed), [self.record_d])
+            with override_settings(QUANTIZE_CLIP_MODELS=not settings.QUANTIZE_CLIP_MODELS):
+                embed.reset_mock()
+                call_command('regenerate_embeddings', '--batch-size=3', '--delete-stale', stdout=StringIO())
+                self.assertEqual([len(call.args[0]) for call in embed.call_args_list], [3, 1])
+                self.assertEqual(set(RecordEmbedding.objects.values_list('record', flat=True)),
+                                 {self.record_a.id, self.record_b.id, self.record_c.id, self.record_d.id})
+                # the record which failed is embedded by the next run
+                embed.reset_mock()
+                call_command('regenerate_embeddings', stdout=StringIO())
+                self.assertEqual(embedded_records(embed), [self.record_b])
+
+
+class RecordVisibilityTest(TestCase, BaseSetup):
+    """ Test for the table of records visible to a user """
+    def setUp(self):
+        self.setUpDB()
+        self.users = [self.user1, self.user2, self.user3, self.user4, self.user5, self.user6]
+        with open(os.path.join(self.sample_files_dir, '500kb.png'), 'rb') as file:
+            image = file.read()
+        self.client.login(username='member1', password='123')
+        self.client.post(reverse('arch_app:upload_record',
+                                 kwargs={'archive_name': self.archive1.name, 'archive_id': self.archive1.id}),
+                         data={'files': [SimpleUploadedFile("image.png", image)]})
+        self.record = Record.objects.get(title='image')
+
+    def visible_users(self, record):
+        return set(User.objects.filter(visible_records__record=record))
+
+    def assertConsistent(self):
+        """ the visibility table returns the same records as the guardian permissions """
+        for user in self.users:
+            self.assertEqual(set(RecordVisibility.objects.filter_records(user, Record.objects.all())),
+                             set(get_objects_for_user(user, 'view_record', Record.objects.all())))
+
+    def test_upload(self):
+        """ the creator and the moderators of the archive can view an uploaded record """
+        self.assertEqual(self.visible_users(self.record), {self.user1, self.user3})
+        self.assertConsistent()
+
+    def test_depicted_users(self):
+        """ tagged users can view the record """
+        self.record.depicted_users.user_set.add(self.user2)
+        self.assertEqual(self.visible_users(self.record), {self.user1, self.user2, self.user3})
+        self.user2.groups.remove(self.record.depicted_users)
+        self.assertEqual(self.visible_users(self.record), {self.user1, self.user3})
+        self.assertConsistent()
+
+    def test_membership(self):
+        """ moderators joining or leaving the archive gain or lose access """
+        membership = Membership.objects.create(user=self.user6, archive=self.archive1, role='moderator')
+        self.assertIn(self.user6, self.visible_users(self.record))
+        membership.delete()
+        self.assertNotIn(self.user6, self.visible_users(self.record))
+        self.archive1.moderators.user_set.clear()
+        self.assertEqual(self.visible_users(self.record), {self.user1})
+        self.assertConsistent()
+
+    def test_permissions(self):
+        """ assigning and removing permissions of users and groups updates the visibility """
+        remove_perm('view_record', self.user1, self.record)
+        self.assertEqual(self.visible_users(self.record), {self.user3})
+        assign_perm('view_record', self.archive2.moderators, self.record)
+        self.assertEqual(self.visible_users(self.record), {self.user3, self.user4})
+        self.assertConsistent()
+        self.record.delete()
+        self.assertFalse(RecordVisibility.objects.exists())
+
+    def test_rebuild(self):
+        """ the management command recomputes the same table """
+        self.record.depicted_users.user_set.add(self.user5)
+        expected = set(RecordVisibility.objects.values_list('user_id', 'record_id'))
+        RecordVisibility.objects.all().delete()
+        call_command('rebuild_record_visibility', stdout=open(os.devnull, 'w'))
+        self.assertEqual(set(RecordVisibility.objects.values_list('user_id', 'record_id')), expected)
+
+
+class AutocompleteSuggestionTest(TestCase, BaseSetup):
+    """ Test for the autocomplete suggestions of the search bar """
+    def setUp(self):
+        self.setUpDB()
+        with open(os.path.join(self.sample_files_dir, '500kb.png'), 'rb') as file:
+            image = file.read()
+        self.client.login(username='member1', password='123')
+        self.client.post(reverse('arch_app:upload_record',
+                                 kwargs={'archive_name': self.archive1.name, 'archive_id': self.archive1.id}),
+                         data={'files': [SimpleUploadedFile("image.png", image),
+                                         SimpleUploadedFile("image2.png", image)]})
+        self.record = Record.objects.get(title='image')
+        self.record2 = Record.objects.get(title='image2')
+
+    def suggest(self, autocomplete, term):
+        response = self.client.get(reverse('arch_app:autocomplete'), data={'autocomplete': autocomplete, 'term': term})
+        return response.json()
+
+    def test_record_changes(self):
+        """ suggestions are weighted by the number of records and follow changes of the records """
+        self.assertEqual(self.suggest('search_input', 'im'), ['image', 'image2'])
+        self.record2.title = 'Image'
+        self.record2.user_caption = 'Sommerfest im Garten'
+        self.record2.save()
+        self.assertEqual(AutocompleteSuggestion.objects.get(display_text='image').weight, 1)
+        self.assertEqual(self.suggest('search_input', 'IMAGE'), ['Image', 'image'])
+        self.assertEqual(self.suggest('search_input', 'garten'), ['Sommerfest im Garten'])
+        self.assertFalse(AutocompleteSuggestion.objects.filter(display_text='image2').exists())
+        self.record2.delete()
+        self.assertEqual(self.suggest('search_input', 'im'), ['image'])
+        self.assertEqual(AutocompleteSuggestion.objects.count(), 1)
+
+    def test_long_captions(self):
+        """ long captions are displayed truncated and matched by the words after the truncation """
+        prefix = 'Sommerfest der Nachbarschaft im Garten hinter dem alten Rathaus am Marktplatz '
+        self.record.user_caption = prefix + 'mit Kuchenbuffet'
+        self.record.save()
+        self.record2.user_caption = prefix + 'mit Laternenumzug'
+        self.record2.save()
+        self.assertEqual(self.suggest('search_input', 'kuchenbuffet'), [prefix[:70] + '...'])
+        self.assertEqual(self.suggest('search_input', 'laternen'), [prefix[:70] + '...'])
+        self.assertEqual(AutocompleteSuggestion.objects.filter(display_text=prefix[:70] + '...').count(), 2)
+
+    def test_location_and_tags(self):
+        """ locations and depicted users (active members of the archives of the user) are suggested """
+        self.record.location = Location.objects.create(name='Osnabrück', country='Germany')
+        self.record.save()
+        self.assertEqual(self.suggest('search_location', 'osnab'), ['Osnabrück'])
+        self.record.location.name = 'Münster'
+        self.record.location.save()
+        self.assertEqual(self.suggest('search_location', 'munster'), ['Münster'])
+        Tag.objects.create(record=self.record, user=self.user3)
+        Tag.objects.create(record=self.record, user=self.user2)
+        self.assertEqual(self.suggest('search_depicted_users', 'mod'), ['mod1'])
+        self.assertEqual(self.suggest('search_depicted_users', 'member2'), [])
+        self.user3.first_name = 'Moritz'
+        self.user3.save()
+        self.assertCountEqual(self.suggest('search_depicted_users', 'mo'), ['mod1', 'Moritz'])
+        Tag.objects.get(user=self.user3).delete()
+        self.assertEqual(self.suggest('search_depicted_users', 'mo'), [])
+
+    def test_permissions(self):
+        """ only suggestions of records the user may view are returned """
+        self.client.logout()
+        self.client.login(username='member2', password='123')
+        self.assertEqual(self.suggest('search_input', 'image'), [])
+        self.client.logout()
+        self.client.login(username='mod1', password='123')
+        self.assertEqual(self.suggest('search_input', 'image'), ['image', 'image2'])
+
+    def test_rebuild(self):
+        """ the management command recomputes the same suggestions """
+        expected = set(AutocompleteSuggestion.objects.values_list('archive_id', 'kind', 'display_text', 'weight'))
+        AutocompleteSuggestion.objects.all().delete()
+        call_command('rebuild_autocomplete_suggestions', stdout=open(os.devnull, 'w'))
+        self.assertEqual(set(AutocompleteSuggestion.objects.values_list('archive_id', 'kind', 'display_text',
+                                                                         'weight')), expected)
+
+
+class SearchBenchmarkTest(TestCase):
+    """ Test for the search benchmark command """
+    def test_benchmark_search(self):
+        out = StringIO()
+        call_command('benchmark_search', records=60, archives=2, users=6, batch_size=25, queries=20, warmup=2,
+                     stdout=out)
+        self.assertIn('p95 ms', out.getvalue())
+        self.assertEqual(Record.objects.count(), 60)
+        # users only find records of their archive
+        user = User.objects.get(username='benchmark_user_1')
+        visible = RecordVisibility.objects.filter_records(user, Record.objects.all())
+        self.assertTrue(visible.exists())
+        self.assertEqual(set(visible.values_list('album__archive__name', flat=True)), {'Benchmark Archive 1'})
+        call_command('benchmark_search', reuse=True, clean=True, queries=5, warmup=0, ranking_mode='sql',
+                     stdout=StringIO())
+        self.assertFalse(Record.objects.exists())
+
+
+class EmbeddingCacheTest(TestCase):
+    """ Test for the cache of search query embeddings """
+    def setUp(self):
+        self.computed = []
+
+    def compute(self, query):
+        """ fake text model, returns the length of the query """
+        self.computed.append(query)
+        return [float(len(query)), 1.0]
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  Summer   Camp '), 'Summer Camp')
+
+    def test_query_case(self):
+        """ the text model gets the query with its case, queries differing in case do not share a cache entry """
+        with patch('arch_app.modules.embeddings.text_image_embedding.encode_text', self.compute), \
+                patch('arch_app.modules.embeddings.text_image_embedding.text_embedding_cache', EmbeddingCache()):
+            generate_text_embedding(' Paris ')
+            generate_text_embedding('paris')
+            generate_text_embedding('Paris')
+        self.assertEqual(self.computed, ['Paris', 'paris'])
+
+    def test_lru(self):
+        """ repeated queries are served from the cache, the least recently used entry is evicted """
+        cache = EmbeddingCache(max_size=2)
+        cache.get_or_compute('model', 'a', self.compute)
+        cache.get_or_compute('model', 'bb', self.compute)
+        embedding = cache.get_or_compute('model', 'a', self.compute)
+        self.assertEqual(embedding.tolist(), [1.0, 1.0])
+        self.assertEqual(self.computed, ['a', 'bb'])
+        # 'bb' is evicted, 'a' was used more recently
+        cache.get_or_compute('model', 'ccc', self.compute)
+        cache.get_or_compute('model', 'a', self.compute)
+        cache.get_or_compute('model', 'bb', self.compute)
+        self.assertEqual(self.computed, ['a', 'bb', 'ccc', 'bb'])
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (2, 4, 2))
+
+    def test_model_version(self):
+        """ embeddings of another model version are not reused """
+        cache = EmbeddingCache(max_size=10)
+        cache.get_or_compute('model_1', 'a', self.compute)
+        cache.get_or_compute('model_2', 'a', self.compute)
+        self.assertEqual(self.computed, ['a', 'a'])
+
+    def test_shared_cache(self):
+        """ embeddings computed by another process are found in the shared cache """
+        other_process = EmbeddingCache(max_size=10, shared_cache='default')
+        other_process.get_or_compute('model', 'a', self.compute)
+        cache = EmbeddingCache(max_size=10, shared_cache='default')
+        embedding = cache.get_or_compute('model', 'a', self.compute)
+        self.assertEqual(embedding.tolist(), [1.0, 1.0])
+        self.assertEqual(self.computed, ['a'])
+        self.assertEqual(cache.info()['shared_hits'], 1)
+
+
+class ModelRegistryTest(TestCase):
+    """ Test for the lazy loading and the idle eviction of the AI models """
+    def setUp(self):
+        self.now = 0
+        self.loaded = []
+        self.registry = ModelRegistry(idle_timeout=60, clock=lambda: self.now)
+        for name in ('image', 'text'):
+            self.registry.register(name, lambda name=name: self.loaded.append(name) or f'{name} model')
+
+    def tearDown(self):
+        if self.registry.timer:
+            self.registry.timer.cancel()
+
+    def test_lazy_loading(self):
+        """ every model is loaded independently on its first use """
+        self.assertEqual(self.registry.get('text'), 'text model')
+        self.registry.get('text')
+        self.assertEqual(self.loaded, ['text'])
+        self.assertFalse(self.registry.is_loaded('image'))
+
+    def test_idle_eviction(self):
+        """ models which were not used within the idle timeout are evicted, pinned models are kept """
+        self.registry.get('text')
+        self.registry.get('image', pin=True)
+        self.now = 30
+        self.assertEqual(self.registry.evict_idle(), [])
+        self.now = 61
+        self.assertEqual(self.registry.evict_idle(), ['text'])
+        self.assertTrue(self.registry.is_loaded('image'))
+        # the model is loaded again on its next use
+        self.registry.get('text')
+        self.assertEqual(self.loaded, ['text', 'image', 'text'])
+        status = self.registry.status()
+        self.assertEqual([event['event'] for event in status['events']], ['load', 'load', 'evict', 'load'])
+        self.assertTrue(status['models']['image']['pinned'])
+        self.assertGreater(status['memory_mb'], 0)
+
+
+class WorkerWarmupTest(TestCase):
+    """ Test for the warm-up of the qcluster worker processes """
+    def test_warmup_hook(self):
+        """ the warm-up hook runs when a worker starts, a failing hook does not stop the worker """
+        with patch('arch_app.workers.warm_up_models') as warm_up:
+            post_spawn.send(sender='django_q', proc_name='Process-1')
+            warm_up.assert_called_once()
+            warm_up.side_effect = RuntimeError('out of memory')
+            post_spawn.send(sender='django_q', proc_name='Process-2')
+            with override_settings(QCLUSTER_WARMUP_HOOK=''):
+                post_spawn.send(sender='django_q', proc_name='Process-3')
+            self.assertEqual(warm_up.call_count, 2)
+
+    def test_memory_budget(self):
+        """ models which exceed the memory budget are not preloaded """
+        with override_settings(QCLUSTER_MEMORY_BUDGET=1):
+            self.assertFalse(fits_memory_budget('face_detection_yunet'))
+        with override_settings(QCLUSTER_MEMORY_BUDGET=0):
+            self.assertTrue(fits_memory_budget('embedding'))
+        # the estimates are replaced by the configured memory of the models
+        budget = int(resident_memory()) + 500
+        with override_settings(QCLUSTER_MEMORY_BUDGET=budget, QCLUSTER_MODEL_MEMORY={}):
+            self.assertFalse(fits_memory_budget('face_detection_cvlib'))
+        with override_settings(QCLUSTER_MEMORY_BUDGET=budget, QCLUSTER_MODEL_MEMORY={'face_detection_cvlib': 100}):
+            self.assertTrue(fits_memory_budget('face_detection_cvlib'))
+
+
+class StartupTest(TestCase):
+    """ Test for the import time of the web processes """
+    def test_parse_importtime(self):
+        output = ('import time: self [us] | cumulative | imported package\n'
+                  'import time:       120 |        120 |   numpy.core\n'
+                  'import time:      2000 |       2120 | numpy\n')
+        self.assertEqual(parse_importtime(output), [('numpy.core', 0.00012, 0.00012), ('numpy', 0.002, 0.00212)])
+
+    def test_lazy_imports(self):
+        """ the views and tasks do not import the AI libraries, ffmpeg or scipy """
+        code = ("import os, sys, django; os.environ['DJANGO_SETTINGS_MODULE'] = 'arch.settings'; django.setup(); "
+                "import arch.urls, arch_app.tasks; "
+                "print(sorted({'torch', 'sentence_transformers', 'cvlib', 'tensorflow', 'ffmpeg', 'scipy'} & "
+                "set(sys.modules)))")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR, env={**os.environ, 'ACTIVATE_AI_SEARCH': '1',
+                                                            'ACTIVATE_FACE_DETECTION': '1'})
+        self.assertEqual(result.stdout.strip(), '[]', result.stderr)
+
+
+class ClipBackendTest(TestCase):
+    """ Test for the ONNX Runtime backend of the CLIP models """
+    def test_preprocess_images(self):
+        """ images are resized to 224 pixels on the shortest side, center cropped and normalized """
+        img = Image.new('RGB', (448, 224), (255, 255, 255))
+        img.paste((0, 0, 0), (0, 0, 112, 224))
+        pixels = preprocess_images([img])
+        self.assertEqual(pixels.shape, (1, 3, 224, 224))
+        # the black stripe is cropped
+        self.assertTrue(np.allclose(pixels[0, :, :, 0], ((1 - CLIP_MEAN) / CLIP_STD)[:, None], atol=1e-2))
+
+    def test_model_versions(self):
+        """ the embeddings of the quantized ONNX models are stored as another model version """
+        with override_settings(QUANTIZE_CLIP_MODELS=False, CLIP_BACKEND='onnx'):
+            fp32_version = get_image_model_version()
+        with override_settings(QUANTIZE_CLIP_MODELS=False, CLIP_BACKEND='torch'):
+            self.assertEqual(get_image_model_version(), fp32_version)
+        with override_settings(QUANTIZE_CLIP_MODELS=True, CLIP_BACKEND='onnx'):
+            onnx_version = get_image_model_version()
+        with override_settings(QUANTIZE_CLIP_MODELS=True, CLIP_BACKEND='torch'):
+            self.assertEqual(len({get_image_model_version(), onnx_version, fp32_version}), 3)
+
+    def test_model_not_exported(self):
+        """ the models are not exported when they are loaded, the error refers to the export command """
+        with override_settings(IMAGE_EMBEDDING_MODEL='not-exported-model'):
+            with self.assertRaisesMessage(FileNotFoundError, 'manage.py export_onnx_models'):
+                load_onnx_image_model(quantize=True)
+
+
+class ImageLoadingTest(TestCase):
+    """ Test for decoding images at reduced size """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'photo.jpg')
+        # 1600 x 1200 photo taken in portrait orientation (displayed rotated by 90 degrees)
+        img = Image.new('RGB', (1600, 1200), (0, 0, 0))
+        img.paste((255, 255, 255), (0, 0, 400, 300))
+        exif = img.getexif()
+        exif[274] = 6
+        img.save(self.path, exif=exif)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_load_image(self):
+        """ images are reduced to the target size and rotated according to their EXIF orientation """
+        self.assertEqual(get_image_size(self.path), (1200, 1600))
+        img, original_size = load_image(self.path, 200, side='long')
+        self.assertEqual((img.size, original_size), ((150, 200), (1200, 1600)))
+        # the white corner is displayed at the top right
+        self.assertGreater(img.getpixel((140, 10))[0], 200)
+        self.assertLess(img.getpixel((10, 10))[0], 50)
+        img, _ = load_image(self.path, 224)
+        self.assertEqual(img.size, (224, 299))
+        img, _ = load_image(self.path, 5000)
+        self.assertEqual(img.size, (1200, 1600))
+
+    def test_scale_boxes(self):
+        """ boxes detected on the reduced image refer to the original image """
+        self.assertEqual(scale_boxes([(10, 20, 30, 40)], (150, 200), (1200, 1600)), [(80, 160, 240, 320)])
+
+
+    def test_face_detector_backend(self):
+        """ the detector of settings.FACE_DETECTOR gets the reduced RGB image, its boxes refer to the original image """
+        class FakeDetector(FaceDetector):
+            name = 'fake'
+
+            def detect(self, image):
+                self.shape = image.shape
+                return [(10, 20, 30, 40)]
+
+        detector = FakeDetector()
+        with override_settings(FACE_DETECTOR='fake', FACE_DETECTION_IMAGE_SIZE=200), \
+                patch.dict(face_detection.detectors, {'fake': detector}):
+            self.assertEqual(face_detection.detect_faces_locally(self.path), [(80, 160, 240, 320)])
+        self.assertEqual(detector.shape, (200, 150, 3))
+        with self.assertRaises(ValueError):
+            create_detector('unknown')
+
+    def test_cvlib_channel_order(self):
+        """ cvlib gets the RGB image as before the backends were added """
+        detector = CvlibFaceDetector.__new__(CvlibFaceDetector)
+        detector.threshold = 0.5
+        images = []
+        detector.cvlib = type('cvlib', (), {'detect_face': staticmethod(
+            lambda image, threshold: images.append(image) or ([[1, 2, 3, 4]], [0.9]))})
+        image = np.zeros((4, 4, 3), dtype=np.uint8)
+        image[:, :, 0] = 255
+        self.assertEqual(detector.detect(image), [(1, 2, 3, 4)])
+        self.assertTrue(np.array_equal(images[0], image))
+
+    def test_face_detector_weights(self):
+        """ the weights are only kept and loaded with a matching checksum, the detectors do not download them """
+        content = b'weights'
+        checksum = hashlib.sha256(content).hexdigest()
+        names = ['deploy.prototxt', 'res10_300x300_ssd_iter_140000.caffemodel']
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('arch_app.modules.computer_vision.face_detectors.get_model_path',
+                      lambda name: os.path.join(directory, name)), \
+                patch('urllib.request.urlretrieve', lambda url, path: open(path, 'wb').write(content)):
+            with self.assertRaisesMessage(FileNotFoundError, 'download_face_detectors'):
+                load_weights('ssd')
+            with override_settings(FACE_DETECTOR_WEIGHTS_SHA256={}):
+                with self.assertRaisesMessage(ValueError, checksum):
+                    download_weights('ssd')
+                self.assertEqual(os.listdir(os.path.join(directory, 'face_detection_ssd')), [])
+            with override_settings(FACE_DETECTOR_WEIGHTS_SHA256={name: checksum for name in names}):
+                self.assertEqual(len(download_weights('ssd')), 2)
+                self.assertEqual(download_weights('ssd'), [])
+                self.assertEqual([os.path.basename(path) for path in load_weights('ssd')], names)
+            with override_settings(FACE_DETECTOR_WEIGHTS_SHA256={name: '0' * 64 for name in names}):
+                with self.assertRaisesMessage(ValueError, 'instead of'):
+                    load_weights('ssd')
+            with override_settings(FACE_DETECTOR_YUNET_REVISION=''):
+                with self.assertRaisesMessage(ValueError, 'FACE_DETECTOR_YUNET_REVISION'):
+                    download_weights('yunet')
+
+    def test_box_matching(self):
+        """ boxes of two backends are matched by their intersection over union """
+        self.assertAlmostEqual(box_iou((0, 0, 10, 10), (5, 0, 15, 10)), 1 / 3)
+        self.assertEqual(box_iou((0, 0, 10, 10), (20, 20, 30, 30)), 0)
+        self.assertEqual(match_boxes([(0, 0, 10, 10), (20, 20, 30, 30)], [(1, 1, 10, 10)]), 1)
+
+class InferenceServerTest(TestCase):
+    """ Test for the local inference server and its client """
+    def setUp(self):
+        self.batches = []
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.directory.name, 'inference.sock')
+        self.server = InferenceServer(self.socket_path, self.embed_texts, self.embed_images, self.detect_faces,
+                                      max_batch_size=8, max_wait=0.2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def embed_texts(self, texts):
+        """ fake text model, returns the length of each text """
+        self.batches.append(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    @staticmethod
+    def embed_images(paths):
+        return [False if path.endswith('.txt') else [1.0, 0.0] for path in paths]
+
+    @staticmethod
+    def detect_faces(paths):
+        return [[(1, 2, 3, 4)] for _path in paths]
+
+    def test_requests(self):
+        with override_settings(INFERENCE_SOCKET=self.socket_path):
+            self.assertEqual(inference_client.embed_texts(['abc'])[0].tolist(), [3.0, 1.0])
+            embeddings = inference_client.embed_images(['a.jpg', 'b.txt'])
+            self.assertEqual((embeddings[0].tolist(), embeddings[1]), ([1.0, 0.0], False))
+            self.assertEqual(inference_client.detect_faces('a.jpg'), [(1, 2, 3, 4)])
+
+    def test_micro_batching(self):
+        """ concurrent requests are processed in one batch """
+        results = {}
+
+        def embed(text):
+            results[text] = inference_client.embed_texts([text])[0].tolist()
+
+        with override_settings(INFERENCE_SOCKET=self.socket_path):
+            threads = [threading.Thread(target=embed, args=('x' * length,)) for length in range(1, 5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, {'x' * length: [float(length), 1.0] for length in range(1, 5)})
+            self.assertLess(len(self.batches), 4)
+            self.assertEqual(inference_client.status()['embed_texts']['requests'], 4)
+
+    def test_server_not_available(self):
+        with override_settings(INFERENCE_SOCKET=os.path.join(self.directory.name, 'missing.sock')):
+            with self.assertRaises(inference_client.InferenceError):
+                inference_client.embed_texts(['abc'])
+
+
+class FaceDetectionBackfillTest(TestCase, BaseSetup):
+    """ Test for the detection of faces on the images uploaded before the face detection was activated """
+    class FakeDetector(FaceDetector):
+        """ finds one face on images wider than 100 pixels """
+        name = 'fake'
+
+        def detect(self, image):
+            return [(0, 0, 10, 10)] if image.shape[1] > 100 else []
+
+    def setUp(self):
+        self.setUpDB()
+        self.directory = tempfile.TemporaryDirectory()
+        self.media_root = override_settings(MEDIA_ROOT=self.directory.name)
+        self.media_root.enable()
+        self.records = []
+        for title, size in (('wide', (400, 200)), ('small', (50, 50)), ('broken', None)):
+            content = b'no image'
+            if size:
+                output = tempfile.SpooledTemporaryFile()
+                Image.new('RGB', size).save(output, format='JPEG')
+                output.seek(0)
+                content = output.read()
+            self.records.append(Record.objects.create_record('Image', title, self.archive1.inbox, self.user1,
+                                                             content, f'{title}.jpg'))
+        self.tagged = Record.objects.create(title='tagged', type='Image', album=self.archive1.inbox)
+        TagBox.objects.create(record=self.tagged, x1=1, y1=1, x2=2, y2=2, height=10, width=10)
+
+    def tearDown(self):
+        self.media_root.disable()
+        self.directory.cleanup()
+
+    def test_backfill(self):
+        """ faces are detected once per record, records which failed or already have tag boxes are skipped """
+        with override_settings(ACTIVATE_FACE_DETECTION=True, FACE_DETECTOR='fake', FACE_DETECTION_IMAGE_SIZE=200), \
+                patch.dict(face_detection.detectors, {'fake': self.FakeDetector()}):
+            call_command('detect_faces', '--batch-size=2', stdout=StringIO())
+            wide, small, broken = self.records
+            self.assertEqual(list(TagBox.objects.filter(record=wide).values_list('x1', 'x2', 'width', 'height')),
+                             [(0, 20, 400, 200)])
+            self.assertFalse(TagBox.objects.filter(record=small).exists())
+            self.assertEqual(set(Record.objects.filter(faces_detected__isnull=False).values_list('title', flat=True)),
+                             {'wide', 'small'})
+            # only the record which failed is processed again
+            output = StringIO()
+            call_command('detect_faces', stdout=output)
+            self.assertIn('0 faces on 0 images, 1 images failed', output.getvalue())
+            self.assertEqual(TagBox.objects.count(), 2)
+
+
+class TagBoxBulkTest(TestCase, BaseSetup):
+    """ Test for creating all TagBoxes of a record at once """
+    def setUp(self):
+        self.setUpDB()
+        self.record = Record.objects.create(title='group photo', type='Image', album=self.archive1.inbox,
+                                            media_file='group_photo.jpg')
+
+    def test_create_detected_faces(self):
+        """ the boxes of all detected faces are inserted with a constant number of queries """
+        faces = [(index, index, index + 10, index + 10) for index in range(20)]
+        with patch('arch_app.modules.computer_vision.face_detection.detect_faces', return_value=faces), \
+                patch('arch_app.tasks.get_image_size', return_value=(800, 600)), \
+                CaptureQueriesContext(connection) as queries:
+            self.assertTrue(create_tagboxes_and_save(self.record.id))
+        self.assertLess(len(queries), 10)
+        self.assertEqual(TagBox.objects.filter(record=self.record, width=800, height=600).count(), 20)
+        self.assertEqual(sorted(TagBox.objects.values_list('x1', flat=True)), list(range(20)))
+
+    def test_existing_faces(self):
+        """ detected faces which are already tagged (e.g. imported from the metadata) are not added again """
+        TagBox.objects.create_for_record(self.record, [TagBox(x1=10, y1=10, x2=20, y2=20, height=300, width=400)])
+        with patch('arch_app.modules.computer_vision.face_detection.detect_faces',
+                   return_value=[(21, 19, 41, 41), (100, 100, 120, 120)]), \
+                patch('arch_app.tasks.get_image_size', return_value=(800, 600)):
+            create_tagboxes_and_save(self.record.id)
+        self.assertEqual(sorted(TagBox.objects.values_list('x1', 'width')), [(10, 400), (100, 800)])
+
+    def test_depicted_users(self):
+        """ the visible tagged users are added to the depicted users of the record """
+        TagBox.objects.create_for_record(self.record, [
+            TagBox(user=self.user1, x1=0, y1=0, x2=1, y2=1, height=10, width=10),
+            TagBox(user=self.user2, visible='hidden_by_user', x1=0, y1=0, x2=1, y2=1, height=10, width=10),
+            TagBox(x1=0, y1=0, x2=1, y2=1, height=10, width=10),
+        ])
+        self.record.refresh_from_db()
+        self.assertEqual(list(self.record.depicted_users.user_set.all()), [self.user1])
+        self.assertTrue(RecordVisibility.objects.filter(user=self.user1, record=self.record).exists())
+        self.assertEqual(Tag.objects.filter(record=self.record).count(), 3)
+
+
+class PreviewRenderingTest(TestCase, BaseSetup):
+    """ Test for rendering the previews of images with the hidden faces blurred """
+    def setUp(self):
+        self.setUpDB()
+        self.directory = tempfile.TemporaryDirectory()
+        self.media_root = override_settings(MEDIA_ROOT=self.directory.name)
+        self.media_root.enable()
+        output = tempfile.SpooledTemporaryFile()
+        Image.fromarray(np.random.default_rng(0).integers(0, 256, (100, 200, 3), dtype=np.uint8)).save(output, 'PNG')
+        output.seek(0)
+        self.content = output.read()
+        self.record = Record.objects.create_record('Image', 'group photo', self.archive1.inbox, self.user1,
+                                                   self.content, 'group_photo.png')
+        # the box was detected on the image scaled to half its size
+        self.tagbox = TagBox.objects.create(record=self.record, user=self.user2, x1=10, y1=10, x2=30, y2=30,
+                                            width=100, height=50)
+
+    def tearDown(self):
+        self.media_root.disable()
+        self.directory.cleanup()
+
+    def set_visible(self, visible):
+        self.tagbox.visible = visible
+        self.tagbox.save()
+        return render_preview(self.record)
+
+    def test_render_hidden_faces(self):
+        """ the hidden faces are blurred on the preview, the original is not changed """
+        path = self.set_visible('hidden_by_mod')
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.preview_file.path, path)
+        with open(self.record.media_file.path, 'rb') as original:
+            self.assertEqual(original.read(), self.content)
+        original, preview = np.asarray(Image.open(self.record.media_file.path)), np.asarray(Image.open(path))
+        self.assertFalse(np.array_equal(original[20:60, 20:60], preview[20:60, 20:60]))
+        preview = preview.copy()
+        preview[20:60, 20:60] = original[20:60, 20:60]
+        self.assertTrue(np.array_equal(original, preview))
+
+    def test_cached_previews(self):
+        """ every set of hidden faces is rendered once, previews without hidden faces are copies of the original """
+        with patch('arch_app.modules.computer_vision.preview_rendering.render_image',
+                   wraps=preview_rendering.render_image) as render_image:
+            hidden = self.set_visible('hidden_by_mod')
+            visible = self.set_visible('visible')
+            self.assertEqual(self.set_visible('hidden_by_user'), hidden)
+            self.assertEqual(self.set_visible('visible'), visible)
+        self.assertEqual(render_image.call_count, 2)
+        self.assertNotEqual(hidden, visible)
+        with open(visible, 'rb') as preview:
+            self.assertEqual(preview.read(), self.content)
+
+    def test_blur_original(self):
+        """ the faces of deleted accounts are blurred on the original, the previews are deleted with the record """
+        preview_rendering.blur_original(self.record, TagBox.objects.filter(user=self.user2)
+                                        .values_list(*preview_rendering.BOX_FIELDS))
+        path = self.set_visible('visible')
+        self.assertFalse(np.array_equal(np.asarray(Image.open(self.record.media_file.path)),
+                                        np.asarray(Image.open(BytesIO(self.content)))))
+        with open(path, 'rb') as preview, open(self.record.media_file.path, 'rb') as original:
+            self.assertEqual(preview.read(), original.read())
+        self.record.delete()
+        self.assertEqual(os.listdir(preview_rendering.preview_directory(self.record)), [])
+
+    def test_hide_personal_data(self):
+        """ the previews of the records of a user who hides the personal data are rendered by a task """
+        self.client.login(username='member2', password='123')
+        with patch('arch_app.views.render_preview') as render:
+            self.client.get(reverse('arch_app:hide_personal_data'), HTTP_HOST='testserver')
+        render.assert_not_called()
+        self.record.refresh_from_db()
+        self.assertFalse(np.array_equal(np.asarray(Image.open(self.record.media_file.path)),
+                                        np.asarray(Image.open(self.record.preview_file.path))))
+
+    def test_delete_account(self):
+        """ the faces of a deleted account are blurred on the original and the preview by a task """
+        url = reverse('arch_app:delete_account', kwargs={'uidb64': urlsafe_base64_encode(force_bytes(self.user2.pk)),
+                                                         'token': default_token_generator.make_token(self.user2)})
+        unblurred = render_preview(self.record)
+        with patch('arch_app.views.render_preview') as render:
+            self.client.post(url)
+        render.assert_not_called()
+        self.assertFalse(User.objects.filter(pk=self.user2.pk).exists())
+        self.record.refresh_from_db()
+        with open(self.record.preview_file.path, 'rb') as preview, open(self.record.media_file.path, 'rb') as original:
+            self.assertNotEqual(original.read(), self.content)
+            original.seek(0)
+            self.assertEqual(preview.read(), original.read())
+        # the preview rendered before, which shows the face unblurred, is removed
+        previews = glob.glob(os.path.join(preview_rendering.preview_directory(self.record), f'{self.record.id}_*'))
+        self.assertEqual(previews, [self.record.preview_file.path])
+        self.assertFalse(os.path.exists(unblurred))
+
+
+class FaceRegionsTest(TestCase, BaseSetup):
+    """ Test for importing the face regions stored in the XMP metadata of images """
+    MWG_XMP = b"""<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+        <rdf:Description xmlns:mwg-rs="http://www.metadataworkinggroup.com/schemas/regions/"
+                         xmlns:stDim="http://ns.adobe.com/xap/1.0/sType/Dimensions#"
+                         xmlns:stArea="http://ns.adobe.com/xmp/sType/Area#"><mwg-rs:Regions>
+          <mwg-rs:AppliedToDimensions stDim:w="%d" stDim:h="%d" stDim:unit="pixel"/>
+          <mwg-rs:RegionList><rdf:Bag>
+            <rdf:li><rdf:Description mwg-rs:Name="Ada" mwg-rs:Type="Face">
+              <mwg-rs:Area stArea:x="0.25" stArea:y="0.5" stArea:w="0.1" stArea:h="0.2" stArea:unit="normalized"/>
+            </rdf:Description></rdf:li>
+            <rdf:li><rdf:Description mwg-rs:Type="Pet">
+              <mwg-rs:Area stArea:x="0.5" stArea:y="0.5" stArea:w="0.1" stArea:h="0.1" stArea:unit="normalized"/>
+            </rdf:Description></rdf:li>
+          </rdf:Bag></mwg-rs:RegionList>
+        </mwg-rs:Regions></rdf:Description></rdf:RDF></x:xmpmeta>"""
+    MICROSOFT_XMP = b"""<x:xmpmeta xmlns:x="adobe:ns:meta/">
+        <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+        <rdf:Description xmlns:MP="http://ns.microsoft.com/photo/1.2/"
+                         xmlns:MPRI="http://ns.microsoft.com/photo/1.2/t/RegionInfo#"
+                         xmlns:MPReg="http://ns.microsoft.com/photo/1.2/t/Region#">
+          <MP:RegionInfo rdf:parseType="Resource"><MPRI:Regions><rdf:Bag>
+            <rdf:li rdf:parseType="Resource"><MPReg:Rectangle>0.1, 0.2, 0.3, 0.4</MPReg:Rectangle></rdf:li>
+          </rdf:Bag></MPRI:Regions></MP:RegionInfo>
+        </rdf:Description></rdf:RDF></x:xmpmeta>"""
+
+    @staticmethod
+    def jpeg(size, xmp=b'', orientation=None):
+        """ returns a JPEG file, the XMP packet is appended (it is found anywhere in the file) """
+        output = tempfile.SpooledTemporaryFile()
+        img = Image.new('RGB', size)
+        exif = img.getexif()
+        if orientation:
+            exif[274] = orientation
+        img.save(output, format='JPEG', exif=exif)
+        output.seek(0)
+        return output.read() + xmp
+
+    def test_extract_regions(self):
+        """ MWG areas (center, size) and Microsoft rectangles (top left corner, size) are converted to boxes """
+        self.assertEqual(extract_face_regions(self.jpeg((400, 200), self.MWG_XMP % (400, 200))),
+                         ((400, 200), [(80, 80, 120, 120)]))
+        self.assertEqual(extract_face_regions(self.jpeg((100, 100), self.MICROSOFT_XMP)),
+                         ((100, 100), [(10, 20, 40, 60)]))
+        self.assertEqual(extract_face_regions(self.jpeg((100, 100))), (None, []))
+
+    def test_rotated_image(self):
+        """ regions of the stored image of a rotated photo are converted to the displayed image """
+        # stored 400 x 200, displayed 200 x 400 (rotated by 90 degrees clockwise)
+        displayed = extract_face_regions(self.jpeg((400, 200), self.MWG_XMP % (200, 400), orientation=6))
+        stored = extract_face_regions(self.jpeg((400, 200), self.MWG_XMP % (400, 200), orientation=6))
+        self.assertEqual(displayed, ((200, 400), [(40, 160, 60, 240)]))
+        self.assertEqual(stored, ((200, 400), [(80, 80, 120, 120)]))
+
+    def test_upload(self):
+        """ the faces of images with face regions are not detected, unless the detection is forced """
+        self.setUpDB()
+        self.client.login(username='member1', password='123')
+        url = reverse('arch_app:upload_record', kwargs={'archive_name': self.archive1.name,
+                                                        'archive_id': self.archive1.id})
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root, ACTIVATE_FACE_DETECTION=True), \
+                patch('arch_app.views.async_task') as async_task:
+            self.client.post(url, data={'files': [
+                SimpleUploadedFile('regions.jpg', self.jpeg((400, 200), self.MWG_XMP % (400, 200))),
+                SimpleUploadedFile('plain.jpg', self.jpeg((400, 200)))]})
+            detected = [call.args[1] for call in async_task.call_args_list if call.args[0] == create_tagboxes_and_save]
+            self.assertEqual(detected, [Record.objects.get(title='plain').id])
+            record = Record.objects.get(title='regions')
+            self.assertEqual(list(TagBox.objects.filter(record=record).values_list('x1', 'y1', 'x2', 'y2')),
+                             [(80, 80, 120, 120)])
+            self.assertIsNotNone(record.faces_detected)
+            with override_settings(FORCE_FACE_DETECTION=True):
+                async_task.reset_mock()
+                self.client.post(url, data={'files': [
+                    SimpleUploadedFile('forced.jpg', self.jpeg((400, 200), self.MWG_XMP % (400, 200)))]})
+                self.assertIn(create_tagboxes_and_save, [call.args[0] for call in async_task.call_args_list])
+
+
 class RecordTests(TestCase, BaseSetup):
     """ Test for creating and deleting Record objects """
 
@@ -79,6 +79,8 @@ urlpatterns = [
 
                   # dashboard for usage statistics
                   path('dashboard/', views.DashboardView.as_view(), name='dashboard'),
+                  # AI models loaded by the web process
+                  path('dashboard/ai_models/', views.ai_model_status, name='ai_model_status'),
 
               ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
@@ -5,7 +5,7 @@ from django.contrib.auth.views import LoginView
 from django.db.models.functions import Trunc
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect
-from django.db.models import Case, When, Q, Count
+from django.db.models import Q, Count
 from django.db.utils import IntegrityError, DataError
 from django.template.loader import render_to_string
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
@@ -22,27 +22,38 @@ from django.utils.encoding import force_bytes, force_str
 from django.http import JsonResponse
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib.auth.tokens import PasswordResetTokenGenerator, default_token_generator
-from itertools import chain
 
 from .forms import *
 from .utils import send_email
 from PIL import Image
 # import modules
 from .modules.metadata_extraction.file_processing import extract_metadata, determine_type
+from .modules.metadata_extraction.face_regions import extract_face_regions
 from .modules.search.helpers import SearchMixin
-from .modules.computer_vision.blur_image import blur_image, unblur_image
+from .modules.search.vector_index import vector_search_scope
+from .modules.search.result_sets import create_result_set, get_or_create_result_set, get_result_set, \
+    ranked_records, get_position, remove_record, delete_album_result_sets
+from .modules.computer_vision.preview_rendering import render_preview, BOX_FIELDS
 from guardian.shortcuts import assign_perm, get_objects_for_user, remove_perm
 from datetime import datetime
 import logging
 from django.conf import settings
 
 from django_q.tasks import async_task
-from .tasks import create_tagboxes_and_save, generate_preview_and_save, generate_image_embedding_and_save
+from .tasks import create_tagboxes_and_save, generate_preview_and_save, generate_image_embeddings_and_save, \
+    save_face_boxes, render_preview_and_save, blur_faces_and_save
 
 
 console_logger = logging.getLogger('ARCH_console_logger')
 file_logger = logging.getLogger('ARCH_file_logger')
 PAGINATE_BY = 20
+# maximum number of autocomplete suggestions and the suggestion kinds of the autocomplete types of the search bar
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_KINDS = {
+    'search_input': 'text',
+    'search_location': 'location',
+    'search_depicted_users': 'person',
+}
 
 
 class TokenGenerator(PasswordResetTokenGenerator):
@@ -78,16 +89,13 @@ class CustomLoginView(LoginView):
                 if comment.visible == 'hidden_by_user':
                     comment.visible = 'visible'
                     comment.save()
-            for tagbox in TagBox.objects.filter(user=user):
-                if tagbox.visible == 'hidden_by_user':
-                    unblur_image(
-                        image_path=tagbox.record.preview_file.path,
-                        original_file_path=tagbox.record.media_file.path,
-                        coordinates=(tagbox.x1, tagbox.y1, tagbox.x2, tagbox.y2))
             for tag in Tag.objects.filter(user=user):
                 if tag.visible == 'hidden_by_user':
                     tag.visible = 'visible'
                     tag.save()
+            # render the previews without the blurred faces of the user
+            for record_id in TagBox.objects.filter(user=user).values_list('record', flat=True).distinct():
+                async_task(render_preview_and_save, record_id)
             messages.success(self.request, _('Your data was successfully restored and made visible again.'))
 
         Tracker.objects.create_from_request(request=self.request, content_object=user, user=user)
@@ -287,6 +295,8 @@ class FileUploadView(LoginRequiredMixin, FormMixin, generic.TemplateView):
 
         if form.is_valid():
             files = self.request.FILES.getlist('files')
+            # images embedded in batches after all files are saved
+            embedding_record_ids = []
             for file in files:
                 with (file.open() as f):
                     # process file
@@ -347,16 +357,23 @@ class FileUploadView(LoginRequiredMixin, FormMixin, generic.TemplateView):
 
                     # step 5: generate image dense vector representation if AI search is activated
                     if mime_type == 'image' and settings.ACTIVATE_AI_SEARCH:
-                        async_task(generate_image_embedding_and_save, record.id, sync=True)
-                        # Note: This only works synchronously, because the model is loaded in the task
+                        embedding_record_ids.append(record.id)
 
                     # step 6: generate preview file
                     async_task(generate_preview_and_save, record.id, file_extension, mime_type, subtype)
 
-                    # step 7: detect faces
+                    # step 7: detect faces, face regions stored in the metadata (XMP) are imported instead
                     if mime_type == 'image' and file_extension in ['jpg', 'jpeg', 'png', 'PNG', 'JPG'] \
                             and settings.ACTIVATE_FACE_DETECTION:
-                        async_task(create_tagboxes_and_save, record.id)
+                        image_size, face_regions = extract_face_regions(file_read)
+                        if face_regions:
+                            save_face_boxes(record, image_size, face_regions)
+                        if not face_regions or settings.FORCE_FACE_DETECTION:
+                            async_task(create_tagboxes_and_save, record.id)
+            # the embedding model is preloaded by the qcluster workers (see workers.py)
+            batch_size = settings.IMAGE_EMBEDDING_BATCH_SIZE
+            for start in range(0, len(embedding_record_ids), batch_size):
+                async_task(generate_image_embeddings_and_save, embedding_record_ids[start:start + batch_size])
             return self.form_valid(form)
 
         else:
@@ -535,18 +552,19 @@ class RecordUpdateView(LoginRequiredMixin, View):
             return response
 
         # remove permissions from the old album group, update the album of the record and save
-        remove_perm('view_record', record.album.group, record)
+        previous_album = record.album
+        remove_perm('view_record', previous_album.group, record)
         record.album = album
         record.save()
         # add permissions to the album group
         assign_perm('view_record', album.group, record)
 
-        # update nav_ctx (remove record from nav_ctx)
-        if 'nav_ctx' in self.request.session:
-            nav_ctx = self.request.session.get('nav_ctx', [])
-            if record_id in nav_ctx:
-                nav_ctx.remove(record_id)
-                self.request.session['nav_ctx'] = nav_ctx
+        # update the navigation context (remove record from the result set)
+        result_set = get_result_set(self.request)
+        if result_set:
+            remove_record(result_set, record_id)
+        # the other result sets of both albums are created again
+        delete_album_result_sets([previous_album, album], keep=result_set.token if result_set else None)
         return response
 
 
@@ -560,28 +578,14 @@ class RecordView(LoginRequiredMixin, generic.TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         current_record = get_object_or_404(Record, id=self.kwargs['pk'])
-        if 'nav_ctx' in self.request.session:
-            if self.request.session['nav_ctx']:
-                try:
-                    index = self.request.session['nav_ctx'].index(str(current_record.id))
-                except ValueError:
-                    # the record is not in the nav_ctx
-                    index = None
-
-                if index is not None:
-                    context['current_page'] = index // PAGINATE_BY + 1
-                    # this is to prevent the index to take the last item in case the current record is the first one
-                    if index == 0:
-                        context['prev_record'] = None
-                    else:
-                        try:
-                            context['prev_record'] = Record.objects.get(id=self.request.session['nav_ctx'][index - 1])
-                        except IndexError:
-                            context['prev_record'] = None
-                    try:
-                        context['next_record'] = Record.objects.get(id=self.request.session['nav_ctx'][index + 1])
-                    except IndexError:
-                        context['next_record'] = None
+        result_set = get_result_set(self.request)
+        if result_set:
+            # find the neighbours of the record by its rank in the navigation context
+            index, prev_id, next_id = get_position(result_set, current_record.id)
+            if index is not None:
+                context['current_page'] = index // PAGINATE_BY + 1
+                context['prev_record'] = Record.objects.get(id=prev_id) if prev_id else None
+                context['next_record'] = Record.objects.get(id=next_id) if next_id else None
 
         context['record_form'] = RecordForm(instance=current_record)
         context['location_form'] = LocationForm(instance=current_record.location)
@@ -639,6 +643,9 @@ class RecordView(LoginRequiredMixin, generic.TemplateView):
                 record = record_form.save(commit=False)
                 record.location = location_form.save()
                 record.save()
+                if 'date_created' in record_form.changed_data:
+                    # the records of the album are ordered by their date
+                    delete_album_result_sets([record.album])
                 messages.success(request, _('Record was saved!'))
                 return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
             else:
@@ -664,6 +671,12 @@ def delete_record(request, pk):
 
     # store album of the record in case we need to redirect there
     album = record.album
+    # locate the record in the navigation context before it is deleted
+    result_set = get_result_set(request)
+    if result_set:
+        index, record_id, _next_id = get_position(result_set, pk)
+    else:
+        index = None
     try:
         record.delete()
     except Exception as e:
@@ -671,22 +684,6 @@ def delete_record(request, pk):
         file_logger.error(e)
         messages.error(request, _('Record could not be deleted.'))
 
-    # update the navigation context when deleting a record
-    nav_ctx = request.session.get('nav_ctx')
-    if nav_ctx:
-        index = nav_ctx.index(str(pk))
-        if index == 0:
-            pass
-        else:
-            try:
-                record_id = request.session['nav_ctx'][index - 1]
-            except IndexError:
-                pass
-        request.session['nav_ctx'].remove(str(pk))
-        request.session.modified = True
-    else:
-        index = None
-
     messages.success(request, _('Record was deleted.'))
 
     # check if user came from record or search or album page
@@ -694,7 +691,7 @@ def delete_record(request, pk):
         album_mode = request.GET.get('album_mode') == "True"
         # if record was deleted from record page, redirect to previous record
         if 'record' in request.META['HTTP_REFERER']:
-            if record_id:  # if there is still a record in the nav_ctx, redirect to the previous record
+            if record_id:  # if there is a previous record in the result set, redirect to it
                 return redirect(reverse('arch_app:record', kwargs={'pk': record_id}) +
                                 '?album_mode=' + str(album_mode))
             elif album_mode:  # else, redirect to album or search
@@ -703,7 +700,7 @@ def delete_record(request, pk):
                 return redirect(reverse('arch_app:search'))
         # if record was deleted from album or search page, redirect to album or search with the same page
         else:
-            # get page based on the index of the previous record in the nav_ctx
+            # get page based on the index of the previous record in the result set
             page = index // PAGINATE_BY + 1 if index else 1
             return HttpResponseRedirect(request.META.get('HTTP_REFERER') + "&page=" + str(page))
     # default: redirect to search
@@ -743,25 +740,20 @@ class SearchView(LoginRequiredMixin, SearchMixin, generic.ListView):
         Get method for the search view.
 
         """
-        if 'nav_ctx' in self.request.session:
-            if self.request.session['nav_ctx']:
-                nav_ctx = self.request.session['nav_ctx']
-                preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(nav_ctx)])
-                # create a queryset of the current navigation context and filter by permissions
-                self.search_results = get_objects_for_user(self.request.user,
-                                                           "view_record",
-                                                           Record.objects.filter(pk__in=nav_ctx)) \
-                    .order_by(preserved)
-                self.request.session['nav_ctx'] = [str(i.id) for i in self.search_results]
-                paginator = self.get_paginator(self.get_queryset(), self.paginate_by)
-                # check if the page is out of range. If so, redirect to the last page
-                if paginator.num_pages < int(self.request.GET.get('page', 1)):
-                    # redirect to the last page
-                    return redirect(reverse('arch_app:search', kwargs={}) + '?page=' + str(
-                        paginator.num_pages))
-                return super().get(request, *args, **kwargs)
-
-        # empty nv_ctx
+        result_set = get_result_set(self.request)
+        if result_set:
+            # create a queryset of the current navigation context (ordered by rank) and filter by permissions
+            self.search_results = RecordVisibility.objects.filter_records(self.request.user,
+                                                                          ranked_records(result_set))
+            paginator = self.get_paginator(self.get_queryset(), self.paginate_by)
+            # check if the page is out of range. If so, redirect to the last page
+            if paginator.num_pages < int(self.request.GET.get('page', 1)):
+                # redirect to the last page
+                return redirect(reverse('arch_app:search', kwargs={}) + '?page=' + str(
+                    paginator.num_pages))
+            return super().get(request, *args, **kwargs)
+
+        # no navigation context
         self.search_results = Record.objects.none()
         if 'page' in self.request.GET:
             self.object_list = self.get_queryset()
@@ -791,9 +783,9 @@ class SearchView(LoginRequiredMixin, SearchMixin, generic.ListView):
             # generate navigation context given the query parameters provided by the form
             cleaned_data = search_form.cleaned_data
             self.search_results = None
-            search_results_ids, self.search_results = self.get_search_results(cleaned_data)
-            nav_ctx = search_results_ids
-            self.request.session['nav_ctx'] = nav_ctx
+            self.search_results = self.get_search_results(cleaned_data)
+            with vector_search_scope():
+                create_result_set(self.request, self.search_results)
 
             query_params = {
                 'query': cleaned_data['search_query'],
@@ -866,12 +858,14 @@ class AlbumView(LoginRequiredMixin, generic.ListView):
     def get_queryset(self):
         album = Album.objects.get(id=self.kwargs['pk'])
         if album.is_inbox:
-            record_list = get_objects_for_user(self.request.user, "view_record", Record.objects.filter(album=album)) \
-                .order_by('-date_created', '-date_uploaded')
+            record_list = RecordVisibility.objects.filter_records(self.request.user,
+                                                                  Record.objects.filter(album=album)) \
+                .order_by('-date_created', '-date_uploaded', 'pk')
         else:
-            record_list = Record.objects.filter(album=album).order_by('-date_created', '-date_uploaded')
-        nav_ctx = [str(m.id) for m in record_list]  # create navigation context session
-        self.request.session['nav_ctx'] = nav_ctx
+            record_list = Record.objects.filter(album=album).order_by('-date_created', '-date_uploaded', 'pk')
+        # create the navigation context, it is reused by the next pages until records are added or removed (moved and
+        # edited records delete the result sets of the album, see delete_album_result_sets)
+        get_or_create_result_set(self.request, record_list, key=f'album:{album.id}:{record_list.count()}')
         return record_list
 
     def get_context_data(self, **kwargs):
@@ -1032,103 +1026,29 @@ def set_language(request):
     return response
 
 
-def generate_autocomplete_json(query_results, max_length=70):
-    """
-    generates a json object for the autocomplete function of the search bar
-    query_results: QuerySet of the search results
-    max_length: int. Truncates the results to the given length
-    """
-    query_results_json = []
-    for q_result in query_results:
-        for r in q_result:
-            if r:
-                query_results_json.append(r[:max_length] + ('...' if len(r) > max_length else ''))
-    return query_results_json
-
-
 @login_required
 def autocomplete(request):
     """
     The function handles different autocomplete types ('search_location', 'search_depicted_users', 'search_input').
     Results are consumed by the autocomplete (jquery) function of the search bar.
     """
-    if request.GET.get('autocomplete') == 'search_location':
-        if 'term' in request.GET:
-            q_list = [
-                Q(location__name__icontains=request.GET['term']),
-                Q(location__country__icontains=request.GET['term']),
-                Q(location__state__icontains=request.GET['term']),
-                Q(location__region__icontains=request.GET['term']),
-            ]
-            # filter record by permissions
-            filtered_records = get_objects_for_user(
-                request.user,
-                'view_record',
-                Record.objects.select_related('location').filter(Q(*q_list, _connector=Q.OR))
-            )
-            query_results = filtered_records.values_list('location__name',
-                                                         'location__country',
-                                                         'location__state',
-                                                         'location__region').distinct()
-
-            return JsonResponse(list(set(generate_autocomplete_json(query_results))), safe=False)
-
-    if request.GET.get('autocomplete') == 'search_depicted_users':
-        if 'term' in request.GET:
-            q_list = [
-                Q(depicted_users__user__username__icontains=request.GET['term']),
-                Q(depicted_users__user__first_name__icontains=request.GET['term']),
-                Q(depicted_users__user__last_name__icontains=request.GET['term']),
-            ]
-            # get residential groups of the user
-            archives = User.objects.get(id=request.user.id).archives.all()
-            active_members = [archive.get_active_members() for archive in archives]
-            # merge query sets
-            query_merged = chain.from_iterable(active_members)
-
-            users_data = []
-            for u in query_merged:
-                if u.username:
-                    users_data.append(u.username)
-                if u.first_name:
-                    users_data.append(u.first_name)
-                if u.last_name:
-                    users_data.append(u.last_name)
-
-            filtered_records = get_objects_for_user(
-                request.user,
-                'view_record',
-                Record.objects.select_related('depicted_users').filter(Q(*q_list, _connector=Q.OR))
-            )
-            query_results = filtered_records.values_list('depicted_users__user__username',
-                                                         'depicted_users__user__first_name',
-                                                         'depicted_users__user__last_name').distinct()
-
-            query_results_json = []
-            for q_result in query_results:
-                for r in q_result:
-                    if r:
-                        if r in users_data:
-                            query_results_json.append(r)
-                        else:
-                            break
-
-            return JsonResponse(list(set(query_results_json)), safe=False)
-
-    if request.GET.get('autocomplete') == 'search_input':
-        if 'term' in request.GET:
-            query = Q(title__icontains=request.GET['term']) | Q(user_caption__icontains=request.GET['term'])
-            # filter record by permissions
-            filtered_records = get_objects_for_user(
-                request.user,
-                'view_record',
-                Record.objects.filter(query)
-            )
-            query_results = filtered_records.values_list('title', 'user_caption').distinct()
+    kind = AUTOCOMPLETE_KINDS.get(request.GET.get('autocomplete'))
+    if kind and 'term' in request.GET:
+        return JsonResponse(AutocompleteSuggestion.objects.suggest(request.user, kind, request.GET['term'],
+                                                                   limit=AUTOCOMPLETE_LIMIT), safe=False)
+    return JsonResponse([], safe=False)
 
-            return JsonResponse(list(set(generate_autocomplete_json(query_results))), safe=False)
 
-    return JsonResponse([], safe=False)
+@login_required
+def ai_model_status(request):
+    """
+    Returns the AI models of the web process which answers the request (loaded, idle time), their recent load and
+    evict events and the resident memory of the process, for monitoring by the admin.
+    """
+    if not request.user.has_perm('is_admin'):
+        return JsonResponse({'error': _('You do not have permission to view this page.')}, status=403)
+    from .modules.embeddings.text_image_embedding import ai_models
+    return JsonResponse(ai_models.status())
 
 
 class TagCreateView(LoginRequiredMixin, generic.View):
@@ -1269,11 +1189,9 @@ def pixelate_image(request, pk):
         messages.error(request, _('Only images can be pixelated.'))
         return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
-    blur_image(image_path=record.preview_file.path,
-               coordinates=(tag_box.x1, tag_box.y1, tag_box.x2, tag_box.y2)
-               )
     tag_box.visible = 'hidden_by_mod'
     tag_box.save()
+    render_preview(record)
     messages.success(request, _('Image was pixelated successfully.'))
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
@@ -1288,11 +1206,9 @@ def show_tag(request, pk):
         messages.error(request, _('You do not have permission to show this tag.'))
         # redirect to where the user came from
         return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
-    unblur_image(image_path=record.preview_file.path,
-                 original_file_path=record.media_file.path,
-                 coordinates=(tag_box.x1, tag_box.y1, tag_box.x2, tag_box.y2))
     tag_box.visible = 'visible'
     tag_box.save()
+    render_preview(record)
     messages.success(request, _('Tag was shown successfully.'))
     # reload the page
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
@@ -1385,11 +1301,9 @@ def hide_personal_data(request):
     for tag in Tag.objects.filter(user=user):
         tag.visible = 'hidden_by_user'
         tag.save()
-    # blur all images
-    for tagbox in TagBox.objects.filter(user=user):
-        blur_image(image_path=tagbox.record.preview_file.path,
-                   coordinates=(tagbox.x1, tagbox.y1, tagbox.x2, tagbox.y2)
-                   )
+    # blur the faces of the user on the previews of all images
+    for record_id in TagBox.objects.filter(user=user).values_list('record', flat=True).distinct():
+        async_task(render_preview_and_save, record_id)
     # send mail to user with information link to delete account
     # Build the URL to permanently delete the account
     # encode the user's primary key
@@ -1446,13 +1360,15 @@ class DeleteAccountView(generic.TemplateView):
         # check if the token is valid
         if user is not None and default_token_generator.check_token(user, token):
             # delete all personal data
-            # blur all images
-            for tagbox in TagBox.objects.filter(user=user):
-                blur_image(image_path=tagbox.record.media_file.path,
-                           coordinates=(tagbox.x1, tagbox.y1, tagbox.x2, tagbox.y2)
-                           )
+            # blur the faces of the user on all images permanently, the TagBoxes are deleted with the user, so
+            # their boxes are passed to the tasks
+            tagboxes = {}
+            for record_id, *box in TagBox.objects.filter(user=user).values_list('record', *BOX_FIELDS):
+                tagboxes.setdefault(record_id, []).append(tuple(box))
             # delete user account (and all related data, e.g. comments, tags, etc.)
             user.delete()
+            for record_id, boxes in tagboxes.items():
+                async_task(blur_faces_and_save, record_id, boxes)
             # send confirmation email
             email_status = send_email(user.email,
                                       subject="Account deleted",
@@ -0,0 +1,77 @@
+"""
+Preparation of the Django Q2 worker processes (qcluster).
+
+Every worker runs settings.QCLUSTER_WARMUP_HOOK when it starts, the default hook loads the AI models used by the
+tasks, so that the first embedding or face detection task does not wait for the models (and does not run into the
+task timeout). Models which would exceed settings.QCLUSTER_MEMORY_BUDGET are loaded by their first task instead.
+The memory a model adds to a worker is logged by the warm-up, it can replace the estimates (QCLUSTER_MODEL_MEMORY).
+"""
+import importlib
+from django.conf import settings
+from django.dispatch import receiver
+from django_q.signals import post_spawn
+from .modules.embeddings.model_registry import resident_memory
+
+import logging
+console_logger = logging.getLogger('ARCH_console_logger')
+
+# estimated resident memory in MB a model adds to a worker (CLIP image and text model, the face detectors including
+# their libraries, e.g. TensorFlow for cvlib), settings.QCLUSTER_MODEL_MEMORY overrides them with measured values
+MODEL_MEMORY = {
+    'embedding': 1200,
+    'embedding_quantized': 700,
+    'face_detection_cvlib': 800,
+    'face_detection_ssd': 60,
+    'face_detection_yunet': 30,
+}
+
+
+def model_memory(model):
+    """ returns the memory in MB a model adds to a worker (as configured or estimated) """
+    return settings.QCLUSTER_MODEL_MEMORY.get(model, MODEL_MEMORY[model])
+
+
+def fits_memory_budget(model):
+    """ returns whether a model fits into the memory budget of the worker, logs a warning otherwise """
+    if not settings.QCLUSTER_MEMORY_BUDGET or \
+            resident_memory() + model_memory(model) <= settings.QCLUSTER_MEMORY_BUDGET:
+        return True
+    console_logger.warning(f"Worker warm-up: the {model} model is not preloaded, it exceeds the memory budget of "
+                           f"{settings.QCLUSTER_MEMORY_BUDGET} MB ({resident_memory():.0f} MB in use)")
+    return False
+
+
+def load_model(model, load):
+    """ loads a model if it fits into the memory budget and logs the memory it added to the worker """
+    if not fits_memory_budget(model):
+        return
+    memory = resident_memory()
+    load()
+    console_logger.info(f"Worker warm-up: loaded the {model} model (+{resident_memory() - memory:.0f} MB, "
+                        f"estimated {model_memory(model)} MB)")
+
+
+def warm_up_models():
+    """ Loads the models of the activated AI features as far as they fit into the memory budget. """
+    if settings.INFERENCE_SOCKET:
+        # the models are hosted by the inference server
+        return
+    if settings.ACTIVATE_AI_SEARCH:
+        from .modules.embeddings.text_image_embedding import init_ai_models
+        load_model('embedding_quantized' if settings.QUANTIZE_CLIP_MODELS else 'embedding', init_ai_models)
+    if settings.ACTIVATE_FACE_DETECTION:
+        from .modules.computer_vision.face_detection import warm_up
+        load_model(f'face_detection_{settings.FACE_DETECTOR}', warm_up)
+    console_logger.info(f"Worker warm-up finished ({resident_memory():.0f} MB in use)")
+
+
+@receiver(post_spawn)
+def run_warmup_hook(sender, proc_name, **kwargs):
+    """ Runs settings.QCLUSTER_WARMUP_HOOK in a new worker process, errors are logged and do not stop the worker """
+    if not settings.QCLUSTER_WARMUP_HOOK:
+        return
+    module_name, function_name = settings.QCLUSTER_WARMUP_HOOK.rsplit('.', 1)
+    try:
+        getattr(importlib.import_module(module_name), function_name)()
+    except Exception as error:
+        console_logger.error(f"Worker warm-up of {proc_name} failed: {error}")
@@ -0,0 +1,24 @@
+"""
+Models of the pgvector index. The app is only installed with VECTOR_SEARCH_BACKEND='pgvector' (see settings), so the
+vector column and its HNSW index are only created in databases with the pgvector extension.
+"""
+from django.conf import settings
+from django.db import models
+from pgvector.django import VectorField, HnswIndex
+
+
+class RecordVector(models.Model):
+    """
+    Copy of a record embedding in a pgvector column with an HNSW index for nearest neighbour search. Only the vectors of
+    the current image model (model_version, see get_image_model_version) are searched.
+    """
+    record = models.OneToOneField('arch_app.Record', on_delete=models.CASCADE, primary_key=True,
+                                  related_name='vector')
+    model_version = models.CharField(max_length=128)
+    embedding = VectorField(dimensions=settings.IMAGE_EMBEDDING_DIMENSIONS)
+
+    class Meta:
+        indexes = [
+            HnswIndex(name='record_vector_hnsw', fields=['embedding'], m=16, ef_construction=64,
+                      opclasses=['vector_cosine_ops'])
+        ]